@@ -0,0 +1,9 @@
+from django.contrib import admin
+from .models import Game
+
+
+@admin.register(Game)
+class GameAdmin(admin.ModelAdmin):
+    list_display = ("uuid", "status", "winner_colour", "created", "ended")
+    list_filter = ("status",)
+    search_fields = ("uuid", "white_uuid", "black_uuid")
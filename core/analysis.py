@@ -0,0 +1,245 @@
+import asyncio
+import functools
+import json
+import logging
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import chess
+import chess.engine
+from channels.layers import get_channel_layer
+from django.conf import settings
+from . import metrics, searcher, wire
+from .positions import hasher
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# process-local analyses by (Zobrist hash, depth), least recently used first
+cache = OrderedDict()
+# channels waiting for the analysis of a queued (hash, depth)
+pending = {}
+# job queues by event loop, each served by one task per engine
+queues = {}
+# process-local rate limits by user, least recently used first
+buckets = OrderedDict()
+# the most users whose rate limit is remembered
+MAX_LIMITED_USERS = 10_000
+
+
+class UciEngine:
+    """A GAME_ENGINE_PATH subprocess spoken to over UCI, restarted if it dies."""
+
+    def __init__(self):
+        self.protocol = None
+
+    async def analyse(self, board, depth, seconds=None):
+        if self.protocol is None:
+            _, self.protocol = await chess.engine.popen_uci(settings.GAME_ENGINE_PATH)
+
+        try:
+            info = await self.protocol.analyse(
+                board,
+                chess.engine.Limit(
+                    depth=depth,
+                    time=settings.GAME_ANALYSIS_TIME if seconds is None else seconds,
+                ),
+            )
+        except chess.engine.EngineTerminatedError:
+            self.protocol = None
+            raise
+
+        score = info.get("score")
+        score = score.white() if score else None
+        return {
+            "depth": info.get("depth", 0),
+            "score": score.score() if score else None,
+            "mate": score.mate() if score else None,
+            "pv": info.get("pv", []),
+        }
+
+
+@functools.lru_cache(maxsize=None)
+def searcher_pool():
+    # spawned rather than forked from the multi-threaded server
+    return ProcessPoolExecutor(
+        settings.GAME_ENGINE_POOL_SIZE, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+class SearcherEngine:
+    """The pure Python searcher, run in a worker process of pool()."""
+
+    def __init__(self, pool=searcher_pool):
+        self.pool = pool
+
+    async def analyse(self, board, depth, seconds=None):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.pool(),
+            searcher.search,
+            board.fen(),
+            depth,
+            settings.GAME_ANALYSIS_TIME if seconds is None else seconds,
+        )
+
+
+def user_key(scope, channel_name):
+    """Return who is rate limited for a socket, its channel when anonymous."""
+    user = scope.get("user")
+    if user and user.is_authenticated:
+        return user.pk
+    return channel_name
+
+
+def result_event(fen, board, analysis):
+    """Return an analysis as the analysed event sent to the consumers."""
+    sans = []
+    pv_board = board.copy(stack=False)
+    for move in analysis["pv"]:
+        sans.append(pv_board.san(move))
+        pv_board.push(move)
+
+    return {
+        "type": "analysed",
+        "fen": fen,
+        "depth": analysis["depth"],
+        "score": analysis["score"],
+        "mate": analysis["mate"],
+        "moves": [wire.encode_move(move) for move in analysis["pv"]],
+        "sans": sans,
+        "error": "",
+    }
+
+
+def error_event(fen, error):
+    return {
+        "type": "analysed",
+        "fen": fen,
+        "depth": 0,
+        "score": None,
+        "mate": None,
+        "moves": [],
+        "sans": [],
+        "error": error,
+    }
+
+
+def analysis_frame(event, msgpack):
+    if msgpack:
+        return {
+            "bytes_data": wire.pack(
+                wire.ANALYSIS,
+                event["fen"],
+                event["depth"],
+                event["score"],
+                event["mate"],
+                event["moves"],
+                event["error"],
+            )
+        }
+
+    text_data = {
+        "command": "analysis",
+        "fen": event["fen"],
+        "depth": event["depth"],
+        "score": event["score"],
+        "mate": event["mate"],
+        "moves": event["sans"],
+        "error": event["error"],
+    }
+    return {"text_data": json.dumps(text_data)}
+
+
+class AnalysisService:
+    """Analyses positions on a bounded pool of engines.
+
+    GAME_ENGINE_POOL_SIZE engines, UCI subprocesses or the pure Python
+    searcher in worker processes, take jobs from a queue of at most
+    GAME_ANALYSIS_QUEUE_SIZE positions, so the event loop only waits on
+    pipes. A full queue answers busy rather than growing. Analyses are kept
+    in an LRU by Zobrist hash and depth, so common positions are answered
+    at once, and a position already queued isn't queued again. Every user
+    may have GAME_ANALYSIS_BURST positions analysed at once and
+    GAME_ANALYSIS_RATE more per second, cached answers are free.
+    """
+
+    async def analyse(self, user, fen, depth, channel):
+        """Return the analysed event for fen, or None if it's sent to channel."""
+        try:
+            board = chess.Board(fen)
+            depth = int(depth or settings.GAME_ANALYSIS_DEPTH)
+        except (TypeError, ValueError):
+            return error_event(fen, "invalid")
+        if not board.is_valid():
+            return error_event(fen, "invalid")
+        depth = min(max(depth, 1), settings.GAME_ANALYSIS_MAX_DEPTH)
+
+        key = (hasher(board), depth)
+        analysis = cache.get(key)
+        if analysis:
+            cache.move_to_end(key)
+            metrics.ANALYSES.inc("cached")
+            return result_event(fen, board, analysis)
+
+        jobs = self.jobs()
+        if key not in pending and jobs.full():
+            metrics.ANALYSES.inc("busy")
+            return error_event(fen, "busy")
+        if not self.allow(user):
+            metrics.ANALYSES.inc("limited")
+            return error_event(fen, "limited")
+
+        if key in pending:
+            pending[key].append((channel, fen))
+        else:
+            pending[key] = [(channel, fen)]
+            jobs.put_nowait((key, board))
+        return None
+
+    def allow(self, user):
+        bucket = buckets.get(user)
+        if bucket is None:
+            bucket = buckets[user] = TokenBucket(
+                settings.GAME_ANALYSIS_RATE, settings.GAME_ANALYSIS_BURST
+            )
+            if len(buckets) > MAX_LIMITED_USERS:
+                buckets.popitem(last=False)
+        buckets.move_to_end(user)
+        return bucket.take()
+
+    def jobs(self):
+        """Return the job queue of the running loop, starting its engines."""
+        loop = asyncio.get_running_loop()
+        jobs = queues.get(loop)
+        if jobs is None:
+            for stale in [stale for stale in queues if stale.is_closed()]:
+                del queues[stale]
+
+            jobs = queues[loop] = asyncio.Queue(settings.GAME_ANALYSIS_QUEUE_SIZE)
+            for _ in range(settings.GAME_ENGINE_POOL_SIZE):
+                engine = UciEngine() if settings.GAME_ENGINE_PATH else SearcherEngine()
+                asyncio.ensure_future(self.serve(jobs, engine))
+        return jobs
+
+    async def serve(self, jobs, engine):
+        channel_layer = get_channel_layer()
+        while True:
+            key, board = await jobs.get()
+            try:
+                analysis = await engine.analyse(board, key[1])
+            except Exception:
+                logger.exception("Failed to analyse %s", board.fen())
+                analysis = None
+
+            if analysis:
+                metrics.ANALYSES.inc("analysed")
+                cache[key] = analysis
+                if len(cache) > settings.GAME_ANALYSIS_CACHE_SIZE:
+                    cache.popitem(last=False)
+
+            for channel, fen in pending.pop(key, ()):
+                if analysis:
+                    event = result_event(fen, board, analysis)
+                else:
+                    event = error_event(fen, "failed")
+                await channel_layer.send(channel, event)
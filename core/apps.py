@@ -1,6 +1,15 @@
+import signal
+import threading
 from django.apps import AppConfig
 
 
 class CoreConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'core'
+
+    def ready(self):
+        from . import handoff
+
+        # `kill -USR1 <pid>` drains the process before a restart
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, handoff.on_signal)
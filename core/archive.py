@@ -0,0 +1,132 @@
+from datetime import timedelta
+import atexit
+import logging
+import queue
+import threading
+import time
+from django.conf import settings
+from django.db import close_old_connections
+from . import models, wire
+
+logger = logging.getLogger(__name__)
+
+STATUSES = {"abandonment": "A", "checkmate": "C", "timeout": "T"}
+
+# finished games waiting to be written, bounded so a slow database can't
+# grow it without limit
+pending = queue.Queue(maxsize=settings.GAME_ARCHIVE_QUEUE_SIZE)
+writer = None
+writer_lock = threading.Lock()
+# set on exit, the writer flushes what's queued and stops
+stopping = threading.Event()
+
+
+class GameArchive:
+    """Persists finished games off the game loop.
+
+    add() only enqueues; a background thread turns the games into rows and
+    writes them with bulk_create in batches of GAME_ARCHIVE_BATCH_SIZE, or
+    whatever arrived within GAME_ARCHIVE_FLUSH_INTERVAL seconds. Games still
+    queued are written when the process exits. Nothing is archived while
+    GAME_ARCHIVE is off. The players' ratings don't wait on the archive, the
+    owner of the game applies them itself.
+    """
+
+    def add(self, game):
+        if not settings.GAME_ARCHIVE:
+            return
+
+        start_writer()
+        try:
+            pending.put_nowait(game)
+        except queue.Full:
+            logger.warning("Game archive queue is full, dropping game %s", game.uuid)
+
+
+def start_writer():
+    global writer
+
+    if writer:
+        return
+
+    with writer_lock:
+        if not writer:
+            writer = threading.Thread(
+                target=write_forever, name="game-archive", daemon=True
+            )
+            writer.start()
+            atexit.register(stop_writer)
+
+
+def stop_writer():
+    """Flush the queued games and wait for the writer to finish."""
+    stopping.set()
+    try:
+        # wakes an idle writer, a full queue has it busy until it sees stopping
+        pending.put_nowait(None)
+    except queue.Full:
+        pass
+    writer.join(timeout=settings.GAME_ARCHIVE_FLUSH_INTERVAL * 10)
+
+
+def write_forever():
+    while True:
+        batch = [pending.get()]
+        deadline = time.monotonic() + settings.GAME_ARCHIVE_FLUSH_INTERVAL
+        while batch[-1] and len(batch) < settings.GAME_ARCHIVE_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(pending.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        if stopping.is_set():
+            # drain whatever was queued ahead of shutdown
+            while not pending.empty():
+                batch.append(pending.get_nowait())
+            write([game for game in batch if game])
+            return
+
+        write(batch)
+
+
+def write(games):
+    if not games:
+        return
+
+    close_old_connections()
+    try:
+        models.Game.objects.bulk_create(
+            [to_model(game) for game in games],
+            batch_size=settings.GAME_ARCHIVE_BATCH_SIZE,
+            ignore_conflicts=True,
+        )
+    except Exception:
+        logger.exception("Failed to archive %d games", len(games))
+
+
+def to_model(game):
+    if game.result["type"] == "inform_draw":
+        status, winner_colour = "D", None
+    else:
+        status = STATUSES[game.result["by"]]
+        winner_colour = game.result["winner_colour"]
+
+    return models.Game(
+        uuid=game.uuid,
+        white_uuid=game.white_uuid,
+        black_uuid=game.black_uuid,
+        white_id=game.white_user_id,
+        black_id=game.black_user_id,
+        status=status,
+        winner_colour=winner_colour,
+        moves=" ".join(wire.decode_move(code).uci() for code in game.moves),
+        fen=game.fen,
+        time_control=game.control,
+        white_timer=timedelta(milliseconds=game.used(True)),
+        black_timer=timedelta(milliseconds=game.used(False)),
+        created=game.created,
+        ended=game.ended,
+    )
@@ -0,0 +1,189 @@
+import glob
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.templatetags.static import static
+
+try:
+    import brotli
+except ImportError:  # optional, only gzip variants are written without it
+    brotli = None
+
+# The build lives in BUILD under GAME_ASSETS_ROOT, a static files directory.
+# Every file is named after its content hash, so it never changes and may be
+# cached for good, and its text files sit next to .gz and .br variants for
+# the web server to send as they are. manifest.json maps bundle and source
+# names to the built files.
+BUILD = "build"
+MANIFEST = "manifest.json"
+# already compressed, not worth a variant
+COMPRESSED = {".png", ".jpg", ".jpeg", ".gif", ".woff", ".woff2"}
+
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+CSS_COMMENT = re.compile(r"/\*(?!!).*?\*/", re.S)
+CSS_SPACE = re.compile(r"\s+")
+CSS_PUNCTUATION = re.compile(r"\s*([{};,>])\s*")
+
+# the manifest of this process with the file version it was read from,
+# reread when a build replaces the file
+loaded = {}
+
+
+def content_name(path, data):
+    """Return path with the hash of data before its extension."""
+    root, ext = posixpath.splitext(path)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def source(path):
+    """Return the bytes of the static file at path, wherever it's found."""
+    found = finders.find(path)
+    if not found:
+        raise FileNotFoundError(f"static file {path} not found")
+    with open(found, "rb") as f:
+        return f.read()
+
+
+def minify_css(text):
+    """Drop comments and the whitespace css doesn't need, keeping /*! notices."""
+    text = CSS_COMMENT.sub("", text)
+    text = CSS_SPACE.sub(" ", text)
+    return CSS_PUNCTUATION.sub(r"\1", text).strip()
+
+
+def minify_js(text):
+    """Drop indentation, blank lines and whole line // comments.
+
+    Anything bolder needs a parser, so already minified files are left
+    alone and the rest is left to compression.
+    """
+    lines = (line.strip() for line in text.splitlines())
+    return "\n".join(line for line in lines if line and not line.startswith("//"))
+
+
+class AssetBuilder:
+    """Writes the bundles of GAME_ASSET_BUNDLES into root/BUILD."""
+
+    def __init__(self, root):
+        self.root = root
+        self.files = {}
+
+    def write(self, path, data):
+        """Write data under its content name, with its compressed variants."""
+        built = content_name(posixpath.join(BUILD, path), data)
+        target = os.path.join(self.root, built)
+        if os.path.exists(target):
+            return built  # unchanged since an earlier build
+
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        variants = [("", data)]
+        if posixpath.splitext(path)[1] not in COMPRESSED:
+            # no timestamp, so the same file always compresses the same
+            variants.append((".gz", gzip.compress(data, 9, mtime=0)))
+            if brotli:
+                variants.append((".br", brotli.compress(data)))
+        for suffix, content in variants:
+            with open(f"{target}{suffix}.tmp", "wb") as f:
+                f.write(content)
+        # the plain file last, a reader seeing it finds the variants too
+        for suffix, _ in reversed(variants):
+            os.replace(f"{target}{suffix}.tmp", f"{target}{suffix}")
+        return built
+
+    def file(self, path):
+        """Build the static file at path, returning its built name."""
+        path = posixpath.normpath(path)
+        if path not in self.files:
+            self.files[path] = self.write(path, source(path))
+        return self.files[path]
+
+    def css(self, path):
+        """Return the css at path with its urls pointing at built files."""
+
+        def rewrite(match):
+            quote, url = match.groups()
+            if re.match(r"^([a-z]+:|/|#)", url):
+                return match.group(0)  # data: uris, absolute and fragments
+            target, suffix = re.match(r"([^?#]*)(.*)", url).groups()
+            target = posixpath.join(posixpath.dirname(path), target)
+            try:
+                built = self.file(target)
+            except FileNotFoundError:
+                built = posixpath.normpath(target)
+            # bundles are written in BUILD
+            return f"url({quote}{posixpath.relpath(built, BUILD)}{suffix}{quote})"
+
+        return CSS_URL.sub(rewrite, minify_css(source(path).decode()))
+
+    def bundle(self, name, paths):
+        if name.endswith(".css"):
+            text = "\n".join(self.css(path) for path in paths)
+        else:
+            parts = []
+            for path in paths:
+                text = source(path).decode()
+                parts.append(text if path.endswith(".min.js") else minify_js(text))
+            text = "\n;\n".join(parts)
+        return self.write(name, text.encode())
+
+    def build(self):
+        bundles = {
+            name: self.bundle(name, paths)
+            for name, paths in settings.GAME_ASSET_BUNDLES.items()
+        }
+        static_dirs = [str(path) for path in settings.STATICFILES_DIRS]
+        for pattern in settings.GAME_ASSET_FILES:
+            for static_dir in static_dirs:
+                for found in sorted(glob.glob(os.path.join(static_dir, pattern))):
+                    self.file(os.path.relpath(found, static_dir).replace(os.sep, "/"))
+
+        manifest = {"bundles": bundles, "files": self.files}
+        path = os.path.join(self.root, BUILD, MANIFEST)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(f"{path}.tmp", path)
+        return manifest
+
+
+def build(root=None):
+    """Build the asset bundles, returning the manifest written.
+
+    Files of earlier builds are kept, pages cached before the build still
+    point at them.
+    """
+    return AssetBuilder(root or settings.GAME_ASSETS_ROOT).build()
+
+
+def manifest():
+    """Return the manifest of the last build, None if there was none."""
+    path = os.path.join(settings.GAME_ASSETS_ROOT, BUILD, MANIFEST)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+
+    version = (path, stat.st_ino, stat.st_mtime_ns)
+    current = loaded.get("manifest")
+    if not current or current[0] != version:
+        with open(path) as f:
+            current = loaded["manifest"] = (version, json.load(f))
+    return current[1]
+
+
+def bundle_urls(name):
+    """Return the urls a page loads for a bundle, its sources if unbuilt."""
+    built = manifest()
+    if built and name in built["bundles"]:
+        return [static(built["bundles"][name])]
+    return [static(path) for path in settings.GAME_ASSET_BUNDLES[name]]
+
+
+def url(path):
+    """Return the url of a static file, built if it was."""
+    built = manifest()
+    return static(built["files"].get(path, path) if built else path)
@@ -0,0 +1,131 @@
+import asyncio
+import functools
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import chess
+from channels.layers import get_channel_layer
+from django.conf import settings
+from . import metrics, searcher, wire
+from .analysis import SearcherEngine, UciEngine
+from .games import GameRegistry
+
+logger = logging.getLogger(__name__)
+
+# the opponent uuid players see for the computer
+COMPUTER_UUID = "computer"
+
+# job queues by event loop, each served by one task per engine
+queues = {}
+# games whose computer move an engine is searching right now
+searching = set()
+
+
+@functools.lru_cache(maxsize=None)
+def computer_pool():
+    # a pool of its own, games don't wait on analyses nor the other way round
+    return ProcessPoolExecutor(
+        settings.GAME_COMPUTER_POOL_SIZE,
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+
+def fallback_move(board):
+    """Return a move found without an engine, the most valuable capture first."""
+    return searcher.ordered_moves(board)[0]
+
+
+class ComputerService:
+    """Plays the computer's side of games on a bounded pool of engines.
+
+    Runs in the owner of the game, which asks for a move whenever it's the
+    computer's turn. GAME_COMPUTER_POOL_SIZE engines, UCI subprocesses or the
+    pure Python searcher in worker processes of their own, take the searches
+    from a queue of at most GAME_COMPUTER_QUEUE_SIZE, so the event loop only
+    waits on pipes. The move found is sent to the owner as a play_move, the
+    same event a player's move is, and goes on the computer's clock. A move
+    asked for while the queue is full is played at once without an engine,
+    and counted.
+    """
+
+    async def think(self, game, owner):
+        """Have the computer's next move in game played on owner."""
+        colour, depth, seconds = game.computer
+        # a slice of what's left, the computer doesn't lose on time
+        left = max(game.remaining(colour), 0) / 1000
+        seconds = min(seconds, left / settings.GAME_COMPUTER_MOVES_LEFT)
+        job = (game.uuid, len(game.moves), game.board.fen(), depth, seconds, owner)
+        try:
+            self.jobs().put_nowait(job)
+        except asyncio.QueueFull:
+            metrics.COMPUTER_MOVES.inc("busy")
+            await self.play(job, fallback_move(game.board))
+
+    def jobs(self):
+        """Return the job queue of the running loop, starting its engines."""
+        loop = asyncio.get_running_loop()
+        jobs = queues.get(loop)
+        if jobs is None:
+            for stale in [stale for stale in queues if stale.is_closed()]:
+                del queues[stale]
+
+            jobs = queues[loop] = asyncio.Queue(settings.GAME_COMPUTER_QUEUE_SIZE)
+            for _ in range(settings.GAME_COMPUTER_POOL_SIZE):
+                if settings.GAME_ENGINE_PATH:
+                    engine = UciEngine()
+                else:
+                    engine = SearcherEngine(computer_pool)
+                asyncio.ensure_future(self.serve(jobs, engine))
+        return jobs
+
+    async def serve(self, jobs, engine):
+        while True:
+            job = await jobs.get()
+            game_uuid, _, fen, depth, seconds, _ = job
+            board = chess.Board(fen)
+            searching.add(game_uuid)
+            try:
+                analysis = await engine.analyse(board, depth, seconds)
+            except Exception:
+                logger.exception("Failed to search %s", fen)
+                analysis = None
+            finally:
+                searching.discard(game_uuid)
+
+            if analysis and analysis["pv"]:
+                metrics.COMPUTER_MOVES.inc("searched")
+                await self.play(job, analysis["pv"][0])
+            else:
+                metrics.COMPUTER_MOVES.inc("failed")
+                await self.play(job, fallback_move(board))
+
+    async def play(self, job, move):
+        """Send move to the owner, unless the game went on or ended meanwhile."""
+        game_uuid, ply, _, _, _, owner = job
+        game = GameRegistry().get(game_uuid)
+        if not game or game.result or len(game.moves) != ply:
+            return
+
+        await get_channel_layer().send(
+            owner,
+            {
+                "type": "play_move",
+                "game_uuid": game_uuid,
+                "colour": game.computer[0],
+                "san": None,
+                "code": wire.encode_move(move),
+                "channel": None,
+            },
+        )
+
+
+metrics.Gauge(
+    "chess_computer_moves_queued",
+    "Computer moves waiting for an engine of this process.",
+    lambda: sum(jobs.qsize() for jobs in queues.values()),
+)
+metrics.Gauge(
+    "chess_computer_engines_busy",
+    "Engines of this process searching a computer move.",
+    lambda: len(searching),
+)
@@ -1,14 +1,382 @@
-from datetime import timedelta
+import asyncio
 import json
+import re
+import time
 import uuid
-import chess
 from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
-from django.utils import timezone, dateparse
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer, WebsocketConsumer
+from django.conf import settings
+from . import handoff, metrics, shards, wire
+from .analysis import AnalysisService, analysis_frame, error_event, user_key
+from .computer import COMPUTER_UUID
+from .games import Game
+from .ratelimit import FrameLimiter
+from .scheduler import SearchScheduler
+from .spectators import SpectatorHub
 from .waiting_queue import WaitingQueue
+from users.models import DEFAULT_RATING
+
+# close codes of sockets sending frames they shouldn't
+UNSUPPORTED_DATA = 1003
+POLICY_VIOLATION = 1008
+MESSAGE_TOO_BIG = 1009
+
+# game uuids and resume tokens, 32 lowercase hex digits
+HEX_ID = re.compile("[0-9a-f]{32}")
+
+
+def well_formed(data):
+    """Return whether a command carries the fields its handler reads, as typed."""
+    command = data["command"]
+    if command == "move":
+        # a SAN, or a move code as binary frames send
+        return isinstance(data.get("san"), str) or type(data.get("move")) is int
+    if command == "resume":
+        # compare_digest raises on a token of anything but ASCII
+        return all(
+            isinstance(data.get(field), str) and HEX_ID.fullmatch(data[field])
+            for field in ("game", "token")
+        )
+    optional = {"find_opponent": "control", "play_computer": "level"}.get(command)
+    return optional is None or isinstance(data.get(optional), (str, type(None)))
+
+
+class CommandMixin:
+    """Parses and limits the command frames a socket receives.
+
+    Sockets using it set self.limiter to a frame_limiter() on connect.
+    """
+
+    def load_command(self, text_data, bytes_data):
+        if bytes_data is not None:
+            return wire.unpack_command(bytes_data)
+        return json.loads(text_data)
+
+    def frame_limiter(self):
+        return FrameLimiter(
+            settings.GAME_FRAME_LIMITS,
+            settings.GAME_FRAME_INTERVALS,
+            settings.GAME_FRAME_STRIKES,
+            settings.GAME_FRAME_STRIKE_RATE,
+        )
+
+    def admit(self, text_data, bytes_data):
+        """Return the command of a frame, None to drop it, and a close code.
+
+        Frames are dropped unparsed over GAME_MAX_FRAME_BYTES and over the
+        socket's limits. The socket is closed when a frame is too big or
+        malformed, with fields missing or of the wrong type, once it's out of
+        strikes and, while this process drains, on the commands it refuses.
+        """
+        frame = text_data if bytes_data is None else bytes_data
+        if len(frame) > settings.GAME_MAX_FRAME_BYTES:
+            metrics.THROTTLED_FRAMES.inc("oversize")
+            return None, MESSAGE_TOO_BIG
+        try:
+            data = self.load_command(text_data, bytes_data)
+            command = data["command"]
+        except (ValueError, TypeError, LookupError):
+            command = None
+        if not isinstance(command, str) or not well_formed(data):
+            metrics.THROTTLED_FRAMES.inc("malformed")
+            return None, UNSUPPORTED_DATA
+
+        if command in handoff.REFUSED and handoff.draining():
+            return None, handoff.SERVICE_RESTART
+        throttled = self.limiter.check(command)
+        if throttled:
+            metrics.THROTTLED_FRAMES.inc(throttled)
+            return None, POLICY_VIOLATION if self.limiter.exhausted else None
+        return data, None
+
+
+class GameMixin(CommandMixin):
+    """Helpers shared by the sync and async consumers."""
+
+    def bool_to_colour_str(self, b):
+        return "white" if b else "black"
+
+    def select_subprotocol(self):
+        """Pick the wire format among the subprotocols offered by the client."""
+        subprotocols = self.scope.get("subprotocols", [])
+        self.msgpack = (
+            settings.GAME_MSGPACK_FRAMES and wire.MSGPACK_SUBPROTOCOL in subprotocols
+        )
+        if self.msgpack:
+            return wire.MSGPACK_SUBPROTOCOL
+        if wire.JSON_SUBPROTOCOL in subprotocols:
+            return wire.JSON_SUBPROTOCOL
+        return None
+
+    def start_frame(self):
+        base_ms, increment_ms = settings.GAME_TIME_CONTROLS[self.control]
+        if self.msgpack:
+            return {
+                "bytes_data": wire.pack(
+                    wire.START,
+                    self.client_uuid,
+                    self.client_colour,
+                    self.opponent_uuid,
+                    self.game_uuid,
+                    self.token,
+                    base_ms,
+                    increment_ms,
+                )
+            }
+
+        text_data = {
+            "command": "start",
+            "client": self.client_uuid,
+            "colour": self.bool_to_colour_str(self.client_colour),
+            "opponent": self.opponent_uuid,
+            "game": self.game_uuid,
+            "token": self.token,
+            "time": base_ms,
+            "increment": increment_ms,
+        }
+        return {"text_data": json.dumps(text_data)}
+
+    def moved_frame(self, event):
+        if self.msgpack:
+            return {
+                "bytes_data": wire.pack(
+                    wire.MOVED,
+                    event["move"],
+                    event["colour"],
+                    event["white_time"],
+                    event["black_time"],
+                )
+            }
+
+        text_data = {
+            "command": "moved",
+            "san": event["san"],
+            "colour": self.bool_to_colour_str(event["colour"]),
+            "white_time": event["white_time"],
+            "black_time": event["black_time"],
+        }
+        return {"text_data": json.dumps(text_data)}
+
+    def win_frame(self, event):
+        if self.msgpack:
+            return {
+                "bytes_data": wire.pack(wire.WIN, event["winner_colour"], event["by"])
+            }
+
+        text_data = {
+            "command": "win",
+            "winner_colour": self.bool_to_colour_str(event["winner_colour"]),
+            "by": event["by"],
+        }
+        return {"text_data": json.dumps(text_data)}
+
+    def draw_frame(self):
+        if self.msgpack:
+            return {"bytes_data": wire.pack(wire.DRAW)}
+        return {"text_data": json.dumps({"command": "draw"})}
+
+    def premove_dropped_frame(self):
+        if self.msgpack:
+            return {"bytes_data": wire.pack(wire.PREMOVE_DROPPED)}
+        return {"text_data": json.dumps({"command": "premove_dropped"})}
+
+    def resume_refused_frame(self):
+        if self.msgpack:
+            return {"bytes_data": wire.pack(wire.RESUME_REFUSED)}
+        return {"text_data": json.dumps({"command": "resume_refused"})}
+
+    def computer_offered_frame(self):
+        if self.msgpack:
+            return {"bytes_data": wire.pack(wire.COMPUTER_OFFERED)}
+        return {"text_data": json.dumps({"command": "computer_offered"})}
+
+    def resume_frame(self, event):
+        if self.msgpack:
+            return {
+                "bytes_data": wire.pack(
+                    wire.RESUME,
+                    event["game_uuid"],
+                    event["client_uuid"],
+                    event["token"],
+                    event["colour"],
+                    event["opponent_uuid"],
+                    event["fen"],
+                    event["moves"],
+                    event["white_time"],
+                    event["black_time"],
+                    event["running"],
+                    event["time"],
+                    event["increment"],
+                )
+            }
+
+        text_data = {
+            "command": "resume",
+            "game": event["game_uuid"],
+            "client": event["client_uuid"],
+            "token": event["token"],
+            "colour": self.bool_to_colour_str(event["colour"]),
+            "opponent": event["opponent_uuid"],
+            "fen": event["fen"],
+            "moves": event["sans"],
+            "white_time": event["white_time"],
+            "black_time": event["black_time"],
+            "running": event["running"],
+            "time": event["time"],
+            "increment": event["increment"],
+        }
+        return {"text_data": json.dumps(text_data)}
+
+    async def open_game(self, game):
+        """Hand the new game to its owner and remember where it lives."""
+        self.owner = await shards.owner_channel(game.uuid)
+        await shards.send(self.owner, {"type": "create_game", "state": game.to_state()})
+
+    async def send_to_owner(self, event):
+        """Send event about the current game to the owner of the game."""
+        if self.game_uuid:
+            await shards.send(self.owner, {"game_uuid": self.game_uuid, **event})
+
+    def load_player(self):
+        """Return the user id and current rating of the client.
+
+        Anonymous clients are matched at the default rating.
+        """
+        user = self.scope.get("user")
+        if not user or not user.is_authenticated:
+            return None, DEFAULT_RATING
+
+        user.refresh_from_db(fields=["rating"])
+        return user.pk, user.rating
+
+    def search_radius(self):
+        """Return how many rating buckets away an opponent may be by now."""
+        waited = time.monotonic() - self.queued_at
+        return min(
+            int(waited // settings.GAME_MATCH_WIDEN_EVERY),
+            settings.GAME_MATCH_MAX_RADIUS,
+        )
+
+    def computer_due(self):
+        """Return whether to offer this waiting client the computer now."""
+        after = settings.GAME_COMPUTER_OFFER_AFTER
+        if after is None or self.computer_offered:
+            return False
+        self.computer_offered = time.monotonic() - self.queued_at >= after
+        return self.computer_offered
+
+    def computer_game(self, level):
+        """Return a new game against the computer at level, seated as white.
+
+        Like a player found in the queue the computer plays black.
+        """
+        self.game_uuid = uuid.uuid4().hex
+        self.client_colour = True
+        self.opponent_uuid = COMPUTER_UUID
+        self.opponent_colour = False
+        game = Game(
+            self.game_uuid,
+            self.client_uuid,
+            COMPUTER_UUID,
+            self.user_id,
+            None,
+            self.control,
+        )
+        game.computer = (False, *settings.GAME_COMPUTER_LEVELS[level])
+        self.token = game.white_token
+        return game
+
+    def waited(self):
+        """Record how long this client waited in the queue for an opponent."""
+        metrics.QUEUE_WAIT_SECONDS.observe(time.monotonic() - self.queued_at)
+
+    async def leave_game(self):
+        """Leave the game on disconnect, the owner keeps the seat a while."""
+        await self.channel_layer.group_discard(
+            f"game_{self.game_uuid}", self.channel_name
+        )
+        await self.send_to_owner(
+            {
+                "type": "player_left",
+                "colour": self.client_colour,
+                "channel": self.channel_name,
+            }
+        )
+
+    async def request_resume(self, game_uuid, token):
+        """Ask the owner of game_uuid to give this socket its seat back.
+
+        A game handed off by a draining process is claimed by the first of
+        its players to resume and owned where that player is. The owner
+        answers resumed, or resume_refused to a token of none of its seats.
+        """
+        if self.in_waiting_queue or self.game_uuid:
+            await self.channel_layer.send(self.channel_name, {"type": "resume_refused"})
+            return
+
+        event = {
+            "type": "resume",
+            "game_uuid": game_uuid,
+            "token": token,
+            "channel": self.channel_name,
+        }
+        owner = await shards.owner_channel(game_uuid)
+        claimed = await handoff.claim(game_uuid, token, owner)
+        if not claimed:
+            await self.channel_layer.group_send(f"owner_{game_uuid}", event)
+        elif claimed[0] == "state":
+            await shards.send(
+                owner, {**event, "type": "take_over", "state": claimed[1]}
+            )
+        else:
+            await shards.send(claimed[1], event)
+
+    async def pick_up_game(self):
+        """Resume the game just handed off by its draining owner, from here."""
+        game_uuid, self.game_uuid = self.game_uuid, ""
+        await self.channel_layer.group_discard(f"game_{game_uuid}", self.channel_name)
+        await self.request_resume(game_uuid, self.token)
+
+    async def analyse_position(self, data):
+        """Return the analysed event answering an analyse command.
+
+        None means the position was queued and the event is sent to this
+        socket once analysed. Players can't analyse during their game.
+        """
+        if self.game_uuid:
+            return error_event(data.get("fen"), "playing")
+
+        return await AnalysisService().analyse(
+            user_key(self.scope, self.channel_name),
+            data.get("fen"),
+            data.get("depth"),
+            self.channel_name,
+        )
+
+    async def take_seat(self, event):
+        """Become the player described by a resumed snapshot."""
+        await self.channel_layer.group_discard(
+            f"client_{self.client_uuid}", self.channel_name
+        )
+        self.client_uuid = event["client_uuid"]
+        self.game_uuid = event["game_uuid"]
+        self.token = event["token"]
+        self.client_colour = event["colour"]
+        self.opponent_uuid = event["opponent_uuid"]
+        self.opponent_colour = not event["colour"]
+        self.control = event["control"]
+        self.owner = event["owner"]
+
+        await self.channel_layer.group_add(
+            f"client_{self.client_uuid}", self.channel_name
+        )
+        await self.channel_layer.group_add(
+            f"game_{self.game_uuid}", self.channel_name
+        )
 
 
-class GameConsumer(WebsocketConsumer):
+class GameConsumer(GameMixin, WebsocketConsumer):
     def connect(self):
         self.client_uuid = uuid.uuid4().hex
         self.in_waiting_queue = False
@@ -17,235 +385,564 @@ class GameConsumer(WebsocketConsumer):
         async_to_sync(self.channel_layer.group_add)(
             f"client_{self.client_uuid}", self.channel_name
         )
-        self.accept()
+        handoff.sockets.add(self.channel_name)
+        self.limiter = self.frame_limiter()
+        self.accept(self.select_subprotocol())
 
     def disconnect(self, close_code):
+        handoff.sockets.discard(self.channel_name)
         async_to_sync(self.channel_layer.group_discard)(
             f"client_{self.client_uuid}", self.channel_name
         )
 
         if self.in_waiting_queue:
-            wq = WaitingQueue()
-            wq.remove(self.client_uuid)
+            async_to_sync(SearchScheduler().cancel)(self.channel_name)
+            wq = WaitingQueue(self.control)
+            async_to_sync(wq.remove)(self.client_uuid)
 
         elif self.game_uuid:
-            async_to_sync(self.channel_layer.group_discard)(
-                f"game_{self.game_uuid}", self.channel_name
-            )
-            async_to_sync(self.channel_layer.group_send)(
-                f"game_{self.game_uuid}",
-                {
-                    "type": "inform_win",
-                    "winner_colour": self.opponent_colour,
-                    "by": "abandonment",
-                },
-            )
-
-    def receive(self, text_data):
-        text_data_json = json.loads(text_data)
+            async_to_sync(self.leave_game)()
+
+    @metrics.timed(metrics.RECEIVE_SECONDS, "sync")
+    def receive(self, text_data=None, bytes_data=None):
+        data, close_code = self.admit(text_data, bytes_data)
+        if close_code:
+            self.close(code=close_code)
+        if data is None:
+            return
 
-        if text_data_json["command"] == "find_opponent":
-            self.find_opponent_and_start()
-        elif text_data_json["command"] == "move":
-            self.move_if_legal(text_data_json["san"])
-        elif text_data_json["command"] == "end_if_timeout":
+        if data["command"] == "find_opponent":
+            self.find_opponent_and_start(data.get("control"))
+        elif data["command"] == "move":
+            self.move_if_legal(data.get("san"), data.get("move"))
+        elif data["command"] == "end_if_timeout":
             self.end_if_timeout()
-
-    def find_opponent_and_start(self):
+        elif data["command"] == "cancel_premove":
+            self.cancel_premove()
+        elif data["command"] == "play_computer":
+            self.play_computer(data.get("level"))
+        elif data["command"] == "resume":
+            async_to_sync(self.request_resume)(data["game"], data["token"])
+        elif data["command"] == "analyse":
+            event = async_to_sync(self.analyse_position)(data)
+            if event:
+                self.analysed(event)
+
+    def find_opponent_and_start(self, control=None):
         if self.in_waiting_queue or self.game_uuid:
             return
 
-        wq = WaitingQueue()
-        opponent_uuid = wq.pop()
-        if opponent_uuid:
-            self.game_uuid = uuid.uuid4().hex
-            self.client_colour = False
-            self.opponent_uuid = opponent_uuid
-            self.opponent_colour = True
-            self.board = chess.Board()
-            self.white_last_move_datetime = None
-            self.black_last_move_datetime = None
-            self.white_timer = timedelta()
-            self.black_timer = timedelta()
-
-            async_to_sync(self.channel_layer.group_add)(
-                f"game_{self.game_uuid}", self.channel_name
-            )
-            async_to_sync(self.channel_layer.group_send)(
-                f"client_{opponent_uuid}",
-                {
-                    "type": "start",
-                    "game_uuid": self.game_uuid,
-                    "client_uuid": self.client_uuid,
-                },
-            )
-            self.inform_start()
+        control = control or settings.GAME_DEFAULT_TIME_CONTROL
+        if control not in settings.GAME_TIME_CONTROLS:
+            return
+        self.control = control
+
+        self.user_id, self.rating = self.load_player()
+        self.queued_at = time.monotonic()
+        self.computer_offered = False
+        self.search_opponent()
+
+    def widen_search(self, event):
+        if self.in_waiting_queue:
+            self.search_opponent()
+
+    def search_opponent(self):
+        wq = WaitingQueue(self.control)
+        opponent = async_to_sync(wq.match)(
+            self.client_uuid,
+            self.rating,
+            self.search_radius(),
+            self.user_id,
+            self.in_waiting_queue,
+        )
+        if opponent:
+            self.waited()
+            self.in_waiting_queue = False
+            self.start_game(*opponent)
         else:
-            wq.push(self.client_uuid)
             self.in_waiting_queue = True
+            async_to_sync(SearchScheduler().arm)(self.channel_name)
+            if self.computer_due():
+                self.send(**self.computer_offered_frame())
+
+    def play_computer(self, level=None):
+        level = level or settings.GAME_COMPUTER_DEFAULT_LEVEL
+        if not self.in_waiting_queue or not self.computer_offered:
+            return
+        if level not in settings.GAME_COMPUTER_LEVELS:
+            return
+        if not async_to_sync(WaitingQueue(self.control).remove)(self.client_uuid):
+            return  # just matched, the start event is on its way
+
+        async_to_sync(SearchScheduler().cancel)(self.channel_name)
+        self.waited()
+        self.in_waiting_queue = False
+        game = self.computer_game(level)
+        async_to_sync(self.open_game)(game)
+
+        async_to_sync(self.channel_layer.group_add)(
+            f"game_{self.game_uuid}", self.channel_name
+        )
+        self.inform_start()
+
+    def start_game(self, opponent_uuid, opponent_user_id):
+        self.game_uuid = uuid.uuid4().hex
+        self.client_colour = False
+        self.opponent_uuid = opponent_uuid
+        self.opponent_colour = True
+        game = Game(
+            self.game_uuid,
+            opponent_uuid,
+            self.client_uuid,
+            opponent_user_id,
+            self.user_id,
+            self.control,
+        )
+        self.token = game.black_token
+        async_to_sync(self.open_game)(game)
+
+        async_to_sync(self.channel_layer.group_add)(
+            f"game_{self.game_uuid}", self.channel_name
+        )
+        async_to_sync(self.channel_layer.group_send)(
+            f"client_{opponent_uuid}",
+            {
+                "type": "start",
+                "game_uuid": self.game_uuid,
+                "client_uuid": self.client_uuid,
+                "token": game.white_token,
+                "owner": self.owner,
+            },
+        )
+        self.inform_start()
 
     def inform_start(self):
-        text_data = {
-            "command": "start",
-            "client": self.client_uuid,
-            "colour": self.bool_to_colour_str(self.client_colour),
-            "opponent": self.opponent_uuid,
-        }
-        self.send(text_data=json.dumps(text_data))
+        self.send(**self.start_frame())
 
     def start(self, event):
+        async_to_sync(SearchScheduler().cancel)(self.channel_name)
+        self.waited()
         self.in_waiting_queue = False
         self.game_uuid = event["game_uuid"]
         self.client_colour = True
         self.opponent_uuid = event["client_uuid"]
         self.opponent_colour = False
-        self.board = chess.Board()
-        self.white_last_move_datetime = None
-        self.black_last_move_datetime = None
-        self.white_timer = timedelta()
-        self.black_timer = timedelta()
+        self.token = event["token"]
+        self.owner = event["owner"]
 
         async_to_sync(self.channel_layer.group_add)(
             f"game_{self.game_uuid}", self.channel_name
         )
         self.inform_start()
 
-    def move_if_legal(self, san):
-        if self.board.turn != self.client_colour:
+    @metrics.timed(metrics.MOVE_SECONDS, "sync")
+    def move_if_legal(self, san, code=None):
+        async_to_sync(self.send_to_owner)(
+            {
+                "type": "play_move",
+                "colour": self.client_colour,
+                "san": san,
+                "code": code,
+                # told if the move is a premove that turns out illegal
+                "channel": self.channel_name,
+            }
+        )
+
+    def end_if_timeout(self):
+        async_to_sync(self.send_to_owner)({"type": "check_timeout"})
+
+    def cancel_premove(self):
+        async_to_sync(self.send_to_owner)(
+            {"type": "cancel_premove", "colour": self.client_colour}
+        )
+
+    def moved(self, event):
+        self.send(**self.moved_frame(event))
+
+    def premove_dropped(self, event):
+        self.send(**self.premove_dropped_frame())
+
+    def inform_win(self, event):
+        self.game_uuid = ""
+        self.send(**self.win_frame(event))
+
+    def inform_draw(self, event):
+        self.game_uuid = ""
+        self.send(**self.draw_frame())
+
+    def resumed(self, event):
+        async_to_sync(self.take_seat)(event)
+        self.send(**self.resume_frame(event))
+
+    def resume_refused(self, event):
+        self.send(**self.resume_refused_frame())
+
+    def handed_off(self, event):
+        # this process's own sockets are closed by drain
+        if not handoff.draining():
+            async_to_sync(self.pick_up_game)()
+
+    def drain(self, event):
+        self.close(code=handoff.SERVICE_RESTART)
+
+    def analysed(self, event):
+        self.send(**analysis_frame(event, self.msgpack))
+
+
+class AsyncGameConsumer(GameMixin, AsyncWebsocketConsumer):
+    """Native async version of GameConsumer speaking the same protocol.
+
+    Channel layer calls are awaited directly on the event loop instead of
+    being handed to a worker thread through async_to_sync.
+    """
+
+    async def connect(self):
+        self.client_uuid = uuid.uuid4().hex
+        self.in_waiting_queue = False
+        self.game_uuid = ""
+
+        await self.channel_layer.group_add(
+            f"client_{self.client_uuid}", self.channel_name
+        )
+        handoff.sockets.add(self.channel_name)
+        self.limiter = self.frame_limiter()
+        await self.accept(self.select_subprotocol())
+
+    async def disconnect(self, close_code):
+        handoff.sockets.discard(self.channel_name)
+        await self.channel_layer.group_discard(
+            f"client_{self.client_uuid}", self.channel_name
+        )
+
+        if self.in_waiting_queue:
+            await SearchScheduler().cancel(self.channel_name)
+            wq = WaitingQueue(self.control)
+            await wq.remove(self.client_uuid)
+
+        elif self.game_uuid:
+            await self.leave_game()
+
+    @metrics.timed(metrics.RECEIVE_SECONDS, "async")
+    async def receive(self, text_data=None, bytes_data=None):
+        data, close_code = self.admit(text_data, bytes_data)
+        if close_code:
+            await self.close(code=close_code)
+        if data is None:
             return
 
-        try:
-            move = self.board.parse_san(san)
-        except ValueError:
+        if data["command"] == "find_opponent":
+            await self.find_opponent_and_start(data.get("control"))
+        elif data["command"] == "move":
+            await self.move_if_legal(data.get("san"), data.get("move"))
+        elif data["command"] == "end_if_timeout":
+            await self.end_if_timeout()
+        elif data["command"] == "cancel_premove":
+            await self.cancel_premove()
+        elif data["command"] == "play_computer":
+            await self.play_computer(data.get("level"))
+        elif data["command"] == "resume":
+            await self.request_resume(data["game"], data["token"])
+        elif data["command"] == "analyse":
+            event = await self.analyse_position(data)
+            if event:
+                await self.analysed(event)
+
+    async def find_opponent_and_start(self, control=None):
+        if self.in_waiting_queue or self.game_uuid:
             return
 
-        if not move:  # null move
+        control = control or settings.GAME_DEFAULT_TIME_CONTROL
+        if control not in settings.GAME_TIME_CONTROLS:
             return
+        self.control = control
 
-        self.board.push(move)
-        async_to_sync(self.channel_layer.group_send)(
-            f"game_{self.game_uuid}",
+        self.user_id, self.rating = await database_sync_to_async(self.load_player)()
+        self.queued_at = time.monotonic()
+        self.computer_offered = False
+        await self.search_opponent()
+
+    async def widen_search(self, event):
+        if self.in_waiting_queue:
+            await self.search_opponent()
+
+    async def search_opponent(self):
+        wq = WaitingQueue(self.control)
+        opponent = await wq.match(
+            self.client_uuid,
+            self.rating,
+            self.search_radius(),
+            self.user_id,
+            self.in_waiting_queue,
+        )
+        if opponent:
+            self.waited()
+            self.in_waiting_queue = False
+            await self.start_game(*opponent)
+        else:
+            self.in_waiting_queue = True
+            await SearchScheduler().arm(self.channel_name)
+            if self.computer_due():
+                await self.send(**self.computer_offered_frame())
+
+    async def play_computer(self, level=None):
+        level = level or settings.GAME_COMPUTER_DEFAULT_LEVEL
+        if not self.in_waiting_queue or not self.computer_offered:
+            return
+        if level not in settings.GAME_COMPUTER_LEVELS:
+            return
+        if not await WaitingQueue(self.control).remove(self.client_uuid):
+            return  # just matched, the start event is on its way
+
+        await SearchScheduler().cancel(self.channel_name)
+        self.waited()
+        self.in_waiting_queue = False
+        game = self.computer_game(level)
+        await self.open_game(game)
+
+        await self.channel_layer.group_add(
+            f"game_{self.game_uuid}", self.channel_name
+        )
+        await self.inform_start()
+
+    async def start_game(self, opponent_uuid, opponent_user_id):
+        self.game_uuid = uuid.uuid4().hex
+        self.client_colour = False
+        self.opponent_uuid = opponent_uuid
+        self.opponent_colour = True
+        game = Game(
+            self.game_uuid,
+            opponent_uuid,
+            self.client_uuid,
+            opponent_user_id,
+            self.user_id,
+            self.control,
+        )
+        self.token = game.black_token
+        await self.open_game(game)
+
+        await self.channel_layer.group_add(
+            f"game_{self.game_uuid}", self.channel_name
+        )
+        await self.channel_layer.group_send(
+            f"client_{opponent_uuid}",
             {
-                "type": "moved",
-                "san": san,
-                "colour": self.client_colour,
-                "time": timezone.now().isoformat(),
+                "type": "start",
+                "game_uuid": self.game_uuid,
+                "client_uuid": self.client_uuid,
+                "token": game.white_token,
+                "owner": self.owner,
             },
         )
+        await self.inform_start()
 
-    def moved(self, event):
-        if event["colour"]:
-            self.update_white_timer(dateparse.parse_datetime(event["time"]))
-            deadline = self.get_black_deadline().isoformat()
-        else:
-            self.update_black_timer(dateparse.parse_datetime(event["time"]))
-            deadline = self.get_white_deadline().isoformat()
+    async def inform_start(self):
+        await self.send(**self.start_frame())
 
-        text_data = {
-            "command": "moved",
-            "san": event["san"],
-            "colour": self.bool_to_colour_str(event["colour"]),
-            "deadline": deadline,
-        }
-        self.send(text_data=json.dumps(text_data))
+    async def start(self, event):
+        await SearchScheduler().cancel(self.channel_name)
+        self.waited()
+        self.in_waiting_queue = False
+        self.game_uuid = event["game_uuid"]
+        self.client_colour = True
+        self.opponent_uuid = event["client_uuid"]
+        self.opponent_colour = False
+        self.token = event["token"]
+        self.owner = event["owner"]
 
-        if event["colour"] == self.client_colour:
-            self.end_if_gameover()
-        else:
-            self.board.push_san(event["san"])
-
-    def end_if_gameover(self):
-        if self.board.is_checkmate():
-            async_to_sync(self.channel_layer.group_send)(
-                f"game_{self.game_uuid}",
-                {
-                    "type": "inform_win",
-                    "winner_colour": self.client_colour,
-                    "by": "checkmate",
-                },
-            )
-        elif (
-            self.board.is_stalemate()
-            or self.board.is_insufficient_material()
-            or self.board.is_fifty_moves()
-            or self.board.is_repetition()
-        ):
-            async_to_sync(self.channel_layer.group_send)(
-                f"game_{self.game_uuid}",
-                {
-                    "type": "inform_draw",
-                },
-            )
+        await self.channel_layer.group_add(
+            f"game_{self.game_uuid}", self.channel_name
+        )
+        await self.inform_start()
 
-    def inform_win(self, event):
+    @metrics.timed(metrics.MOVE_SECONDS, "async")
+    async def move_if_legal(self, san, code=None):
+        await self.send_to_owner(
+            {
+                "type": "play_move",
+                "colour": self.client_colour,
+                "san": san,
+                "code": code,
+                # told if the move is a premove that turns out illegal
+                "channel": self.channel_name,
+            }
+        )
+
+    async def end_if_timeout(self):
+        await self.send_to_owner({"type": "check_timeout"})
+
+    async def cancel_premove(self):
+        await self.send_to_owner(
+            {"type": "cancel_premove", "colour": self.client_colour}
+        )
+
+    async def moved(self, event):
+        await self.send(**self.moved_frame(event))
+
+    async def premove_dropped(self, event):
+        await self.send(**self.premove_dropped_frame())
+
+    async def inform_win(self, event):
         self.game_uuid = ""
-        self.black_last_move_datetime = None
-        text_data = {
-            "command": "win",
-            "winner_colour": self.bool_to_colour_str(event["winner_colour"]),
-            "by": event["by"],
-        }
-        self.send(text_data=json.dumps(text_data))
+        await self.send(**self.win_frame(event))
 
-    def inform_draw(self, event):
+    async def inform_draw(self, event):
         self.game_uuid = ""
-        self.black_last_move_datetime = None
-        self.send(text_data=json.dumps({"command": "draw"}))
+        await self.send(**self.draw_frame())
 
-    def end_if_timeout(self):
-        if self.is_white_timeup():
-            async_to_sync(self.channel_layer.group_send)(
-                f"game_{self.game_uuid}",
-                {
-                    "type": "inform_win",
-                    "winner_colour": False,
-                    "by": "timeout",
-                },
-            )
+    async def resumed(self, event):
+        await self.take_seat(event)
+        await self.send(**self.resume_frame(event))
 
-        elif self.is_black_timeup():
-            async_to_sync(self.channel_layer.group_send)(
-                f"game_{self.game_uuid}",
-                {
-                    "type": "inform_win",
-                    "winner_colour": True,
-                    "by": "timeout",
-                },
-            )
+    async def resume_refused(self, event):
+        await self.send(**self.resume_refused_frame())
 
-    def bool_to_colour_str(self, b):
-        return "white" if b else "black"
+    async def handed_off(self, event):
+        # this process's own sockets are closed by drain
+        if not handoff.draining():
+            await self.pick_up_game()
 
-    def update_white_timer(self, time):
-        self.white_last_move_datetime = time
-        if self.black_last_move_datetime:
-            diff = time - self.black_last_move_datetime
-            self.white_timer += diff
+    async def drain(self, event):
+        await self.close(code=handoff.SERVICE_RESTART)
 
-    def update_black_timer(self, time):
-        self.black_last_move_datetime = time
-        diff = time - self.white_last_move_datetime
-        self.black_timer += diff
+    async def analysed(self, event):
+        await self.send(**analysis_frame(event, self.msgpack))
 
-    def get_white_deadline(self):
-        """Return datetime of when white runs out of time, assuming black has played."""
-        return self.black_last_move_datetime + timedelta(minutes=10) - self.white_timer
 
-    def get_black_deadline(self):
-        """Return datetime of when black runs out of time, assuming white has played."""
-        return self.white_last_move_datetime + timedelta(minutes=10) - self.black_timer
+class SpectatorConsumer(CommandMixin, AsyncWebsocketConsumer):
+    """Read-only socket streaming a game to a spectator.
 
-    def is_white_timeup(self):
-        if not self.board.turn:
-            return False
+    On join the owner of the game answers with a snapshot of it, then
+    only the moves follow, relayed by SpectatorHub as frames the owner has
+    already encoded. Moves relayed before the snapshot arrives are held
+    back and those it already contains are skipped. A game nobody answers
+    for within GAME_WATCH_TIMEOUT seconds, unknown or over, is gone: the
+    spectator is told so and closed. Spectators may send analyse commands
+    for the positions they watch, admitted like a player's.
+    """
 
-        if not self.black_last_move_datetime:
-            return False
+    async def connect(self):
+        self.game_uuid = self.scope["url_route"]["kwargs"]["game_uuid"]
+        self.ply = None  # ply of the snapshot, None until it arrives
+        self.gone_timer = None
+        self.held = []
+        self.limiter = self.frame_limiter()
 
-        return timezone.now() >= self.get_white_deadline()
+        subprotocols = self.scope.get("subprotocols", [])
+        self.msgpack = (
+            settings.GAME_MSGPACK_FRAMES and wire.MSGPACK_SUBPROTOCOL in subprotocols
+        )
+        await self.accept(wire.MSGPACK_SUBPROTOCOL if self.msgpack else None)
 
-    def is_black_timeup(self):
-        if self.board.turn:
-            return False
+        await SpectatorHub().join(self)
+        await self.channel_layer.group_send(
+            f"owner_{self.game_uuid}",
+            {
+                "type": "watch",
+                "game_uuid": self.game_uuid,
+                "channel": self.channel_name,
+            },
+        )
+        # the owner of a game that's over left its group, nobody answers
+        self.gone_timer = asyncio.get_running_loop().call_later(
+            settings.GAME_WATCH_TIMEOUT, self.time_out
+        )
+
+    def time_out(self):
+        asyncio.ensure_future(
+            self.channel_layer.send(self.channel_name, {"type": "gone"})
+        )
+
+    async def disconnect(self, close_code):
+        if self.gone_timer:
+            self.gone_timer.cancel()
+        await SpectatorHub().leave(self)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data, close_code = self.admit(text_data, bytes_data)
+        if close_code:
+            await self.close(code=close_code)
+        if data is None:
+            return
+
+        if data["command"] == "analyse":
+            event = await AnalysisService().analyse(
+                user_key(self.scope, self.channel_name),
+                data.get("fen"),
+                data.get("depth"),
+                self.channel_name,
+            )
+            if event:
+                await self.analysed(event)
+
+    async def analysed(self, event):
+        await self.send(**analysis_frame(event, self.msgpack))
 
-        return timezone.now() >= self.get_black_deadline()
+    async def snapshot(self, event):
+        if self.ply is not None:
+            return
+
+        self.ply = event["ply"]
+        self.gone_timer.cancel()
+        await self.send(**self.snapshot_frame(event))
+        for held in self.held:
+            await self.relay(held)
+        self.held = []
+
+    async def gone(self, event):
+        if self.ply is not None:
+            return
+
+        if self.msgpack:
+            await self.send(bytes_data=wire.pack(wire.GONE))
+        else:
+            await self.send(text_data=json.dumps({"command": "gone"}))
+        await self.close()
+
+    async def relay(self, event):
+        if self.ply is None:
+            self.held.append(event)
+            return
+        if event["ply"] is not None and event["ply"] <= self.ply:
+            return
+
+        if self.msgpack:
+            await self.send(bytes_data=event["bytes_data"])
+        else:
+            await self.send(text_data=event["text_data"])
+        if event["over"]:
+            await self.close()
+
+    def snapshot_frame(self, event):
+        if self.msgpack:
+            return {
+                "bytes_data": wire.pack(
+                    wire.WATCH,
+                    event["game_uuid"],
+                    event["white_uuid"],
+                    event["black_uuid"],
+                    event["fen"],
+                    event["moves"],
+                    event["ply"],
+                    event["white_time"],
+                    event["black_time"],
+                    event["running"],
+                    event["time"],
+                    event["increment"],
+                )
+            }
+
+        text_data = {
+            "command": "watch",
+            "game": event["game_uuid"],
+            "white": event["white_uuid"],
+            "black": event["black_uuid"],
+            "fen": event["fen"],
+            "moves": event["sans"],
+            "ply": event["ply"],
+            "white_time": event["white_time"],
+            "black_time": event["black_time"],
+            "running": event["running"],
+            "time": event["time"],
+            "increment": event["increment"],
+        }
+        return {"text_data": json.dumps(text_data)}
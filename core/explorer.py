@@ -0,0 +1,172 @@
+import mmap
+import os
+import struct
+import chess
+from django.conf import settings
+from . import models, wire
+from .positions import Positions, hasher
+
+# The index is a file of fixed size records sorted by position hash then
+# move, after a header holding the id of the last game indexed. A lookup is
+# a binary search on the memory-mapped file.
+MAGIC = b"CHESSEX1"
+HEADER = struct.Struct("<8sQQ")  # magic, last game id, record count
+# position hash, move code, white wins, draws, black wins
+RECORD = struct.Struct("<QHIII")
+KEY = struct.Struct("<Q")
+
+# the mapped index of this process with the file version it maps, reopened
+# when a build replaces the file
+mapped = {}
+
+
+def results(status, winner_colour):
+    """Return the (white wins, draws, black wins) a finished game adds."""
+    if status == "D":
+        return 0, 1, 0
+    return (1, 0, 0) if winner_colour else (0, 0, 1)
+
+
+def read_records(path):
+    """Yield the header and then every record of the index at path."""
+    if not os.path.exists(path):
+        yield 0
+        return
+
+    with open(path, "rb") as f:
+        magic, last_id, count = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an explorer index")
+        yield last_id
+        for _ in range(count):
+            yield RECORD.unpack(f.read(RECORD.size))
+
+
+def build(path=None, rebuild=False):
+    """Add the games finished since the last build to the index.
+
+    Only the first GAME_EXPLORER_PLIES plies of each game are counted and
+    abandoned games are left out. The new counts are merged with the
+    records on disk into a new file, which replaces the old one at once,
+    so readers never see half an index. Return how many games were added.
+    """
+    path = path or settings.GAME_EXPLORER_PATH
+    existing = read_records(path)
+    last_id = next(existing)
+    if rebuild:
+        existing, last_id = iter(()), 0
+
+    counts = {}
+    added = 0
+    games = (
+        models.Game.objects.filter(id__gt=last_id)
+        .order_by("id")
+        .values_list("id", "moves", "status", "winner_colour")
+    )
+    for game_id, moves, status, winner_colour in games.iterator():
+        last_id = game_id
+        if status == "A":
+            continue
+
+        added += 1
+        score = results(status, winner_colour)
+        board = chess.Board()
+        positions = Positions(board)
+        for uci in moves.split()[: settings.GAME_EXPLORER_PLIES]:
+            move = chess.Move.from_uci(uci)
+            key = (positions.hash, wire.encode_move(move))
+            total = counts.setdefault(key, [0, 0, 0])
+            for i in range(3):
+                total[i] += score[i]
+            positions.push(board, move)
+
+    merged = merge(existing, sorted(counts.items()))
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, last_id, 0))
+        count = 0
+        for record in merged:
+            f.write(RECORD.pack(*record))
+            count += 1
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, last_id, count))
+    os.replace(tmp, path)
+    return added
+
+
+def merge(records, new):
+    """Merge the sorted records on disk with sorted new ((hash, move), counts)."""
+    new = iter(new)
+    pending = next(new, None)
+    for record in records:
+        while pending and pending[0] < record[:2]:
+            yield (*pending[0], *pending[1])
+            pending = next(new, None)
+        if pending and pending[0] == record[:2]:
+            yield (*record[:2], *(a + b for a, b in zip(record[2:], pending[1])))
+            pending = next(new, None)
+        else:
+            yield record
+    while pending:
+        yield (*pending[0], *pending[1])
+        pending = next(new, None)
+
+
+class OpeningExplorer:
+    """Answers which moves were played from a position and how they scored."""
+
+    def index(self):
+        """Return the mapped index and its record count, None if not built."""
+        path = settings.GAME_EXPLORER_PATH
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        version = (path, stat.st_ino, stat.st_mtime_ns)
+        current = mapped.get("index")
+        if not current or current[0] != version:
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            # readers still holding the old mapping keep it alive
+            current = mapped["index"] = (version, data, HEADER.unpack_from(data)[2])
+        return current[1:]
+
+    def moves(self, board):
+        """Return the moves played from board, the most played first."""
+        index = self.index()
+        if not index:
+            return []
+        data, count = index
+
+        key = hasher(board)
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if KEY.unpack_from(data, HEADER.size + mid * RECORD.size)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        moves = []
+        for i in range(lo, count):
+            position, code, white, draws, black = RECORD.unpack_from(
+                data, HEADER.size + i * RECORD.size
+            )
+            if position != key:
+                break
+            move = wire.decode_move(code)
+            if not board.is_legal(move):
+                continue  # another position with the same hash
+            moves.append(
+                {
+                    "uci": move.uci(),
+                    "san": board.san(move),
+                    "white": white,
+                    "draws": draws,
+                    "black": black,
+                    "games": white + draws + black,
+                }
+            )
+        moves.sort(key=lambda move: move["games"], reverse=True)
+        return moves
@@ -0,0 +1,391 @@
+import secrets
+import time
+from array import array
+import chess
+from django.conf import settings
+from django.utils import timezone
+from . import metrics, wire
+from .positions import Positions
+
+# process-local registry of the games owned by this process
+games = {}
+
+
+def clock():
+    """Return monotonic milliseconds, immune to wall clock adjustments."""
+    return time.monotonic_ns() // 1_000_000
+
+
+class Game:
+    """Authoritative state of a single game shared by both players' sockets.
+
+    Only the owner of the game holds it, a shard worker or the process that
+    created it, every move is validated and applied here once and the
+    resulting events are broadcast to the players.
+
+    Owners hold many games at once, so a game is slotted and keeps its
+    moves packed as 16 bit codes. The board only holds the current
+    position, its move stack is cleared after every push, and it's only
+    allocated once the game is played on and released when it ends.
+    """
+
+    __slots__ = (
+        "uuid",
+        "white_uuid",
+        "black_uuid",
+        "white_user_id",
+        "black_user_id",
+        "white_token",
+        "black_token",
+        "white_channel",
+        "black_channel",
+        "absent",
+        "watched",
+        "computer",
+        "premove",
+        "moves",
+        "fen",
+        "_board",
+        "_positions",
+        "control",
+        "base_ms",
+        "increment_ms",
+        "white_ms",
+        "black_ms",
+        "turn_started",
+        "result",
+        "created",
+        "ended",
+    )
+
+    def __init__(
+        self,
+        uuid,
+        white_uuid,
+        black_uuid,
+        white_user_id=None,
+        black_user_id=None,
+        control=None,
+    ):
+        self.uuid = uuid
+        self.white_uuid = white_uuid
+        self.black_uuid = black_uuid
+        # signed in users playing, None for anonymous players
+        self.white_user_id = white_user_id
+        self.black_user_id = black_user_id
+        # secrets a player presents to take its seat back after a reconnect
+        self.white_token = secrets.token_hex(16)
+        self.black_token = secrets.token_hex(16)
+        # channels of the sockets that resumed the seats, None until one did
+        self.white_channel = None
+        self.black_channel = None
+        self.absent = None  # colour whose seat is held for a reconnect
+        self.watched = False  # whether spectators are streaming the moves
+        # (colour, depth, seconds) of the computer playing one side, the
+        # strength and time a move of its is searched with, None between players
+        self.computer = None
+        # move queued by the side not to move and the channel of its socket,
+        # played as soon as the opponent has moved
+        self.premove = None
+        self.moves = array("H")  # wire codes of the moves played
+        self.fen = chess.STARTING_FEN  # the final position once it's over
+        self._board = None
+        self._positions = None
+        self.control = control or settings.GAME_DEFAULT_TIME_CONTROL
+        self.base_ms, self.increment_ms = settings.GAME_TIME_CONTROLS[self.control]
+        # milliseconds left on each clock when its side's turn started
+        self.white_ms = self.base_ms
+        self.black_ms = self.base_ms
+        # clock() when the side to move's clock started, None while it isn't
+        # running, before white's first move
+        self.turn_started = None
+        self.result = None
+        self.created = timezone.now()
+        self.ended = None
+
+    def move(self, colour, san=None, code=None, premove=False):
+        """Play a SAN or wire-encoded move for colour.
+
+        A premove is played at once when the turn starts, its clock is
+        charged nothing. Return the moved event, or None if the move is
+        illegal.
+        """
+        if self.result or self.board.turn != colour:
+            return None
+
+        if code is not None:
+            try:
+                move = wire.decode_move(code)
+            except ValueError:
+                return None
+
+            if not self.board.is_legal(move):
+                return None
+            san = self.board.san(move)
+        else:
+            try:
+                move = self.board.parse_san(san)
+            except ValueError:
+                return None
+
+            if not move:  # null move
+                return None
+
+            code = wire.encode_move(move)
+
+        now = clock()
+        left = self.remaining(colour, self.turn_started if premove else now)
+        if self.turn_started is not None and left <= 0:
+            return None  # the flag fell, the clock scheduler ends the game
+        self.set_remaining(colour, left + self.increment_ms)
+        self.turn_started = now
+        self.push(move)
+
+        return {
+            "type": "moved",
+            "move": code,
+            "san": san,
+            "colour": colour,
+            "white_time": self.white_ms,
+            "black_time": self.black_ms,
+            "ply": len(self.moves),
+        }
+
+    @property
+    def board(self):
+        if self._board is None:
+            self.allocate()
+        return self._board
+
+    @property
+    def positions(self):
+        if self._board is None:
+            self.allocate()
+        return self._positions
+
+    def allocate(self):
+        self._board = chess.Board(self.fen)
+        self._positions = Positions(self._board)
+
+    def push(self, move):
+        self.positions.push(self.board, move)
+        # Positions counts the positions for repetitions, the stack isn't needed
+        self._board.clear_stack()
+        self.moves.append(wire.encode_move(move))
+
+    def queue_premove(self, colour, san=None, code=None, channel=None):
+        """Queue a move for colour to play once its opponent has moved.
+
+        It replaces any move queued before. It only has to move one of
+        colour's pieces now, its legality is checked when it's played.
+        Return whether it was queued.
+        """
+        if self.result or self.board.turn == colour:
+            return False
+
+        try:
+            if code is not None:
+                move = wire.decode_move(code)
+            else:
+                # SAN as if it were colour's turn in the current position
+                board = self.board.copy(stack=False)
+                board.turn = colour
+                board.ep_square = None
+                move = board.parse_san(san)
+        except ValueError:
+            return False
+
+        piece = self.board.piece_at(move.from_square)
+        if not move or not piece or piece.color != colour:
+            return False
+        self.premove = (move, channel)
+        return True
+
+    def play_premove(self):
+        """Play the move queued for the side to move, if any.
+
+        Return the moved event, or None if it's illegal after all and dropped.
+        """
+        move, _ = self.premove
+        self.premove = None
+        return self.move(self.board.turn, code=wire.encode_move(move), premove=True)
+
+    @metrics.timed(metrics.GAMEOVER_SECONDS)
+    def end_if_gameover(self):
+        """Return the inform_win/inform_draw event if the last move ended the game."""
+        if self.result:
+            return None
+
+        outcome = self.positions.outcome(self.board)
+        if outcome == "checkmate":
+            return self.finish(not self.board.turn, "checkmate")
+        elif outcome:
+            return self.finish()
+
+    def end_if_timeout(self):
+        """Return the inform_win event if the side to move has run out of time."""
+        if self.result:
+            return None
+
+        if self.turn_started is not None and self.remaining(self.board.turn) <= 0:
+            return self.finish(not self.board.turn, "timeout")
+
+    def finish(self, winner_colour=None, by=""):
+        """Record the result, stop the clock and return the event announcing it.
+
+        The board is released, only the final position is kept.
+        """
+        self.ended = timezone.now()
+        if self.turn_started is not None:
+            turn = self.board.turn
+            self.set_remaining(turn, max(self.remaining(turn), 0))
+            self.turn_started = None
+        if self._board is not None:
+            self.fen = self._board.fen()
+            self._board = self._positions = None
+        if winner_colour is None:
+            self.result = {"type": "inform_draw"}
+        else:
+            self.result = {
+                "type": "inform_win",
+                "winner_colour": winner_colour,
+                "by": by,
+            }
+        return self.result
+
+    def to_state(self):
+        """Return the game as plain data that can travel on the channel layer."""
+        return {
+            "uuid": self.uuid,
+            "white_uuid": self.white_uuid,
+            "black_uuid": self.black_uuid,
+            "white_user_id": self.white_user_id,
+            "black_user_id": self.black_user_id,
+            "white_token": self.white_token,
+            "black_token": self.black_token,
+            "absent": self.absent,
+            "watched": self.watched,
+            "computer": self.computer,
+            "moves": self.moves.tolist(),
+            "control": self.control,
+            # monotonic clocks don't travel between processes, the running
+            # clock restarts from what is left when the state is loaded
+            "white_time": self.remaining(True),
+            "black_time": self.remaining(False),
+            "running": self.turn_started is not None,
+            "created": wire.epoch_ms(self.created),
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """Rebuild a game from the output of to_state."""
+        game = cls(
+            state["uuid"],
+            state["white_uuid"],
+            state["black_uuid"],
+            state["white_user_id"],
+            state["black_user_id"],
+            state["control"],
+        )
+        game.white_token = state["white_token"]
+        game.black_token = state["black_token"]
+        game.absent = state["absent"]
+        game.watched = state["watched"]
+        if state.get("computer"):
+            game.computer = tuple(state["computer"])
+        for code in state["moves"]:
+            game.push(wire.decode_move(code))
+        game.white_ms = state["white_time"]
+        game.black_ms = state["black_time"]
+        if state["running"]:
+            game.turn_started = clock()
+        game.created = wire.from_epoch_ms(state["created"])
+        return game
+
+    def seat(self, token):
+        """Return the colour whose resume token is token, or None."""
+        if secrets.compare_digest(token, self.white_token):
+            return True
+        if secrets.compare_digest(token, self.black_token):
+            return False
+        return None
+
+    def seated(self, colour, channel):
+        """Return whether the socket on channel holds colour's seat.
+
+        Any socket of colour's does until one resumed the seat.
+        """
+        current = self.white_channel if colour else self.black_channel
+        return current is None or current == channel
+
+    def move_seat(self, colour, channel):
+        if colour:
+            self.white_channel = channel
+        else:
+            self.black_channel = channel
+
+    def view(self):
+        """Return the position, move list and clocks as a spectator sees them."""
+        board = chess.Board()
+        sans = []
+        for code in self.moves:
+            move = wire.decode_move(code)
+            sans.append(board.san(move))
+            board.push(move)
+
+        return {
+            "game_uuid": self.uuid,
+            "white_uuid": self.white_uuid,
+            "black_uuid": self.black_uuid,
+            "fen": self.board.fen(),
+            "moves": self.moves.tolist(),
+            "sans": sans,
+            "ply": len(self.moves),
+            "control": self.control,
+            "time": self.base_ms,
+            "increment": self.increment_ms,
+            "white_time": max(self.remaining(True), 0),
+            "black_time": max(self.remaining(False), 0),
+            "running": self.turn_started is not None,
+        }
+
+    def snapshot(self, colour):
+        """Return what a player reconnecting as colour needs to carry on."""
+        return {
+            **self.view(),
+            "client_uuid": self.white_uuid if colour else self.black_uuid,
+            "opponent_uuid": self.black_uuid if colour else self.white_uuid,
+            "colour": colour,
+        }
+
+    def remaining(self, colour, now=None):
+        """Return the milliseconds colour has left, negative once its flag fell."""
+        ms = self.white_ms if colour else self.black_ms
+        if self.turn_started is not None and self.board.turn == colour:
+            ms -= (clock() if now is None else now) - self.turn_started
+        return ms
+
+    def set_remaining(self, colour, ms):
+        if colour:
+            self.white_ms = ms
+        else:
+            self.black_ms = ms
+
+    def used(self, colour):
+        """Return the milliseconds colour has spent thinking."""
+        moves = (len(self.moves) + colour) // 2
+        return self.base_ms + moves * self.increment_ms - self.remaining(colour)
+
+
+class GameRegistry:
+    def add(self, game):
+        games[game.uuid] = game
+
+    def get(self, game_uuid):
+        return games.get(game_uuid)
+
+    def remove(self, game_uuid):
+        games.pop(game_uuid, None)
+
+
+metrics.Gauge("chess_active_games", "Games owned by this process.", lambda: len(games))
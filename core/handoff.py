@@ -0,0 +1,127 @@
+import asyncio
+import json
+import logging
+from channels.layers import get_channel_layer
+from django.conf import settings
+from . import redis_pool, shards
+from .games import GameRegistry, games
+from .scheduler import ClockScheduler, GraceScheduler
+
+logger = logging.getLogger(__name__)
+
+# close code telling a client to reconnect, to another process
+SERVICE_RESTART = 1012
+# commands a draining process refuses by closing the socket
+REFUSED = {"find_opponent", "play_computer", "resume"}
+
+# Claim the game handed off under KEYS[1] for the player holding token
+# ARGV[1], to be owned on channel ARGV[2]. The first claim takes the state
+# and leaves the new owner behind for the other player, later claims get
+# that owner. Returns {"state", state}, {"owner", channel} or nothing.
+CLAIM = """
+local owner = redis.call("HGET", KEYS[1], "owner")
+if owner then
+    return {"owner", owner}
+end
+local tokens = redis.call("HMGET", KEYS[1], "white_token", "black_token")
+if ARGV[1] ~= tokens[1] and ARGV[1] ~= tokens[2] then
+    return false
+end
+local state = redis.call("HGET", KEYS[1], "state")
+redis.call("HDEL", KEYS[1], "state")
+redis.call("HSET", KEYS[1], "owner", ARGV[2])
+return {"state", state}
+"""
+
+# set once this process drains: it takes no new games and hands its own off
+state = {}
+# channels of this process's game sockets, closed when it drains
+sockets = set()
+
+
+def handoff_key(game_uuid):
+    return f"game-handoff:{game_uuid}"
+
+
+def draining():
+    return state.get("draining", False)
+
+
+async def hand_off(game, owner):
+    """Move a game owned here to redis, for the process its players resume on.
+
+    The running clock stops at what's left, the time the game spends in
+    redis isn't charged to anybody. The players are sent handed_off.
+    """
+    GameRegistry().remove(game.uuid)
+    await ClockScheduler().cancel(game.uuid)
+    await GraceScheduler().cancel(game.uuid)
+
+    key = handoff_key(game.uuid)
+    redis = await redis_pool.connection(key)
+    transaction = redis.multi_exec()
+    transaction.delete(key)
+    transaction.hmset_dict(
+        key,
+        {
+            "state": json.dumps(game.to_state()),
+            "white_token": game.white_token,
+            "black_token": game.black_token,
+        },
+    )
+    transaction.expire(key, settings.GAME_HANDOFF_TTL)
+    await transaction.execute()
+
+    channel_layer = get_channel_layer()
+    await channel_layer.group_discard(f"owner_{game.uuid}", owner)
+    await channel_layer.group_send(f"game_{game.uuid}", {"type": "handed_off"})
+
+
+async def claim(game_uuid, token, owner):
+    """Claim a handed off game for the player holding token.
+
+    Return ("state", state) if it's now owner's to load, ("owner", channel)
+    if another player claimed it first, None if nothing was handed off.
+    """
+    key = handoff_key(game_uuid)
+    redis = await redis_pool.connection(key)
+    claimed = await redis.eval(CLAIM, [key], [token, owner])
+    if not claimed:
+        return None
+    kind, value = claimed
+    return (kind, json.loads(value)) if kind == "state" else (kind, value)
+
+
+async def drain():
+    """Stop taking games, hand off the games owned here and close the sockets.
+
+    Players of this process reconnect elsewhere and resume, players of
+    other processes pick their games up where they are. Games owned by
+    shard workers stay there, their players only reconnect.
+    """
+    if draining():
+        return
+    state["draining"] = True
+
+    owned = [] if settings.GAME_SHARDS else list(games.values())
+    for game in owned:
+        await hand_off(game, shards.local.get("channel"))
+
+    channel_layer = get_channel_layer()
+    open_sockets = list(sockets)
+    for channel in open_sockets:
+        await channel_layer.send(channel, {"type": "drain"})
+    logger.info(
+        "Drained, handed off %s games and closed %s sockets",
+        len(owned),
+        len(open_sockets),
+    )
+
+
+def on_signal(signum, frame):
+    """Drain on the event loop serving the sockets, if this process has one."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    loop.call_soon_threadsafe(lambda: asyncio.ensure_future(drain()))
@@ -0,0 +1,30 @@
+import bisect
+import hashlib
+
+
+def hash_key(key):
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Consistent hashing of keys onto nodes.
+
+    Every node is placed at REPLICAS points of the ring and a key belongs to
+    the first point after its hash, so adding or removing a node only moves
+    the keys of that node.
+    """
+
+    REPLICAS = 64
+
+    def __init__(self, nodes):
+        points = sorted(
+            (hash_key(f"{node}#{i}"), node)
+            for node in nodes
+            for i in range(self.REPLICAS)
+        )
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def get(self, key):
+        index = bisect.bisect(self.hashes, hash_key(key)) % len(self.hashes)
+        return self.nodes[index]
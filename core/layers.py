@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Push a group message onto the channels of one redis host, dropping the
+# expired messages first and skipping the channels over capacity. KEYS are
+# the channels, ARGV their messages, then their capacities, then the time
+# and the expiry. Returns how many channels were over capacity.
+GROUP_SEND = """
+local over_capacity = 0
+local current_time = ARGV[#ARGV - 1]
+local expiry = ARGV[#ARGV]
+for i = 1, #KEYS do
+    redis.call("ZREMRANGEBYSCORE", KEYS[i], 0, current_time - expiry)
+    if redis.call("ZCOUNT", KEYS[i], "-inf", "+inf") < tonumber(ARGV[i + #KEYS]) then
+        redis.call("ZADD", KEYS[i], current_time, ARGV[i])
+        redis.call("EXPIRE", KEYS[i], expiry)
+    else
+        over_capacity = over_capacity + 1
+    end
+end
+return over_capacity
+"""
+
+
+class HybridChannelLayer(RedisChannelLayer):
+    """A redis channel layer delivering in memory to the channels of its process.
+
+    The channels new_channel() makes belong to this process: every consumer's
+    channel and the channel of the games the process owns. Messages sent or
+    group sent to them from the process skip redis and msgpack altogether,
+    they go to an inbox the process's receiver reads alongside its redis
+    list. Groups still live in redis, so a group_send reads the members in
+    one round trip, delivers to the local ones in memory and pushes to the
+    others with one script per redis host. When both players of a game and
+    its owner share a process, a move never leaves it but for that read.
+
+    Messages in memory only reach receivers on the event loop that sent
+    them, from another loop they go through redis as before.
+
+    Written against channels_redis 3.3.1, the version requirements.txt pins:
+    send_remote relies on its private _map_channel_keys_to_connection and
+    group_send on _group_key, and GROUP_SEND mirrors its group send script.
+    Check them again before upgrading.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (channel, message) delivered in memory, for the loop receiving
+        self.inbox = None
+        self.inbox_loop = None
+        # the pop from this process's redis list, left running when a local
+        # message comes first so no redis message is lost to a cancellation
+        self.popping = None
+
+    def is_local(self, channel):
+        return "!" in channel and self.non_local_name(channel).endswith(
+            self.client_prefix + "!"
+        )
+
+    def local_inbox(self, channel):
+        """Return the inbox channel is delivered to, None to go through redis."""
+        if not self.is_local(channel):
+            return None
+        if self.inbox_loop is not asyncio.get_running_loop():
+            return None
+        return self.inbox
+
+    async def send(self, channel, message):
+        inbox = self.local_inbox(channel)
+        if inbox is None:
+            metrics.CHANNEL_MESSAGES.inc("redis")
+            return await super().send(channel, message)
+
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        if inbox.qsize() >= self.capacity:
+            raise ChannelFull()
+        metrics.CHANNEL_MESSAGES.inc("memory")
+        inbox.put_nowait((channel, dict(message)))
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), "Group name not valid"
+        key = self._group_key(group)
+        async with self.connection(self.consistent_hash(group)) as connection:
+            pipe = connection.pipeline()
+            pipe.zremrangebyscore(key, min=0, max=int(time.time()) - self.group_expiry)
+            pipe.zrange(key, 0, -1)
+            _, members = await pipe.execute()
+
+        remote = []
+        for channel in (member.decode("utf8") for member in members):
+            inbox = self.local_inbox(channel)
+            if inbox is None:
+                remote.append(channel)
+            elif inbox.qsize() < self.capacity:
+                metrics.CHANNEL_MESSAGES.inc("memory")
+                inbox.put_nowait((channel, dict(message)))
+            else:
+                logger.info("%s over capacity in group %s", channel, group)
+        if remote:
+            metrics.CHANNEL_MESSAGES.inc("redis", amount=len(remote))
+            await self.send_remote(group, remote, message)
+
+    async def send_remote(self, group, channels, message):
+        """Push message onto channels in redis, one script per redis host."""
+        (
+            connection_to_channel_keys,
+            channel_keys_to_message,
+            channel_keys_to_capacity,
+        ) = self._map_channel_keys_to_connection(channels, message)
+
+        for index, channel_keys in connection_to_channel_keys.items():
+            args = [channel_keys_to_message[key] for key in channel_keys]
+            args += [channel_keys_to_capacity[key] for key in channel_keys]
+            args += [time.time(), self.expiry]
+            async with self.connection(index) as connection:
+                over_capacity = await connection.eval(
+                    GROUP_SEND, keys=channel_keys, args=args
+                )
+            if over_capacity:
+                logger.info(
+                    "%s of %s channels over capacity in group %s",
+                    over_capacity,
+                    len(channels),
+                    group,
+                )
+
+    async def close_pools(self):
+        # the pop left running would otherwise outlive the pools it reads from
+        if self.popping is not None and self.inbox_loop is asyncio.get_running_loop():
+            self.popping.cancel()
+            await asyncio.gather(self.popping, return_exceptions=True)
+        self.popping = None
+        await super().close_pools()
+
+    async def receive_single(self, channel):
+        """Return the next (channel, message) for this process's channels.
+
+        Called by the receiver holding the receive lock, which buffers the
+        message for its channel. Local messages win over the pop from redis,
+        which keeps running for the next call.
+        """
+        if not channel.endswith(self.client_prefix + "!"):
+            return await super().receive_single(channel)
+
+        loop = asyncio.get_running_loop()
+        if self.inbox_loop is not loop:
+            self.inbox, self.inbox_loop, self.popping = asyncio.Queue(), loop, None
+        if not self.inbox.empty():
+            return self.inbox.get_nowait()
+        if self.popping is None:
+            self.popping = asyncio.ensure_future(super().receive_single(channel))
+
+        getting = asyncio.ensure_future(self.inbox.get())
+        try:
+            await asyncio.wait(
+                {self.popping, getting}, return_when=asyncio.FIRST_COMPLETED
+            )
+        except asyncio.CancelledError:
+            getting.cancel()
+            if self.receive_count <= 1:
+                # the last receiver is going, as the plain layer would
+                self.popping.cancel()
+                self.popping = None
+            raise
+
+        if getting.done():
+            return getting.result()
+        getting.cancel()
+        popped, self.popping = self.popping, None
+        return popped.result()
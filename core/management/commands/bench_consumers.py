@@ -0,0 +1,150 @@
+import asyncio
+import random
+import statistics
+import time
+
+import chess
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from core.consumers import AsyncGameConsumer, GameConsumer
+from core.waiting_queue import WaitingQueue
+
+CONSUMERS = {"sync": GameConsumer, "async": AsyncGameConsumer}
+TIMEOUT = 30
+
+
+class Command(BaseCommand):
+    help = (
+        "Play concurrent games against the sync and async game consumers "
+        "in-process and report throughput and move round-trip latency."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--consumer", choices=["sync", "async", "both"], default="both"
+        )
+        parser.add_argument(
+            "--games",
+            default="10,50,100",
+            help="Comma separated numbers of concurrent games.",
+        )
+        parser.add_argument(
+            "--plies", type=int, default=40, help="Plies played per game."
+        )
+        parser.add_argument(
+            "--max-p99",
+            type=float,
+            default=100.0,
+            help="p99 move latency (ms) a worker may reach and still count.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        names = (
+            ["sync", "async"] if options["consumer"] == "both" else [options["consumer"]]
+        )
+        levels = [int(n) for n in options["games"].split(",")]
+
+        self.stdout.write(
+            f"{'consumer':<8} {'games':>6} {'moves/s':>10} {'p50 ms':>8} {'p99 ms':>8}"
+        )
+        for name in names:
+            capacity = 0
+            for games in levels:
+                rng = random.Random(options["seed"])
+                # bots move as soon as their opponent did, faster than players may
+                with override_settings(GAME_FRAME_LIMITS={}):
+                    result = asyncio.run(
+                        run_games(CONSUMERS[name], games, options["plies"], rng)
+                    )
+                self.stdout.write(
+                    f"{name:<8} {games:>6} {result['moves_per_sec']:>10.1f} "
+                    f"{result['p50']:>8.2f} {result['p99']:>8.2f}"
+                )
+                if result["p99"] <= options["max_p99"]:
+                    capacity = games
+            self.stdout.write(
+                f"{name}: {capacity} concurrent games within "
+                f"p99 <= {options['max_p99']:g} ms"
+            )
+
+
+async def run_games(consumer_class, games, plies, rng):
+    """Pair 2 * games bots, then let every game play concurrently."""
+    await WaitingQueue().clear()
+    application = consumer_class.as_asgi()
+
+    pairs = []
+    for _ in range(games):
+        pairs.append(await pair_bots(application))
+
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(
+            play(bot, colour, plies, random.Random(rng.random()), latencies)
+            for pair in pairs
+            for bot, colour in pair
+        )
+    )
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "moves_per_sec": len(latencies) / elapsed,
+        "p50": statistics.median(latencies) * 1000,
+        "p99": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+async def pair_bots(application):
+    """Connect two bots and match them with each other."""
+    first = WebsocketCommunicator(application, "/ws/game/")
+    second = WebsocketCommunicator(application, "/ws/game/")
+    await first.connect()
+    await second.connect()
+
+    # let the first bot land in the waiting queue before the second pops it
+    await first.send_json_to({"command": "find_opponent"})
+    while not await WaitingQueue().count():
+        await asyncio.sleep(0.001)
+    await second.send_json_to({"command": "find_opponent"})
+
+    pair = []
+    for bot in (first, second):
+        data = await bot.receive_json_from(timeout=TIMEOUT)
+        pair.append((bot, data["colour"] == "white"))
+    return pair
+
+
+async def play(bot, colour, plies, rng, latencies):
+    """Play random legal moves until the game ends or reaches plies."""
+    board = chess.Board()
+    sent = None
+
+    async def move():
+        nonlocal sent
+        san = board.san(rng.choice(list(board.legal_moves)))
+        sent = time.perf_counter()
+        await bot.send_json_to({"command": "move", "san": san})
+
+    if colour:
+        await move()
+
+    while True:
+        data = await bot.receive_json_from(timeout=TIMEOUT)
+        if data["command"] != "moved":
+            break
+
+        board.push_san(data["san"])
+        if (data["colour"] == "white") == colour:
+            latencies.append(time.perf_counter() - sent)
+
+        if board.ply() >= plies:
+            break
+        if board.turn == colour and not board.is_game_over():
+            await move()
+
+    await bot.disconnect()
@@ -0,0 +1,96 @@
+import random
+import time
+
+import chess
+from django.core.management.base import BaseCommand
+
+from core.positions import Positions
+
+
+def board_outcome(board):
+    """Game over checks as done on the board before Positions existed."""
+    return (
+        board.is_checkmate()
+        or board.is_stalemate()
+        or board.is_insufficient_material()
+        or board.is_fifty_moves()
+        or board.is_repetition()
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the per-move cost (push plus game over detection) of the "
+        "board checks with the incremental Positions detector over long "
+        "random games."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--games", type=int, default=50)
+        parser.add_argument("--plies", type=int, default=400)
+        parser.add_argument(
+            "--bucket", type=int, default=50, help="Plies per reported row."
+        )
+        parser.add_argument(
+            "--quiet",
+            type=float,
+            default=0.9,
+            help="Chance of preferring a reversible move, which makes long "
+            "shuffling games like the ones repetition checks are slow on.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        games = [
+            self.random_game(rng, options["plies"], options["quiet"])
+            for _ in range(options["games"])
+        ]
+
+        buckets = options["bucket"]
+        rows = options["plies"] // buckets
+        board_times = [[] for _ in range(rows)]
+        positions_times = [[] for _ in range(rows)]
+
+        for moves in games:
+            board = chess.Board()
+            for ply, move in enumerate(moves):
+                started = time.perf_counter()
+                board.push(move)
+                board_outcome(board)
+                board_times[ply // buckets].append(time.perf_counter() - started)
+
+            board = chess.Board()
+            positions = Positions(board)
+            for ply, move in enumerate(moves):
+                started = time.perf_counter()
+                positions.push(board, move)
+                positions.outcome(board)
+                positions_times[ply // buckets].append(time.perf_counter() - started)
+
+        self.stdout.write(f"{'plies':>10} {'board us':>10} {'positions us':>13}")
+        for row in range(rows):
+            self.stdout.write(
+                f"{row * buckets:>4}-{(row + 1) * buckets - 1:<5} "
+                f"{mean_us(board_times[row]):>10.1f} "
+                f"{mean_us(positions_times[row]):>13.1f}"
+            )
+
+    def random_game(self, rng, plies, quiet):
+        """Return the moves of a random game at least plies long."""
+        while True:
+            board = chess.Board()
+            while board.ply() < plies:
+                moves = list(board.legal_moves)
+                if not moves:
+                    break
+                reversible = [m for m in moves if not board.is_irreversible(m)]
+                if reversible and rng.random() < quiet:
+                    moves = reversible
+                board.push(rng.choice(moves))
+            else:
+                return board.move_stack
+
+
+def mean_us(times):
+    return sum(times) / len(times) * 1_000_000 if times else 0
@@ -0,0 +1,112 @@
+import asyncio
+import gc
+import random
+import tracemalloc
+
+import chess
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core import wire
+from core.games import Game
+from core.routing import GAME_CONSUMERS
+
+
+class Command(BaseCommand):
+    help = (
+        "Report the bytes allocated per idle connection to the game consumer "
+        "and per active game held by its owner, measured with tracemalloc. "
+        "Games are compared with a board keeping its whole move stack, as "
+        "games were held before. Connections count the in-process test "
+        "transport too, and need redis."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--connections", type=int, default=1000, help="Idle connections."
+        )
+        parser.add_argument("--games", type=int, default=1000)
+        parser.add_argument(
+            "--plies",
+            default="0,40,100,200",
+            help="Comma separated plies played in the games.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options["connections"]:
+            per_connection = asyncio.run(idle_connections(options["connections"]))
+            self.stdout.write(f"idle connection {per_connection:>10.0f} bytes")
+
+        self.stdout.write(f"{'plies':>6} {'game bytes':>11} {'board bytes':>12}")
+        for plies in [int(n) for n in options["plies"].split(",")]:
+            rng = random.Random(options["seed"])
+            games = [random_moves(rng, plies) for _ in range(options["games"])]
+            self.stdout.write(
+                f"{plies:>6} {measure(active_games, games):>11.0f} "
+                f"{measure(boards, games):>12.0f}"
+            )
+
+
+def measure(build, items):
+    """Return the bytes build allocates and keeps per item."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build(items)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del kept
+    return used / len(items)
+
+
+async def idle_connections(count):
+    application = GAME_CONSUMERS[settings.GAME_CONSUMER].as_asgi()
+
+    async def connect():
+        communicator = WebsocketCommunicator(application, "/ws/game/")
+        await communicator.connect()
+        return communicator
+
+    # the first connection allocates what every later one shares
+    await (await connect()).disconnect()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    communicators = [await connect() for _ in range(count)]
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    for communicator in communicators:
+        await communicator.disconnect()
+    return used / count
+
+
+def random_moves(rng, plies):
+    board = chess.Board()
+    while board.ply() < plies and not board.is_game_over():
+        board.push(rng.choice(list(board.legal_moves)))
+    return board.move_stack
+
+
+def active_games(games):
+    kept = []
+    for n, moves in enumerate(games):
+        game = Game(f"{n:032x}", "w" * 32, "b" * 32)
+        for move in moves:
+            game.move(game.board.turn, code=wire.encode_move(move))
+        kept.append(game)
+    return kept
+
+
+def boards(games):
+    kept = []
+    for moves in games:
+        board = chess.Board()
+        for move in moves:
+            board.push(move)
+        kept.append(board)
+    return kept
@@ -0,0 +1,31 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core import assets
+
+
+class Command(BaseCommand):
+    help = (
+        "Bundle the static files of GAME_ASSET_BUNDLES and GAME_ASSET_FILES "
+        "into fingerprinted files with gzip and, if the brotli module is "
+        "installed, brotli variants, for the pages to load. Run it before "
+        "collectstatic on every deploy."
+    )
+
+    def handle(self, *args, **options):
+        manifest = assets.build()
+        build = os.path.join(settings.GAME_ASSETS_ROOT, assets.BUILD)
+        for name, built in sorted(manifest["bundles"].items()):
+            sizes = [
+                os.path.getsize(os.path.join(settings.GAME_ASSETS_ROOT, built + suffix))
+                for suffix in ("", ".gz")
+            ]
+            self.stdout.write(
+                f"{name:<10} {built:<32} {sizes[0] / 1024:>8.1f} KB "
+                f"{sizes[1] / 1024:>7.1f} KB gzipped"
+            )
+        self.stdout.write(f"{len(manifest['files'])} files built into {build}")
+        if not assets.brotli:
+            self.stdout.write("brotli not installed, no .br variants written")
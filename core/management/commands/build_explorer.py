@@ -0,0 +1,28 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core import explorer
+
+
+class Command(BaseCommand):
+    help = (
+        "Add the games archived since the last run to the opening explorer "
+        "index at GAME_EXPLORER_PATH. Run it periodically, e.g. from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="Index every archived game again from scratch.",
+        )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        added = explorer.build(rebuild=options["rebuild"])
+        self.stdout.write(
+            f"indexed {added} games into {settings.GAME_EXPLORER_PATH} "
+            f"in {time.perf_counter() - started:.2f}s"
+        )
@@ -0,0 +1,31 @@
+import sys
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from core import models, pgn
+
+
+class Command(BaseCommand):
+    help = "Write the archived games as PGN, reading them in chunks."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--output", help="File to write to, standard output by default."
+        )
+        parser.add_argument("--user", help="Only the games of this username.")
+
+    def handle(self, *args, **options):
+        games = models.Game.objects.all()
+        if options["user"]:
+            games = games.filter(
+                Q(white__username=options["user"]) | Q(black__username=options["user"])
+            )
+
+        out = open(options["output"], "w") if options["output"] else sys.stdout
+        try:
+            for text in pgn.export_games(games):
+                out.write(text)
+        finally:
+            if out is not sys.stdout:
+                out.close()
@@ -0,0 +1,52 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand
+
+from core import pgn
+
+
+class Command(BaseCommand):
+    help = (
+        "Archive the games of a PGN file of any size. The moves are validated "
+        "in worker processes and the games inserted in batches, games already "
+        "archived are skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="PGN file to import.")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Games validated and inserted at a time.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Worker processes validating the moves.",
+        )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        workers = options["workers"]
+        read = inserted = 0
+        # the workers unpickle functions of core, which needs the app registry
+        with ProcessPoolExecutor(
+            workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=django.setup,
+        ) as executor, open(options["file"]) as lines:
+            for read, inserted in pgn.import_games(
+                lines, executor, options["batch_size"], window=workers * 2
+            ):
+                self.stderr.write(f"read {read} games, inserted {inserted}")
+
+        self.stdout.write(
+            f"imported {inserted} of {read} games from {options['file']} "
+            f"in {time.perf_counter() - started:.2f}s"
+        )
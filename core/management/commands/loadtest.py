@@ -0,0 +1,253 @@
+import asyncio
+import json
+import random
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import chess
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from core.consumers import AsyncGameConsumer, GameConsumer
+from core.waiting_queue import WaitingQueue
+
+CONSUMERS = {"sync": GameConsumer, "async": AsyncGameConsumer}
+TIMEOUT = 60
+# results compared with the previous run, and whether higher is better
+COMPARED = {
+    "moves_per_sec": True,
+    "move_p50_ms": False,
+    "move_p99_ms": False,
+    "match_p50_ms": False,
+    "match_p99_ms": False,
+    "kb_per_game": False,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive simulated players against the game consumer in-process: they "
+        "look for opponents, play random legal moves and poll for timeouts. "
+        "Report moves per second, move echo and match latency and memory per "
+        "game, and append the results to a file to compare between versions. "
+        "Clears the waiting queue in redis."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--consumer", choices=sorted(CONSUMERS), default=settings.GAME_CONSUMER
+        )
+        parser.add_argument(
+            "--players", type=int, default=1000, help="Simulated players, even."
+        )
+        parser.add_argument(
+            "--plies", type=int, default=40, help="Plies played per game."
+        )
+        parser.add_argument(
+            "--ramp",
+            type=float,
+            default=1.0,
+            help="Seconds over which the players arrive.",
+        )
+        parser.add_argument(
+            "--poll",
+            type=float,
+            default=1.0,
+            help="Seconds between a player's end_if_timeout commands.",
+        )
+        parser.add_argument(
+            "--results",
+            default=str(settings.BASE_DIR / "loadtest.jsonl"),
+            help="File the results are appended to as JSON lines.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options["players"] < 2 or options["players"] % 2:
+            raise CommandError("--players must be an even number of at least 2")
+
+        rng = random.Random(options["seed"])
+        # bots move as soon as their opponent did, faster than players may
+        with override_settings(GAME_FRAME_LIMITS={}):
+            result = asyncio.run(
+                run(
+                    CONSUMERS[options["consumer"]],
+                    options["players"],
+                    options["plies"],
+                    options["ramp"],
+                    options["poll"],
+                    rng,
+                )
+            )
+        run_info = {
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "version": version(),
+            "consumer": options["consumer"],
+            "players": options["players"],
+            "plies": options["plies"],
+            **result,
+        }
+
+        previous = last_run(options["results"], run_info)
+        for name, value in result.items():
+            line = f"{name:<14} {value:>10.2f}"
+            if previous and previous.get(name):
+                change = (value - previous[name]) / previous[name] * 100
+                line += f"  {change:+6.1f}%"
+                if change:
+                    better = (change > 0) == COMPARED[name]
+                    line += " better" if better else " worse"
+            self.stdout.write(line)
+        if previous:
+            self.stdout.write(
+                f"compared with {previous['version'] or 'unknown'} "
+                f"at {previous['time']}"
+            )
+
+        with open(options["results"], "a") as f:
+            f.write(json.dumps(run_info) + "\n")
+
+
+def version():
+    """Return the commit the tree is at, empty if it isn't a git checkout."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def last_run(path, run_info):
+    """Return the last stored run with the same consumer, players and plies."""
+    previous = None
+    try:
+        with open(path) as f:
+            for line in f:
+                stored = json.loads(line)
+                if all(
+                    stored.get(key) == run_info[key]
+                    for key in ("consumer", "players", "plies")
+                ):
+                    previous = stored
+    except FileNotFoundError:
+        pass
+    return previous
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[max(int(len(values) * p / 100) - 1, 0)]
+
+
+def max_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+async def run(consumer_class, players, plies, ramp, poll, rng):
+    """Start the players over ramp seconds and wait until every game is done.
+
+    Memory per game is the growth of the process's peak resident size once
+    every game has started, so it counts the consumers, the game owners and
+    redis clients, not just the boards.
+    """
+    await WaitingQueue().clear()
+    application = consumer_class.as_asgi()
+    baseline_kb = max_rss_kb()
+
+    matches, latencies = [], []
+    kb_per_game = 0
+
+    def game_started():
+        nonlocal kb_per_game
+        if len(matches) == players:
+            kb_per_game = (max_rss_kb() - baseline_kb) / (players // 2)
+
+    started = time.perf_counter()
+    bots = [
+        asyncio.ensure_future(
+            bot(
+                application,
+                i * ramp / players,
+                plies,
+                poll,
+                random.Random(rng.random()),
+                matches,
+                latencies,
+                game_started,
+            )
+        )
+        for i in range(players)
+    ]
+    await asyncio.gather(*bots)
+    elapsed = time.perf_counter() - started
+
+    await WaitingQueue().clear()
+    latencies.sort()
+    matches.sort()
+    return {
+        "moves_per_sec": len(latencies) / elapsed,
+        "move_p50_ms": percentile(latencies, 50) * 1000,
+        "move_p99_ms": percentile(latencies, 99) * 1000,
+        "match_p50_ms": percentile(matches, 50) * 1000,
+        "match_p99_ms": percentile(matches, 99) * 1000,
+        "kb_per_game": kb_per_game,
+    }
+
+
+async def bot(application, delay, plies, poll, rng, matches, latencies, started):
+    """Be a player: find an opponent, then play until the game ends or plies."""
+    await asyncio.sleep(delay)
+    communicator = WebsocketCommunicator(application, "/ws/game/")
+    await communicator.connect(timeout=TIMEOUT)
+
+    searched = time.perf_counter()
+    await communicator.send_json_to({"command": "find_opponent"})
+    data = await communicator.receive_json_from(timeout=TIMEOUT)
+    matches.append(time.perf_counter() - searched)
+    started()
+
+    colour = data["colour"] == "white"
+    board = chess.Board()
+    sent = None
+
+    async def move():
+        nonlocal sent
+        san = board.san(rng.choice(list(board.legal_moves)))
+        sent = time.perf_counter()
+        await communicator.send_json_to({"command": "move", "san": san})
+
+    async def poll_timeout():
+        while True:
+            await asyncio.sleep(poll)
+            await communicator.send_json_to({"command": "end_if_timeout"})
+
+    poller = asyncio.ensure_future(poll_timeout())
+    try:
+        if colour:
+            await move()
+        while board.ply() < plies:
+            data = await communicator.receive_json_from(timeout=TIMEOUT)
+            if data["command"] != "moved":
+                break  # won, lost or drawn
+
+            board.push_san(data["san"])
+            if (data["colour"] == "white") == colour:
+                latencies.append(time.perf_counter() - sent)
+            if board.turn == colour and not board.is_game_over():
+                await move()
+    finally:
+        poller.cancel()
+        await communicator.disconnect(timeout=TIMEOUT)
@@ -0,0 +1,141 @@
+import asyncio
+import heapq
+import random
+import statistics
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.waiting_queue import WaitingQueue
+
+ARRIVAL, WIDEN = 0, 1
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay a synthetic stream of players joining the rating bucketed "
+        "waiting queue and report wait time percentiles and pairing "
+        "throughput. Clears the waiting queue in redis."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--players", type=int, default=10000, help="Players arriving."
+        )
+        parser.add_argument(
+            "--rate", type=float, default=50.0, help="Arrivals per second."
+        )
+        parser.add_argument("--mean", type=float, default=1500.0)
+        parser.add_argument(
+            "--sd", type=float, default=350.0, help="Rating standard deviation."
+        )
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        result = asyncio.run(
+            simulate(
+                options["players"],
+                options["rate"],
+                lambda: rng.gauss(options["mean"], options["sd"]),
+                rng,
+            )
+        )
+
+        waits = sorted(result["waits"])
+        calls = sorted(result["calls"])
+        self.stdout.write(
+            f"players {options['players']}, paired {len(waits)}, "
+            f"left waiting {result['waiting']}, most waiting {result['peak']}"
+        )
+        self.stdout.write(
+            "wait s      p50 {:.1f}  p90 {:.1f}  p99 {:.1f}  max {:.1f}".format(
+                percentile(waits, 50),
+                percentile(waits, 90),
+                percentile(waits, 99),
+                waits[-1] if waits else 0,
+            )
+        )
+        self.stdout.write(
+            "match ms    p50 {:.3f}  p99 {:.3f}".format(
+                percentile(calls, 50) * 1000, percentile(calls, 99) * 1000
+            )
+        )
+        self.stdout.write(
+            f"throughput  {len(calls) / sum(calls):.0f} searches/s, "
+            f"rating gap mean {statistics.mean(result['gaps'] or [0]):.0f}"
+        )
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[max(int(len(values) * p / 100) - 1, 0)]
+
+
+async def simulate(players, rate, rating, rng):
+    """Run the arrivals against redis on a simulated clock.
+
+    Arrivals are a Poisson stream. A waiting player searches again every
+    GAME_MATCH_WIDEN_EVERY simulated seconds with its radius widened, as
+    the consumers do. Only the queue calls themselves are timed.
+    """
+    wq = WaitingQueue()
+    await wq.clear()
+
+    events = []
+    now = 0.0
+    for n in range(players):
+        now += rng.expovariate(rate)
+        events.append((now, ARRIVAL, f"sim{n}"))
+    heapq.heapify(events)
+    # once the last player has searched at the widest radius nobody left
+    # can be paired any more
+    end = now + settings.GAME_MATCH_WIDEN_EVERY * (settings.GAME_MATCH_MAX_RADIUS + 1)
+
+    ratings, arrived, waiting = {}, {}, set()
+    waits, calls, gaps = [], [], []
+    peak = 0
+    while events:
+        now, kind, player = heapq.heappop(events)
+        if now > end:
+            break
+        if kind == ARRIVAL:
+            ratings[player] = rating()
+            arrived[player] = now
+        elif player not in waiting:
+            continue  # paired since the search was scheduled
+
+        radius = min(
+            int((now - arrived[player]) // settings.GAME_MATCH_WIDEN_EVERY),
+            settings.GAME_MATCH_MAX_RADIUS,
+        )
+        started = time.perf_counter()
+        opponent = await wq.match(
+            player, ratings[player], radius, waiting=player in waiting
+        )
+        calls.append(time.perf_counter() - started)
+
+        if opponent:
+            opponent = opponent[0]
+            waiting.discard(player)
+            waiting.discard(opponent)
+            waits.append(now - arrived[player])
+            waits.append(now - arrived[opponent])
+            gaps.append(abs(ratings[player] - ratings[opponent]))
+        else:
+            waiting.add(player)
+            peak = max(peak, len(waiting))
+            heapq.heappush(
+                events, (now + settings.GAME_MATCH_WIDEN_EVERY, WIDEN, player)
+            )
+
+    await wq.clear()
+    return {
+        "waits": waits,
+        "calls": calls,
+        "gaps": gaps,
+        "waiting": len(waiting),
+        "peak": peak,
+    }
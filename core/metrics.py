@@ -0,0 +1,199 @@
+import asyncio
+import bisect
+import functools
+import threading
+import time
+from django.conf import settings
+
+# Latency buckets in seconds, from a local move to a slow Redis round trip.
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+# process-local metrics by name, in registration order
+registry = {}
+
+
+class Metric:
+    """A named family of values, one per combination of label values."""
+
+    kind = ""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+        registry[name] = self
+
+    def labels_str(self, labels, extra=""):
+        pairs = [f'{name}="{value}"' for name, value in zip(self.labelnames, labels)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        with self.lock:
+            return [
+                f"{self.name}{self.labels_str(labels)} {value}"
+                for labels, value in self.values.items()
+            ]
+
+    def render(self):
+        return [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.kind}",
+            *self.samples(),
+        ]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        if not settings.GAME_METRICS:
+            return
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    """A value read from callback whenever the metrics are scraped."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, callback):
+        super().__init__(name, help_text)
+        self.callback = callback
+
+    def samples(self):
+        return [f"{self.name} {self.callback()}"]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def observe(self, value, *labels):
+        if not settings.GAME_METRICS:
+            return
+        index = bisect.bisect_left(BUCKETS, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # one count per bucket, then +Inf, then the sum
+                counts = self.values[labels] = [0] * (len(BUCKETS) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = {labels: list(counts) for labels, counts in self.values.items()}
+
+        lines = []
+        for labels, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), counts):
+                cumulative += count
+                le = self.labels_str(labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{self.labels_str(labels)} {counts[-1]}")
+            lines.append(f"{self.name}_count{self.labels_str(labels)} {cumulative}")
+        return lines
+
+
+def timed(histogram, *labels):
+    """Decorate a function or coroutine function to observe its run time.
+
+    With GAME_METRICS off the function is returned untouched, so disabled
+    metrics cost nothing on the hot path.
+    """
+
+    def decorator(func):
+        if not settings.GAME_METRICS:
+            return func
+
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started, *labels)
+
+        else:
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - started, *labels)
+
+        return wrapper
+
+    return decorator
+
+
+def render():
+    """Return every metric of this process in the Prometheus text format."""
+    lines = []
+    for metric in registry.values():
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+RECEIVE_SECONDS = Histogram(
+    "chess_receive_seconds",
+    "Time to handle a frame received from a player.",
+    ("consumer",),
+)
+MOVE_SECONDS = Histogram(
+    "chess_move_seconds",
+    "Time from receiving a move to it being applied or forwarded to its owner.",
+    ("consumer",),
+)
+GAMEOVER_SECONDS = Histogram(
+    "chess_end_if_gameover_seconds",
+    "Time to check whether a move ended the game.",
+)
+QUEUE_WAIT_SECONDS = Histogram(
+    "chess_queue_wait_seconds",
+    "Time a player waited in the queue for an opponent.",
+)
+WAITING_QUEUE_SECONDS = Histogram(
+    "chess_waiting_queue_seconds",
+    "Latency of a WaitingQueue operation, a Redis round trip.",
+    ("op",),
+)
+FINISHED_GAMES = Counter(
+    "chess_finished_games_total",
+    "Games finished by this process, by how they ended.",
+    ("result",),
+)
+ANALYSES = Counter(
+    "chess_analyses_total",
+    "Analyse requests, by whether they were cached, analysed or refused.",
+    ("result",),
+)
+CHANNEL_MESSAGES = Counter(
+    "chess_channel_messages_total",
+    "Channel layer messages sent, by whether they went in memory or to Redis.",
+    ("path",),
+)
+THROTTLED_FRAMES = Counter(
+    "chess_throttled_frames_total",
+    "Frames from players dropped unhandled: oversize, malformed, limited or "
+    "coalesced.",
+    ("reason",),
+)
+COMPUTER_MOVES = Counter(
+    "chess_computer_moves_total",
+    "Computer moves, by whether an engine searched them, failed to or the "
+    "queue was full.",
+    ("result",),
+)
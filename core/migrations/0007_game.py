@@ -0,0 +1,42 @@
+# Generated by Django 3.2.10 on 2026-10-18 19:25
+
+import core.models
+import datetime
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0006_delete_game'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Game',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('uuid', models.CharField(max_length=32, unique=True)),
+                ('white_uuid', models.CharField(max_length=32)),
+                ('black_uuid', models.CharField(max_length=32)),
+                ('status', models.CharField(choices=[('A', 'abandoned'), ('C', 'checkmate'), ('T', 'timeout'), ('D', 'draw')], max_length=1)),
+                ('winner_colour', models.BooleanField(blank=True, null=True)),
+                ('moves', models.TextField(blank=True, help_text='Space separated UCI moves.')),
+                ('fen', models.CharField(max_length=90)),
+                ('white_timer', models.DurationField(default=datetime.timedelta(0), validators=[core.models.validate_min_timer])),
+                ('black_timer', models.DurationField(default=datetime.timedelta(0), validators=[core.models.validate_min_timer])),
+                ('created', models.DateTimeField()),
+                ('ended', models.DateTimeField()),
+                ('black', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='games_as_black', to=settings.AUTH_USER_MODEL)),
+                ('white', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='games_as_white', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ('-ended',),
+            },
+        ),
+    ]
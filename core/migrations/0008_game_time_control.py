@@ -0,0 +1,18 @@
+# Generated by Django 3.2.10 on 2026-10-18 19:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_game'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='time_control',
+            field=models.CharField(blank=True, max_length=16),
+        ),
+    ]
@@ -1,6 +1,57 @@
+from datetime import timedelta
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.db import models
 
 
 def validate_min_timer(value):
     if value < timedelta():
         raise ValidationError("Timer can't be negative.")
+
+
+class Game(models.Model):
+    """A finished game, written by core.archive once it is over."""
+
+    STATUS_CHOICES = (
+        ("A", "abandoned"),
+        ("C", "checkmate"),
+        ("T", "timeout"),
+        ("D", "draw"),
+    )
+
+    uuid = models.CharField(max_length=32, unique=True)
+    white_uuid = models.CharField(max_length=32)
+    black_uuid = models.CharField(max_length=32)
+    white = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="games_as_white",
+    )
+    black = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+        related_name="games_as_black",
+    )
+    status = models.CharField(max_length=1, choices=STATUS_CHOICES)
+    winner_colour = models.BooleanField(null=True, blank=True)
+    moves = models.TextField(blank=True, help_text="Space separated UCI moves.")
+    time_control = models.CharField(max_length=16, blank=True)
+    fen = models.CharField(max_length=90)
+    white_timer = models.DurationField(
+        default=timedelta(), validators=[validate_min_timer]
+    )
+    black_timer = models.DurationField(
+        default=timedelta(), validators=[validate_min_timer]
+    )
+    created = models.DateTimeField()
+    ended = models.DateTimeField()
+
+    class Meta:
+        ordering = ("-ended",)
+
+    def __str__(self):
+        return self.uuid
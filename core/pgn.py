@@ -0,0 +1,215 @@
+import collections
+import hashlib
+import io
+import itertools
+from datetime import datetime, timezone
+import chess
+import chess.pgn
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.utils import timezone as django_timezone
+from . import models
+
+RESULTS = {True: "1-0", False: "0-1", None: "1/2-1/2"}
+TERMINATIONS = {
+    "A": "abandoned",
+    "C": "normal",
+    "T": "time forfeit",
+    "D": "normal",
+}
+
+
+def time_control_header(control):
+    if control not in settings.GAME_TIME_CONTROLS:
+        return "-"
+    base, increment = settings.GAME_TIME_CONTROLS[control]
+    return f"{base // 1000}+{increment // 1000}"
+
+
+def player_name(user, client_uuid):
+    return user.username if user else f"Anonymous {client_uuid[:8]}"
+
+
+def to_pgn(game):
+    """Return an archived game as PGN text."""
+    created = game.created.astimezone(timezone.utc)
+    pgn = chess.pgn.Game()
+    pgn.headers["Event"] = "Online chess"
+    pgn.headers["Site"] = "-"
+    pgn.headers["Date"] = created.strftime("%Y.%m.%d")
+    pgn.headers["White"] = player_name(game.white, game.white_uuid)
+    pgn.headers["Black"] = player_name(game.black, game.black_uuid)
+    pgn.headers["Result"] = RESULTS[game.winner_colour]
+    pgn.headers["UTCDate"] = created.strftime("%Y.%m.%d")
+    pgn.headers["UTCTime"] = created.strftime("%H:%M:%S")
+    pgn.headers["TimeControl"] = time_control_header(game.time_control)
+    pgn.headers["Termination"] = TERMINATIONS[game.status]
+    pgn.headers["GameId"] = game.uuid
+
+    node = pgn
+    for uci in game.moves.split():
+        node = node.add_variation(chess.Move.from_uci(uci))
+    return f"{pgn}\n\n"
+
+
+def export_games(games):
+    """Yield the games of a queryset as PGN, reading them in chunks."""
+    games = games.select_related("white", "black").order_by("id")
+    for game in games.iterator(chunk_size=settings.GAME_PGN_CHUNK_SIZE):
+        yield to_pgn(game)
+
+
+def split_games(lines):
+    """Yield the text of each game of a PGN file read line by line."""
+    game = []
+    in_moves = False
+    for line in lines:
+        if line.startswith("[") and in_moves:
+            yield "".join(game)
+            game, in_moves = [], False
+        elif line.strip() and not line.startswith("["):
+            in_moves = True
+        game.append(line)
+    if in_moves:
+        yield "".join(game)
+
+
+class QuietGameBuilder(chess.pgn.GameBuilder):
+    """Collects the errors of a game instead of logging each of them."""
+
+    def handle_error(self, error):
+        self.game.errors.append(error)
+
+
+def parse_date(headers):
+    for date, time in (
+        (headers.get("UTCDate"), headers.get("UTCTime", "00:00:00")),
+        (headers.get("Date"), "00:00:00"),
+    ):
+        try:
+            played = datetime.strptime(f"{date} {time}", "%Y.%m.%d %H:%M:%S")
+            return played.replace(tzinfo=timezone.utc)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def parse_games(texts):
+    """Return how many games of PGN text there were and the playable ones.
+
+    Runs in the worker processes of import_games, which validate the moves.
+    Games with illegal moves or no result are skipped. Decisive games that
+    didn't end in checkmate or on time are stored as abandonments, the
+    archive has no resignations.
+    """
+    controls = {
+        time_control_header(control): control
+        for control in settings.GAME_TIME_CONTROLS
+    }
+    parsed = []
+    for text in texts:
+        pgn = chess.pgn.read_game(io.StringIO(text), Visitor=QuietGameBuilder)
+        result = pgn.headers.get("Result") if pgn else None
+        if not pgn or pgn.errors or result not in ("1-0", "0-1", "1/2-1/2"):
+            continue
+
+        board = pgn.end().board()
+        if result == "1/2-1/2":
+            status, winner_colour = "D", None
+        else:
+            winner_colour = result == "1-0"
+            if board.is_checkmate():
+                status = "C"
+            elif pgn.headers.get("Termination", "").lower() == "time forfeit":
+                status = "T"
+            else:
+                status = "A"
+
+        game_id = pgn.headers.get("GameId", "")
+        if len(game_id) != 32:
+            # the same game imported twice gets the same uuid
+            game_id = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+        parsed.append(
+            {
+                "uuid": game_id,
+                "white": pgn.headers.get("White", ""),
+                "black": pgn.headers.get("Black", ""),
+                "status": status,
+                "winner_colour": winner_colour,
+                "moves": " ".join(move.uci() for move in board.move_stack),
+                "fen": board.fen(),
+                "time_control": controls.get(pgn.headers.get("TimeControl"), ""),
+                "created": parse_date(pgn.headers),
+            }
+        )
+    return len(texts), parsed
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def bounded_map(executor, func, iterable, window):
+    """Yield func of every item, in order, with at most window in flight.
+
+    Unlike Pool.imap, the input is only read as results are taken, so a
+    huge file never sits in memory.
+    """
+    in_flight = collections.deque()
+    for item in iterable:
+        in_flight.append(executor.submit(func, item))
+        if len(in_flight) >= window:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+def import_games(lines, executor, batch_size, window):
+    """Insert the games of a PGN file read line by line.
+
+    The file flows through a generator pipeline: split into games, batches
+    validated in executor's worker processes with at most window batches
+    in flight, bulk inserted in order. Games already archived are skipped.
+    Yield how many games were read and inserted so far after every batch.
+    """
+    User = get_user_model()
+    now = django_timezone.now()
+    batches = chunked(split_games(lines), batch_size)
+    read = inserted = 0
+    for count, games in bounded_map(executor, parse_games, batches, window):
+        read += count
+        names = {game[colour] for game in games for colour in ("white", "black")}
+        users = dict(
+            User.objects.filter(username__in=names).values_list("username", "id")
+        )
+        archived = set(
+            models.Game.objects.filter(
+                uuid__in=[game["uuid"] for game in games]
+            ).values_list("uuid", flat=True)
+        )
+        rows = [
+            models.Game(
+                uuid=game["uuid"],
+                white_uuid="",
+                black_uuid="",
+                white_id=users.get(game["white"]),
+                black_id=users.get(game["black"]),
+                status=game["status"],
+                winner_colour=game["winner_colour"],
+                moves=game["moves"],
+                fen=game["fen"],
+                time_control=game["time_control"],
+                created=game["created"] or now,
+                ended=game["created"] or now,
+            )
+            for game in games
+            if game["uuid"] not in archived
+        ]
+        models.Game.objects.bulk_create(rows, ignore_conflicts=True)
+        inserted += len(rows)
+        yield read, inserted
@@ -0,0 +1,89 @@
+from collections import Counter
+import chess
+import chess.polyglot
+
+hasher = chess.polyglot.ZobristHasher(chess.polyglot.POLYGLOT_RANDOM_ARRAY)
+
+
+def piece_key(piece, square):
+    """Return the Zobrist key of piece standing on square, 0 for an empty square."""
+    if piece is None:
+        return 0
+    return hasher.array[64 * ((piece.piece_type - 1) * 2 + piece.color) + square]
+
+
+class Positions:
+    """Counts the positions of a game by a Zobrist hash updated on every push.
+
+    Only the squares a move touches are rehashed, and the counter is cleared
+    on irreversible moves, so both the time and the memory per move stay flat
+    however long the game gets.
+    """
+
+    def __init__(self, board):
+        self.hash = hasher(board)
+        self.castling = hasher.hash_castling(board)
+        self.ep = hasher.hash_ep_square(board)
+        self.counts = Counter({self.hash: 1})
+
+    def push(self, board, move):
+        """Push move on board and count the position it leads to."""
+        squares = [move.from_square, move.to_square]
+        if board.is_en_passant(move):
+            squares.append(
+                chess.square(
+                    chess.square_file(move.to_square),
+                    chess.square_rank(move.from_square),
+                )
+            )
+        elif board.is_castling(move):
+            rank = chess.square_rank(move.from_square)
+            squares = [chess.square(file, rank) for file in range(8)]
+
+        before = [board.piece_at(square) for square in squares]
+        castling_rights = board.castling_rights
+        board.push(move)
+
+        zobrist_hash = self.hash ^ hasher.array[780]  # side to move
+        for square, piece in zip(squares, before):
+            zobrist_hash ^= piece_key(piece, square) ^ piece_key(
+                board.piece_at(square), square
+            )
+
+        if self.ep or board.ep_square:
+            ep = hasher.hash_ep_square(board)
+            zobrist_hash ^= self.ep ^ ep
+            self.ep = ep
+
+        irreversible = not board.halfmove_clock
+        if board.castling_rights != castling_rights:
+            castling = hasher.hash_castling(board)
+            zobrist_hash ^= self.castling ^ castling
+            self.castling = castling
+            irreversible = True
+
+        if irreversible:
+            # no earlier position can occur again
+            self.counts.clear()
+
+        self.hash = zobrist_hash
+        self.counts[zobrist_hash] += 1
+
+    def is_repetition(self, count=3):
+        return self.counts[self.hash] >= count
+
+    def outcome(self, board):
+        """Return why the game on board is over, or None if it goes on.
+
+        Legal move generation runs once and answers both the checkmate and
+        the stalemate question.
+        """
+        if not any(board.generate_legal_moves()):
+            return "checkmate" if board.is_check() else "stalemate"
+        if board.is_insufficient_material():
+            return "insufficient material"
+        if board.is_fifty_moves():
+            return "fifty moves"
+        if self.is_repetition():
+            return "repetition"
+        return None
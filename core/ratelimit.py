@@ -0,0 +1,64 @@
+import time
+
+
+class TokenBucket:
+    """Allows bursts of capacity actions, refilled at rate tokens a second."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Spend a token, return False if none is left."""
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+        if self.tokens < 1:
+            return False
+
+        self.tokens -= 1
+        return True
+
+
+class FrameLimiter:
+    """Limits the frames one socket may send, by command.
+
+    limits maps a command to the (rate, burst) of its bucket, "*" to the
+    bucket shared by the commands without one; commands without either are
+    unlimited. The commands of intervals are handled at most once every so
+    many seconds, the duplicates in between are coalesced. Every frame over
+    a limit is a strike, exhausted is set once the socket ran out of
+    strikes, regained at strike_rate a second.
+    """
+
+    def __init__(self, limits, intervals, strikes, strike_rate):
+        self.limits = limits
+        self.intervals = intervals
+        self.buckets = {}
+        self.handled = {}
+        self.strikes = TokenBucket(strike_rate, strikes)
+        self.exhausted = False
+
+    def check(self, command):
+        """Return None if a frame of command may be handled, else why not."""
+        key = command if command in self.limits else "*"
+        if key in self.limits:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(*self.limits[key])
+            if not bucket.take():
+                if not self.strikes.take():
+                    self.exhausted = True
+                return "limited"
+
+        interval = self.intervals.get(command)
+        if interval is not None:
+            now = time.monotonic()
+            if now - self.handled.get(command, -interval) < interval:
+                return "coalesced"
+            self.handled[command] = now
+        return None
@@ -0,0 +1,66 @@
+import logging
+from collections import defaultdict
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F
+
+logger = logging.getLogger(__name__)
+
+
+def expected_score(rating, opponent_rating):
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
+
+
+def score(game):
+    """Return white's score in the finished game."""
+    if game.result["type"] == "inform_draw":
+        return 0.5
+    return 1.0 if game.result["winner_colour"] else 0.0
+
+
+def rate(games):
+    """Apply the Elo changes of the finished games played by two signed in users.
+
+    Games are rated in order, so a user with several games in the batch is
+    rated on the outcome of the earlier ones. The changes are added to the
+    stored ratings rather than overwriting them.
+    """
+    rated = [game for game in games if game.white_user_id and game.black_user_id]
+    if not rated:
+        return
+
+    User = get_user_model()
+    user_ids = {game.white_user_id for game in rated} | {
+        game.black_user_id for game in rated
+    }
+    ratings = dict(User.objects.filter(pk__in=user_ids).values_list("pk", "rating"))
+
+    changes = defaultdict(float)
+    for game in rated:
+        white, black = game.white_user_id, game.black_user_id
+        if white not in ratings or black not in ratings:
+            continue
+
+        change = settings.GAME_RATING_K * (
+            score(game) - expected_score(ratings[white], ratings[black])
+        )
+        for user_id, delta in ((white, change), (black, -change)):
+            ratings[user_id] += delta
+            changes[user_id] += delta
+
+    with transaction.atomic():
+        for user_id, change in changes.items():
+            User.objects.filter(pk=user_id).update(rating=F("rating") + change)
+
+
+async def rate_game(game):
+    """Apply the Elo change of a finished game from a thread, logging failures.
+
+    Independent of the archive, which may be off or dropping games.
+    """
+    try:
+        await database_sync_to_async(rate)([game])
+    except Exception:
+        logger.exception("Failed to rate game %s", game.uuid)
@@ -0,0 +1,55 @@
+import asyncio
+import functools
+import aioredis
+from django.conf import settings
+from .hashring import HashRing
+
+# pooled async clients by event loop and redis host, a pool only works on
+# the loop it was created on
+pools = {}
+
+
+@functools.lru_cache(maxsize=None)
+def hosts_ring():
+    return HashRing(range(len(settings.REDIS_HOSTS)))
+
+
+def host_index(key):
+    """Return the index in REDIS_HOSTS of the host key lives on."""
+    return hosts_ring().get(key)
+
+
+async def connection(key):
+    """Return a client of the redis host key lives on.
+
+    Clients share a pool of at most REDIS_POOL_SIZE connections per host, so
+    concurrent commands from every consumer of the process are multiplexed
+    over a few sockets and never wait on a blocking call.
+    """
+    loop = asyncio.get_running_loop()
+    index = host_index(key)
+    pool = pools.get((loop, index))
+    if pool is None:
+        pool = await connect(loop, index)
+    return pool
+
+
+async def connect(loop, index):
+    # forget the pools of event loops that were closed
+    for stale in [stale for stale in pools if stale[0].is_closed()]:
+        del pools[stale]
+
+    host, port = settings.REDIS_HOSTS[index]
+    pool = await aioredis.create_redis_pool(
+        (host, port),
+        db=settings.REDIS_DB,
+        maxsize=settings.REDIS_POOL_SIZE,
+        encoding="utf-8",
+    )
+    if (loop, index) in pools:
+        # another coroutine connected first
+        pool.close()
+        await pool.wait_closed()
+    else:
+        pools[(loop, index)] = pool
+    return pools[(loop, index)]
@@ -1,7 +1,23 @@
+from django.conf import settings
 from django.urls import re_path
 
-from . import consumers
+from . import consumers, shards
+
+GAME_CONSUMERS = {
+    "sync": consumers.GameConsumer,
+    "async": consumers.AsyncGameConsumer,
+}
 
 websocket_urlpatterns = [
-    re_path(r"ws/game/$", consumers.GameConsumer.as_asgi()),
+    re_path(r"ws/game/$", GAME_CONSUMERS[settings.GAME_CONSUMER].as_asgi()),
+    re_path(
+        r"ws/watch/(?P<game_uuid>[0-9a-f]{32})/$",
+        consumers.SpectatorConsumer.as_asgi(),
+    ),
 ]
+
+# a worker serves the channels of the shards it's started with
+channel_routes = {
+    shards.shard_channel(name): shards.GameShardConsumer.as_asgi()
+    for name in settings.GAME_SHARDS
+}
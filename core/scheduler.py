@@ -0,0 +1,100 @@
+import asyncio
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+# process-local flag timers, one per active game owned by this process
+timers = {}
+
+
+class ClockScheduler:
+    """Ends games on time by arming one event loop timer per game.
+
+    The timer is re-armed by the owner of the game after every move for the
+    side to move and sends it check_timeout on its channel when the flag
+    falls, so no client has to poll with end_if_timeout.
+    """
+
+    async def arm(self, game, channel):
+        await self.cancel(game.uuid)
+        if game.result or game.turn_started is None:
+            return
+
+        delay = max(game.remaining(game.board.turn), 0) / 1000
+        loop = asyncio.get_running_loop()
+        timers[game.uuid] = loop.call_later(delay, self.fire, game.uuid, channel)
+
+    async def cancel(self, game_uuid):
+        timer = timers.pop(game_uuid, None)
+        if timer:
+            timer.cancel()
+
+    def fire(self, game_uuid, channel):
+        timers.pop(game_uuid, None)
+        asyncio.ensure_future(
+            get_channel_layer().send(
+                channel, {"type": "check_timeout", "game_uuid": game_uuid}
+            )
+        )
+
+
+# process-local reconnect grace timers, one per game with an empty seat
+grace_timers = {}
+
+
+class GraceScheduler:
+    """Holds a disconnected player's seat for GAME_RECONNECT_GRACE seconds.
+
+    Runs in the owner of the game. If the player hasn't resumed when the
+    timer fires the owner is sent abandon and the game is lost.
+    """
+
+    async def hold(self, game, colour, channel):
+        await self.cancel(game.uuid)
+        game.absent = colour
+        loop = asyncio.get_running_loop()
+        grace_timers[game.uuid] = loop.call_later(
+            settings.GAME_RECONNECT_GRACE, self.fire, game.uuid, channel
+        )
+
+    async def cancel(self, game_uuid):
+        timer = grace_timers.pop(game_uuid, None)
+        if timer:
+            timer.cancel()
+
+    def fire(self, game_uuid, channel):
+        grace_timers.pop(game_uuid, None)
+        asyncio.ensure_future(
+            get_channel_layer().send(
+                channel, {"type": "abandon", "game_uuid": game_uuid}
+            )
+        )
+
+
+# process-local search widening timers, one per waiting client's channel
+search_timers = {}
+
+
+class SearchScheduler:
+    """Widens the rating range a waiting client accepts as its wait grows.
+
+    Every GAME_MATCH_WIDEN_EVERY seconds the consumer is sent widen_search,
+    so the sync and async consumers search again the same way.
+    """
+
+    async def arm(self, channel_name):
+        await self.cancel(channel_name)
+        loop = asyncio.get_running_loop()
+        search_timers[channel_name] = loop.call_later(
+            settings.GAME_MATCH_WIDEN_EVERY, self.fire, channel_name
+        )
+
+    async def cancel(self, channel_name):
+        timer = search_timers.pop(channel_name, None)
+        if timer:
+            timer.cancel()
+
+    def fire(self, channel_name):
+        search_timers.pop(channel_name, None)
+        asyncio.ensure_future(
+            get_channel_layer().send(channel_name, {"type": "widen_search"})
+        )
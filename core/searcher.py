@@ -0,0 +1,91 @@
+import time
+import chess
+
+# A small alpha-beta searcher standing in for a UCI engine when
+# GAME_ENGINE_PATH isn't set. It counts material only, it's for
+# development and tests rather than for a useful analysis.
+
+VALUES = {
+    chess.PAWN: 100,
+    chess.KNIGHT: 320,
+    chess.BISHOP: 330,
+    chess.ROOK: 500,
+    chess.QUEEN: 900,
+    chess.KING: 0,
+}
+MATE = 100_000
+INFINITY = MATE + 1
+
+
+def evaluate(board):
+    """Return the material balance from the side to move's point of view."""
+    score = 0
+    for piece_type, value in VALUES.items():
+        score += value * (
+            len(board.pieces(piece_type, chess.WHITE))
+            - len(board.pieces(piece_type, chess.BLACK))
+        )
+    return score if board.turn else -score
+
+
+def ordered_moves(board):
+    """Return the legal moves, captures of the most valuable pieces first."""
+
+    def victim(move):
+        piece = board.piece_at(move.to_square)
+        return VALUES[piece.piece_type] if piece else 0
+
+    return sorted(board.legal_moves, key=victim, reverse=True)
+
+
+def negamax(board, depth, ply, alpha, beta, deadline):
+    """Return the score of board for the side to move and its principal variation.
+
+    Mates score MATE less the plies to them, so nearer mates score higher.
+    """
+    if time.monotonic() > deadline:
+        raise TimeoutError
+
+    moves = ordered_moves(board)
+    if not moves:
+        return (-(MATE - ply) if board.is_check() else 0), []
+    if depth == 0:
+        return evaluate(board), []
+
+    best_pv = []
+    for move in moves:
+        board.push(move)
+        score, pv = negamax(board, depth - 1, ply + 1, -beta, -alpha, deadline)
+        board.pop()
+        score = -score
+        if score > alpha:
+            alpha, best_pv = score, [move] + pv
+            if alpha >= beta:
+                break
+    return alpha, best_pv
+
+
+def search(fen, depth, seconds):
+    """Search fen up to depth plies, deepening until seconds run out.
+
+    Return the analysis of the deepest search completed, the score from
+    white's point of view.
+    """
+    board = chess.Board(fen)
+    deadline = time.monotonic() + seconds
+    result = {"depth": 0, "score": None, "mate": None, "pv": []}
+    for current in range(1, depth + 1):
+        try:
+            score, pv = negamax(board, current, 0, -INFINITY, INFINITY, deadline)
+        except TimeoutError:
+            break
+
+        white = score if board.turn else -score
+        result = {"depth": current, "score": white, "mate": None, "pv": pv}
+        if abs(score) > MATE - 1000:
+            plies = MATE - abs(score)
+            mate = (plies + 1) // 2
+            result["score"] = None
+            result["mate"] = mate if white > 0 else -mate
+            break
+    return result
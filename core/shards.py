@@ -0,0 +1,276 @@
+import asyncio
+import logging
+from channels.consumer import AsyncConsumer
+from channels.layers import get_channel_layer
+from django.conf import settings
+from . import metrics, ratings
+from .archive import GameArchive
+from .computer import ComputerService
+from .games import Game, GameRegistry, clock
+from .hashring import HashRing
+from .scheduler import ClockScheduler, GraceScheduler
+from .spectators import relay_event
+
+logger = logging.getLogger(__name__)
+
+# shard workers owning the games by consistent hash of their uuid, None when
+# every process owns the games it creates
+ring = HashRing(settings.GAME_SHARDS) if settings.GAME_SHARDS else None
+# the channel this process's own games are served on and the task draining
+# it, used when no shard workers run
+local = {}
+
+
+def shard_channel(name):
+    return f"game-shard.{name}"
+
+
+async def owner_channel(game_uuid):
+    """Return the channel of the owner a new game is created on."""
+    if ring:
+        return shard_channel(ring.get(game_uuid))
+
+    if "channel" not in local or local["task"].get_loop().is_closed():
+        channel = await get_channel_layer().new_channel()
+        # served on the running loop, the games of a closed one are gone
+        if "channel" not in local or local["task"].get_loop().is_closed():
+            local["channel"] = channel
+            local["task"] = asyncio.ensure_future(serve(channel))
+    return local["channel"]
+
+
+async def serve(channel):
+    channel_layer = get_channel_layer()
+    shard = GameShard(channel)
+    while True:
+        event = await channel_layer.receive(channel)
+        await shard.handle(event)
+
+
+async def send(owner, event):
+    """Send event to the owner of a game, in process if it lives here."""
+    if owner == local.get("channel"):
+        await GameShard(owner).handle(event)
+    else:
+        await get_channel_layer().send(owner, event)
+
+
+class GameShard:
+    """Owns games: applies their moves, runs their clocks and ends them.
+
+    Players and spectators only hold sockets, every event of a game goes to
+    its owner, a shard worker or, without shards, the process that created
+    the game. The owner also joins the owner_{uuid} group, so a player
+    resuming and a spectator joining reach it knowing only the game uuid.
+    """
+
+    def __init__(self, owner=None):
+        self.owner = owner  # channel the owner receives the events on
+
+    async def handle(self, event):
+        """Apply event, a failing one is logged rather than lost to the owner.
+
+        The owner serves every game of its channel, and its caller too when
+        the event is handled in process, so one bad event mustn't stop them.
+        """
+        try:
+            await getattr(self, event["type"])(event)
+        except Exception:
+            logger.exception("Failed to handle %s", event["type"])
+
+    async def create_game(self, event):
+        game = Game.from_state(event["state"])
+        GameRegistry().add(game)
+        await get_channel_layer().group_add(f"owner_{game.uuid}", self.owner)
+        await self.computer_turn(game)
+
+    async def play_move(self, event):
+        game = GameRegistry().get(event["game_uuid"])
+        if not game:
+            return
+
+        if game.board.turn != event["colour"]:
+            game.queue_premove(
+                event["colour"], event["san"], event["code"], event["channel"]
+            )
+            return
+
+        moved_event = game.move(event["colour"], event["san"], event["code"])
+        if not moved_event:
+            return
+        await self.announce_move(game, moved_event)
+
+        if game.premove and not game.result:
+            # played in the same event, without a round trip to the premover
+            channel = game.premove[1]
+            moved_event = game.play_premove()
+            if moved_event:
+                await self.announce_move(game, moved_event)
+            else:
+                await get_channel_layer().send(channel, {"type": "premove_dropped"})
+
+    async def announce_move(self, game, moved_event):
+        """Announce a move, then end the game or arm the clock of the side to move."""
+        await get_channel_layer().group_send(f"game_{game.uuid}", moved_event)
+        if game.watched:
+            await self.notify_spectators(game, moved_event)
+        if game.end_if_gameover():
+            await self.end_game(game)
+        else:
+            await ClockScheduler().arm(game, self.owner)
+            await self.computer_turn(game)
+
+    async def computer_turn(self, game):
+        """Have the computer move if it plays game and it's its turn."""
+        if game.computer and game.board.turn == game.computer[0]:
+            await ComputerService().think(game, self.owner)
+
+    async def cancel_premove(self, event):
+        game = GameRegistry().get(event["game_uuid"])
+        if game and game.board.turn != event["colour"]:
+            game.premove = None
+
+    async def check_timeout(self, event):
+        game = GameRegistry().get(event["game_uuid"])
+        if not game:
+            return
+
+        if game.end_if_timeout():
+            await self.end_game(game)
+        else:
+            # the timer fired a little before the flag fell
+            await ClockScheduler().arm(game, self.owner)
+
+    async def player_left(self, event):
+        game = GameRegistry().get(event["game_uuid"])
+        if not game or not game.seated(event["colour"], event["channel"]):
+            return  # a socket whose seat was resumed by another
+
+        if game.absent is not None and game.absent != event["colour"]:
+            # both players are gone, the one who left first loses
+            game.finish(not game.absent, "abandonment")
+            await self.end_game(game)
+        else:
+            await GraceScheduler().hold(game, event["colour"], self.owner)
+
+    async def abandon(self, event):
+        game = GameRegistry().get(event["game_uuid"])
+        if not game or game.absent is None:
+            return
+
+        game.finish(not game.absent, "abandonment")
+        await self.end_game(game)
+
+    async def resume(self, event):
+        """Move a player's seat to the socket resuming it, with a snapshot.
+
+        The seat may still be held by the player's old socket, which the
+        server hasn't seen drop yet, its disconnect is then ignored.
+        """
+        game = GameRegistry().get(event["game_uuid"])
+        if not game:
+            return
+
+        colour = game.seat(event["token"])
+        if colour is None:
+            await get_channel_layer().send(
+                event["channel"], {"type": "resume_refused"}
+            )
+            return
+
+        game.move_seat(colour, event["channel"])
+        if game.absent == colour:
+            await GraceScheduler().cancel(game.uuid)
+            game.absent = None
+        if game.absent is None and game.moves and game.turn_started is None:
+            # paused while the game moved here from a draining process
+            game.turn_started = clock()
+            await ClockScheduler().arm(game, self.owner)
+        await get_channel_layer().send(
+            event["channel"],
+            {
+                "type": "resumed",
+                "token": event["token"],
+                "owner": self.owner,
+                **game.snapshot(colour),
+            },
+        )
+
+    async def take_over(self, event):
+        """Own a game handed off by a draining process, seating its claimer.
+
+        The clock stays stopped until the other player is back too, who has
+        the reconnect grace to resume, but for games against the computer.
+        """
+        game = Game.from_state(event["state"])
+        colour = game.seat(event["token"])
+        if colour is None:
+            await get_channel_layer().send(
+                event["channel"], {"type": "resume_refused"}
+            )
+            return
+
+        game.move_seat(colour, event["channel"])
+        if not game.computer:
+            game.turn_started = None
+            await GraceScheduler().hold(game, not colour, self.owner)
+        GameRegistry().add(game)
+        await get_channel_layer().group_add(f"owner_{game.uuid}", self.owner)
+        if game.computer:
+            # the computer never left, its game goes on at once
+            await ClockScheduler().arm(game, self.owner)
+            await self.computer_turn(game)
+        await get_channel_layer().send(
+            event["channel"],
+            {
+                "type": "resumed",
+                "token": event["token"],
+                "owner": self.owner,
+                **game.snapshot(colour),
+            },
+        )
+
+    async def watch(self, event):
+        """Send the current view of the game to a spectator who just joined."""
+        game = GameRegistry().get(event["game_uuid"])
+        if not game:
+            await get_channel_layer().send(event["channel"], {"type": "gone"})
+            return
+
+        game.watched = True
+        await get_channel_layer().send(
+            event["channel"], {"type": "snapshot", **game.view()}
+        )
+
+    async def end_game(self, game):
+        """Drop the finished game, archive and rate it and announce the result."""
+        GameRegistry().remove(game.uuid)
+        await ClockScheduler().cancel(game.uuid)
+        await GraceScheduler().cancel(game.uuid)
+
+        channel_layer = get_channel_layer()
+        await channel_layer.group_discard(f"owner_{game.uuid}", self.owner)
+        metrics.FINISHED_GAMES.inc(game.result.get("by") or "draw")
+        GameArchive().add(game)
+        if game.white_user_id and game.black_user_id:
+            asyncio.ensure_future(ratings.rate_game(game))
+        await channel_layer.group_send(f"game_{game.uuid}", game.result)
+        if game.watched:
+            await self.notify_spectators(game, game.result)
+
+    async def notify_spectators(self, game, event):
+        """Send event, encoded once, to every process with spectators of game."""
+        await get_channel_layer().group_send(
+            f"watch_{game.uuid}", relay_event(event)
+        )
+
+
+class GameShardConsumer(GameShard, AsyncConsumer):
+    """Serves a shard's channel in a `manage.py runworker` process."""
+
+    async def __call__(self, scope, receive, send):
+        self.owner = scope["channel"]
+        await super().__call__(scope, receive, send)
+
+    async def dispatch(self, message):
+        await self.handle(message)
@@ -0,0 +1,100 @@
+import asyncio
+import json
+from channels.layers import get_channel_layer
+from . import wire
+
+# process-local spectator sockets, by the uuid of the game they watch
+watchers = {}
+# process-local relay channels and the tasks draining them, by game uuid
+relays = {}
+
+
+def colour_str(colour):
+    return "white" if colour else "black"
+
+
+def relay_event(event):
+    """Return a moved/inform_win/inform_draw event as ready-made frames.
+
+    The owner of the game encodes each frame once, in both wire formats, and
+    every spectator socket sends the one it speaks as is.
+    """
+    if event["type"] == "moved":
+        text_data = {
+            "command": "moved",
+            "san": event["san"],
+            "colour": colour_str(event["colour"]),
+            "white_time": event["white_time"],
+            "black_time": event["black_time"],
+            "ply": event["ply"],
+        }
+        bytes_data = wire.pack(
+            wire.MOVED,
+            event["move"],
+            event["colour"],
+            event["white_time"],
+            event["black_time"],
+            event["ply"],
+        )
+    elif event["type"] == "inform_win":
+        text_data = {
+            "command": "win",
+            "winner_colour": colour_str(event["winner_colour"]),
+            "by": event["by"],
+        }
+        bytes_data = wire.pack(wire.WIN, event["winner_colour"], event["by"])
+    else:
+        text_data = {"command": "draw"}
+        bytes_data = wire.pack(wire.DRAW)
+
+    return {
+        "type": "relay",
+        "ply": event.get("ply"),
+        "over": event["type"] != "moved",
+        "text_data": json.dumps(text_data),
+        "bytes_data": bytes_data,
+    }
+
+
+class SpectatorHub:
+    """Fans the moves of watched games out to this process's spectators.
+
+    Whatever the number of spectators, a process subscribes a single relay
+    channel per game to the watch_{uuid} group, so the owner of the game
+    sends each move once per process rather than once per spectator. The
+    relay hands the pre-encoded frames straight to the local sockets.
+    """
+
+    async def join(self, consumer):
+        game_uuid = consumer.game_uuid
+        watchers.setdefault(game_uuid, set()).add(consumer)
+        if game_uuid in relays:
+            return
+
+        channel_layer = get_channel_layer()
+        channel = await channel_layer.new_channel()
+        task = asyncio.ensure_future(self.relay(game_uuid, channel))
+        relays[game_uuid] = (channel, task)
+        await channel_layer.group_add(f"watch_{game_uuid}", channel)
+
+    async def leave(self, consumer):
+        game_uuid = consumer.game_uuid
+        sockets = watchers.get(game_uuid)
+        if sockets is None:
+            return
+
+        sockets.discard(consumer)
+        if sockets:
+            return
+
+        del watchers[game_uuid]
+        channel, task = relays.pop(game_uuid)
+        task.cancel()
+        await get_channel_layer().group_discard(f"watch_{game_uuid}", channel)
+
+    async def relay(self, game_uuid, channel):
+        channel_layer = get_channel_layer()
+        while True:
+            event = await channel_layer.receive(channel)
+            for consumer in list(watchers.get(game_uuid, ())):
+                await consumer.relay(event)
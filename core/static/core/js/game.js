@@ -2,29 +2,47 @@ $(document).ready(function () {
   var colour;
   var board;
   var game;
+  var duration;
   var userDeadline;
   var opponentDeadline;
   var userIntervalID;
   var opponentIntervalID;
   var gameover = false;
+  var gameSocket;
+  var resumeTimeoutID;
+  var premove = null; // move queued on the server for when our turn comes
+
+  const RECONNECT_DELAY = 1000; // in ms
+  const RESUME_TIMEOUT = 5000; // in ms
+  const PREMOVE_SQUARE = "#e0a060";
+  const PIECE_URLS = JSON.parse($("#piece-urls").text());
+
+  function showPremove() {
+    /*Highlight the squares of the queued premove.*/
+    if (!premove) return;
+    $("#myBoard .square-" + premove.from).css("background", PREMOVE_SQUARE);
+    $("#myBoard .square-" + premove.to).css("background", PREMOVE_SQUARE);
+  }
 
-  const DURATION = 10 * 60 * 1000; // in ms
-  const DUR_SEC = Math.floor((DURATION / 1000) % 60);
-  const DUR_MIN = Math.floor(DURATION / (1000 * 60));
-  const DUR_SEC_TEXT = DUR_SEC < 10 ? `0${DUR_SEC}` : DUR_SEC;
-  const DUR_MIN_TEXT = DUR_MIN < 10 ? `0${DUR_MIN}` : DUR_MIN;
+  function clearPremove() {
+    premove = null;
+    $("#myBoard .square-55d63").css("background", "");
+  }
 
-  function preStart(col, user, oppo) {
-    /*set var colour and gameover, hide play button, update opponent username, timers and show player containers.*/
+  function preStart(col, user, oppo, time) {
+    /*set var colour, duration and gameover, hide play button, update opponent username, timers and show player containers.*/
     colour = col;
+    duration = time;
     gameover = false;
     $("#play-btn").hide();
+    $("#computer-btn").hide();
+    $("#time-control").hide();
     $("#opponent-username").text(oppo);
-    $("#opponent-timer").text(`${DUR_MIN_TEXT}:${DUR_SEC_TEXT}`);
     $("#opponent-timer").removeClass("badge-warning badge-danger");
+    updateTimer(time, "#opponent-timer");
     $("#username").text(`You (${user})`);
-    $("#user-timer").text(`${DUR_MIN_TEXT}:${DUR_SEC_TEXT}`);
     $("#user-timer").removeClass("badge-warning badge-danger");
+    updateTimer(time, "#user-timer");
     $("#opponent-container").show();
     $("#user-container").show();
   }
@@ -37,6 +55,7 @@ $(document).ready(function () {
 
     function removeGreySquares() {
       $("#myBoard .square-55d63").css("background", "");
+      showPremove();
     }
 
     function greySquare(square) {
@@ -65,18 +84,33 @@ $(document).ready(function () {
         return false;
       }
 
-      // or if it's not that side's turn
-      if (
-        (game.turn() === "w" && piece.search(/^b/) !== -1) ||
-        (game.turn() === "b" && piece.search(/^w/) !== -1)
-      ) {
-        return false;
-      }
+      // pieces picked up during the opponent's turn are premoved
+    }
+
+    function onPremove(source, target) {
+      /*Queue a move of ours to be played on the server when our turn comes.*/
+      // the moves our pieces could make if it were our turn now, the server
+      // checks the premove is legal when it's played
+      const fields = game.fen().split(" ");
+      fields[1] = colour[0];
+      fields[3] = "-";
+      const ahead = new Chess(fields.join(" "));
+      const move = ahead.move({ from: source, to: target, promotion: "q" });
+      if (move === null) return;
+
+      premove = { from: move.from, to: move.to, promotion: move.promotion };
+      sendCommand("move", premove);
+      removeGreySquares();
     }
 
     function onDrop(source, target) {
       removeGreySquares();
 
+      if (game.turn() !== colour[0]) {
+        onPremove(source, target);
+        return "snapback";
+      }
+
       const isPromotion =
         game
           .moves({ verbose: true })
@@ -110,12 +144,7 @@ $(document).ready(function () {
       // illegal move
       if (move === null) return "snapback";
 
-      gameSocket.send(
-        JSON.stringify({
-          command: "move",
-          san: move["san"],
-        })
-      );
+      sendCommand("move", move);
     }
 
     function onMouseoverSquare(square, piece) {
@@ -166,22 +195,66 @@ $(document).ready(function () {
       onMouseoverSquare: onMouseoverSquare,
       onSnapEnd: onSnapEnd,
       orientation: colour,
+      pieceTheme: (piece) => PIECE_URLS[piece],
     };
     board = Chessboard("myBoard", config);
     $(window).resize(board.resize);
+
+    // right click takes the premove back
+    $("#myBoard").off("contextmenu").on("contextmenu", function (e) {
+      if (!premove) return;
+      e.preventDefault();
+      sendCommand("cancel_premove");
+      clearPremove();
+    });
   }
 
-  function moved(san, col, deadline) {
-    /*Update game and board, and start/stop timers.*/
+  function moved(san, col, whiteTime, blackTime) {
+    /*Update game and board, and start/stop timers from the ms left on each clock.*/
+    const userTime = colour === "white" ? whiteTime : blackTime;
+    const opponentTime = colour === "white" ? blackTime : whiteTime;
+    if (col === colour && game.turn() === colour[0]) {
+      // a move of ours not played here, the premove the server played as
+      // soon as the opponent moved
+      clearPremove();
+      game.move(san);
+      board.position(game.fen());
+    }
+
     if (col !== colour) {
       game.move(san);
       board.position(game.fen());
-      userDeadline = new Date(deadline);
       clearInterval(opponentIntervalID);
+      updateTimer(opponentTime, "#opponent-timer");
+      userDeadline = Date.now() + userTime;
       userIntervalID = setInterval(updateUserTimer, 100);
     } else {
-      opponentDeadline = new Date(deadline);
       clearInterval(userIntervalID);
+      updateTimer(userTime, "#user-timer");
+      opponentDeadline = Date.now() + opponentTime;
+      opponentIntervalID = setInterval(updateOpponentTimer, 100);
+    }
+  }
+
+  function resumed(data) {
+    /*Rebuild game, board and timers from the snapshot of a resumed game.*/
+    clearTimeout(resumeTimeoutID);
+    preStart(data.colour, data.client, data.opponent, data.time);
+    start();
+    for (const move of data.moves) game.move(move);
+    board.position(game.fen());
+
+    const userTime = colour === "white" ? data.white_time : data.black_time;
+    const opponentTime = colour === "white" ? data.black_time : data.white_time;
+    updateTimer(userTime, "#user-timer");
+    updateTimer(opponentTime, "#opponent-timer");
+
+    if (!data.running) return;
+    if (game.turn() === colour[0]) {
+      userDeadline = Date.now() + userTime;
+      userIntervalID = setInterval(updateUserTimer, 100);
+    } else {
+      opponentDeadline = Date.now() + opponentTime;
       opponentIntervalID = setInterval(updateOpponentTimer, 100);
     }
   }
@@ -189,9 +262,11 @@ $(document).ready(function () {
   function endGame() {
     /*Set var gameover, enable and show play button, and clear timer intervals.*/
     gameover = true;
+    clearPremove();
     $("#play-btn").prop("disabled", false);
     $("#play-btn").html("Play Again");
     $("#play-btn").show();
+    $("#time-control").show();
     clearInterval(userIntervalID);
     clearInterval(opponentIntervalID);
   }
@@ -203,22 +278,34 @@ $(document).ready(function () {
        Finding opponent...`
     );
 
-    gameSocket.send(JSON.stringify({ command: "find_opponent" }));
+    gameSocket.send(
+      JSON.stringify({
+        command: "find_opponent",
+        control: $("#time-control").val(),
+      })
+    );
+  });
+
+  // offered by the server once the player waited a while for an opponent
+  $("#computer-btn").click(function () {
+    $(this).hide();
+    gameSocket.send(JSON.stringify({ command: "play_computer" }));
   });
 
   function updateTimer(t, selector) {
+    // the server ends the game when a flag falls
+    if (t < 0) t = 0;
+
     const sec = Math.floor((t / 1000) % 60);
     const min = Math.floor((t / (1000 * 60)) % 60);
 
     const secText = sec < 10 ? `0${sec}` : sec;
     const minText = min < 10 ? `0${min}` : min;
 
-    if (t <= 0)
-      return gameSocket.send(JSON.stringify({ command: "end_if_timeout" }));
-    else if (t <= (DURATION / 100) * 10) {
+    if (t <= (duration / 100) * 10) {
       $(selector).addClass("badge-danger");
       $(selector).removeClass("badge-warning");
-    } else if (t <= (DURATION / 100) * 30)
+    } else if (t <= (duration / 100) * 30)
       $(selector).addClass("badge-warning");
 
     $(selector).text(`${minText}:${secText}`);
@@ -236,28 +323,244 @@ $(document).ready(function () {
     updateTimer(diff, "#opponent-timer");
   }
 
-  const gameSocket = new WebSocket(
-    "ws://" + window.location.host + "/ws/game/"
-  );
+  /* Compact msgpack frames, used when the server picks the chess.msgpack
+  subprotocol (see core/wire.py). Only the msgpack types the server sends
+  are decoded. */
+  const COMMANDS = [
+    "find_opponent",
+    "move",
+    "end_if_timeout",
+    "cancel_premove",
+  ];
+  const FILES = "abcdefgh";
+  const PROMOTIONS = [null, null, "n", "b", "r", "q"];
+
+  function squareIndex(name) {
+    return FILES.indexOf(name[0]) + (parseInt(name[1]) - 1) * 8;
+  }
+
+  function squareName(index) {
+    return FILES[index % 8] + (Math.floor(index / 8) + 1);
+  }
+
+  function encodeMove(move) {
+    const promotion = move.promotion ? PROMOTIONS.indexOf(move.promotion) : 0;
+    return (
+      squareIndex(move.from) | (squareIndex(move.to) << 6) | (promotion << 12)
+    );
+  }
+
+  function decodeMove(code) {
+    return {
+      from: squareName(code & 63),
+      to: squareName((code >> 6) & 63),
+      promotion: PROMOTIONS[code >> 12] || undefined,
+    };
+  }
+
+  function packInts(ints) {
+    const bytes = [0x90 | ints.length];
+    for (const n of ints) {
+      if (n < 0x80) bytes.push(n);
+      else bytes.push(0xcd, n >> 8, n & 0xff);
+    }
+    return new Uint8Array(bytes);
+  }
+
+  function unpack(buffer) {
+    const view = new DataView(buffer);
+    let offset = 0;
+
+    function readString(length) {
+      const bytes = new Uint8Array(buffer, offset, length);
+      offset += length;
+      return new TextDecoder().decode(bytes);
+    }
+
+    function readArray(length) {
+      const items = [];
+      for (let i = 0; i < length; i++) items.push(read());
+      return items;
+    }
+
+    function read() {
+      const type = view.getUint8(offset++);
+      if (type < 0x80) return type;
+      if (type >= 0xe0) return type - 0x100;
+      if ((type & 0xe0) === 0xa0) return readString(type & 0x1f);
+      if ((type & 0xf0) === 0x90) return readArray(type & 0x0f);
+
+      offset += { 0xcc: 1, 0xcd: 2, 0xce: 4, 0xcf: 8, 0xdc: 2 }[type] || 0;
+      switch (type) {
+        case 0xc0:
+          return null;
+        case 0xc2:
+          return false;
+        case 0xc3:
+          return true;
+        case 0xcc:
+          return view.getUint8(offset - 1);
+        case 0xcd:
+          return view.getUint16(offset - 2);
+        case 0xce:
+          return view.getUint32(offset - 4);
+        case 0xcf:
+          return (
+            view.getUint32(offset - 8) * 2 ** 32 + view.getUint32(offset - 4)
+          );
+        case 0xd9:
+          return readString(view.getUint8(offset++));
+        case 0xdc:
+          return readArray(view.getUint16(offset - 2));
+      }
+      throw new Error(`Unsupported msgpack type ${type}`);
+    }
+
+    return read();
+  }
+
+  function decodeFrame(buffer) {
+    /*Return a binary frame as the object its JSON counterpart parses to.*/
+    const fields = unpack(buffer);
+    const colourStr = (b) => (b ? "white" : "black");
+
+    switch (fields[0]) {
+      case 0:
+        return {
+          command: "start",
+          client: fields[1],
+          colour: colourStr(fields[2]),
+          opponent: fields[3],
+          game: fields[4],
+          token: fields[5],
+          time: fields[6],
+          increment: fields[7],
+        };
+      case 1:
+        return {
+          command: "moved",
+          san: decodeMove(fields[1]),
+          colour: colourStr(fields[2]),
+          white_time: fields[3],
+          black_time: fields[4],
+        };
+      case 2:
+        return {
+          command: "win",
+          winner_colour: colourStr(fields[1]),
+          by: fields[2],
+        };
+      case 3:
+        return { command: "draw" };
+      case 4:
+        return {
+          command: "resume",
+          game: fields[1],
+          client: fields[2],
+          token: fields[3],
+          colour: colourStr(fields[4]),
+          opponent: fields[5],
+          fen: fields[6],
+          moves: fields[7].map(decodeMove),
+          white_time: fields[8],
+          black_time: fields[9],
+          running: fields[10],
+          time: fields[11],
+          increment: fields[12],
+        };
+      case 7:
+        return { command: "premove_dropped" };
+      case 8:
+        return { command: "computer_offered" };
+      case 9:
+        return { command: "resume_refused" };
+    }
+  }
+
+  function sendCommand(command, move) {
+    if (gameSocket.protocol === "chess.msgpack") {
+      const fields = [COMMANDS.indexOf(command)];
+      if (move) fields.push(encodeMove(move));
+      gameSocket.send(packInts(fields));
+    } else {
+      const data = { command: command };
+      // premoves have no SAN yet, they're sent as move codes
+      if (move && move.san) data.san = move.san;
+      else if (move) data.move = encodeMove(move);
+      gameSocket.send(JSON.stringify(data));
+    }
+  }
+
+  function resume(seat) {
+    /*Ask the server for the seat held since the socket dropped.*/
+    $("#play-btn").prop("disabled", true);
+    $("#play-btn").html(
+      `<span class="spinner-border spinner-border-sm" role="status" aria-hidden="true"></span>
+       Reconnecting...`
+    );
+    gameSocket.send(
+      JSON.stringify({ command: "resume", game: seat.game, token: seat.token })
+    );
+
+    // the game ended while we were away
+    resumeTimeoutID = setTimeout(resumeRefused, RESUME_TIMEOUT);
+  }
+
+  function resumeRefused() {
+    /*Forget the seat that can't be taken back.*/
+    clearTimeout(resumeTimeoutID);
+    sessionStorage.removeItem("seat");
+    endGame();
+  }
 
-  gameSocket.onmessage = function (e) {
-    const data = JSON.parse(e.data);
+  function onMessage(e) {
+    const data =
+      e.data instanceof ArrayBuffer ? decodeFrame(e.data) : JSON.parse(e.data);
 
     if (data.command === "start") {
-      preStart(data.colour, data.client, data.opponent);
+      sessionStorage.setItem(
+        "seat",
+        JSON.stringify({ game: data.game, token: data.token })
+      );
+      preStart(data.colour, data.client, data.opponent, data.time);
       start();
-    } else if (data.command === "moved")
-      moved(data.san, data.colour, data.deadline);
+    } else if (data.command === "resume") resumed(data);
+    else if (data.command === "resume_refused") resumeRefused();
+    else if (data.command === "moved")
+      moved(data.san, data.colour, data.white_time, data.black_time);
+    else if (data.command === "premove_dropped") clearPremove();
+    else if (data.command === "computer_offered") $("#computer-btn").show();
     else if (data.command === "win") {
+      sessionStorage.removeItem("seat");
       endGame();
       alert(data.winner_colour + " win by " + data.by);
     } else if (data.command === "draw") {
+      sessionStorage.removeItem("seat");
       endGame();
       alert("Draw");
     }
-  };
+  }
+
+  function connect() {
+    gameSocket = new WebSocket(
+      "ws://" + window.location.host + "/ws/game/",
+      ["chess.msgpack", "chess.json"]
+    );
+    gameSocket.binaryType = "arraybuffer";
+    gameSocket.onmessage = onMessage;
+
+    gameSocket.onopen = function () {
+      const seat = JSON.parse(sessionStorage.getItem("seat"));
+      if (seat) resume(seat);
+    };
+
+    gameSocket.onclose = function (e) {
+      console.error("Game socket closed unexpectedly, reconnecting");
+      clearInterval(userIntervalID);
+      clearInterval(opponentIntervalID);
+      setTimeout(connect, RECONNECT_DELAY);
+    };
+  }
 
-  gameSocket.onclose = function (e) {
-    console.error("Chat socket closed unexpectedly");
-  };
+  connect();
 });
@@ -0,0 +1,16 @@
+from django import template
+from django.utils.html import format_html_join
+from .. import assets
+
+register = template.Library()
+
+
+@register.simple_tag
+def bundle(name):
+    """Load a bundle of GAME_ASSET_BUNDLES, its built file once there is one."""
+    if name.endswith(".css"):
+        tag = '<link href="{}" rel="stylesheet">'
+    else:
+        tag = '<script type="text/javascript" src="{}"></script>'
+    return format_html_join("\n", tag, ((url,) for url in assets.bundle_urls(name)))
+
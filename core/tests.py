@@ -1,3 +1,1337 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+import channels_redis
+import chess
+import django
+import msgpack
+import redis
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.messages import constants as message_constants
+from django.contrib.messages.storage.base import Message
+from django.contrib.messages.storage.cookie import MessageEncoder
+from django.core.asgi import get_asgi_application
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.urls import reverse
+from django.utils import timezone
+from users.models import DEFAULT_RATING
+
+from . import (
+    analysis,
+    archive,
+    assets,
+    consumers,
+    explorer,
+    handoff,
+    metrics,
+    models,
+    pgn,
+    ratings,
+    searcher,
+    shards,
+    wire,
+)
+from .games import Game, GameRegistry
+from .hashring import HashRing
+from .layers import HybridChannelLayer
+from .waiting_queue import WaitingQueue
+
+# white to mate in one with Qxf7#
+SCHOLARS_MATE_IN_ONE = (
+    "r1bqkb1r/pppp1ppp/2n2n2/4p2Q/2B1P3/8/PPPP1PPP/RNB1K1NR w KQkq - 4 4"
+)
+
+# scholar's mate, the moves each colour plays in turn
+SCRIPT = {
+    "white": ["e4", "Bc4", "Qh5", "Qxf7#"],
+    "black": ["e5", "Nc6", "Nf6"],
+}
+
+
+class HashRingTests(SimpleTestCase):
+    def test_spreads_keys(self):
+        ring = HashRing(["s1", "s2", "s3"])
+        owners = Counter(ring.get(f"game{n}") for n in range(3000))
+        self.assertEqual(set(owners), {"s1", "s2", "s3"})
+        for count in owners.values():
+            self.assertGreater(count, 700)
+
+    def test_adding_a_node_only_moves_its_keys(self):
+        before = HashRing(["s1", "s2", "s3"])
+        after = HashRing(["s1", "s2", "s3", "s4"])
+        keys = [f"game{n}" for n in range(3000)]
+        moved = [key for key in keys if before.get(key) != after.get(key)]
+        self.assertTrue(all(after.get(key) == "s4" for key in moved))
+        self.assertLess(len(moved), len(keys) / 3)
+
+
+class SearcherTests(SimpleTestCase):
+    def test_finds_mate_in_one(self):
+        result = searcher.search(SCHOLARS_MATE_IN_ONE, 3, 5)
+        self.assertEqual(result["mate"], 1)
+        self.assertEqual(result["pv"][0].uci(), "h5f7")
+
+    def test_scores_from_whites_point_of_view(self):
+        # black to move, a queen up
+        result = searcher.search("4k3/8/8/8/8/8/8/q3K3 b - - 0 1", 1, 5)
+        self.assertLess(result["score"], -800)
+
+
+class GameTests(SimpleTestCase):
+    def play(self, game, sans):
+        for san in sans:
+            self.assertTrue(game.move(game.board.turn, san))
+
+    def test_keeps_the_moves_packed_and_releases_the_board(self):
+        game = Game("g" * 32, "w" * 32, "b" * 32)
+        self.assertIsNone(game._board)
+        self.play(game, ["e4", "e5", "Bc4", "Nc6", "Qh5", "Nf6", "Qxf7#"])
+        self.assertEqual(game.board.move_stack, [])
+        self.assertEqual(len(game.moves), 7)
+        self.assertEqual(game.view()["sans"][-1], "Qxf7#")
+        self.assertEqual(Game.from_state(game.to_state()).board, game.board)
+
+        self.assertEqual(game.end_if_gameover()["by"], "checkmate")
+        self.assertIsNone(game._board)
+        self.assertEqual(
+            game.fen,
+            "r1bqkb1r/pppp1Qpp/2n2n2/4p3/2B1P3/8/PPPP1PPP/RNB1K1NR b KQkq - 0 4",
+        )
+
+    def test_adds_the_increment_to_the_clock_of_each_move(self):
+        game = Game("g" * 32, "w" * 32, "b" * 32, control="blitz_3_2")
+        base, increment = settings.GAME_TIME_CONTROLS["blitz_3_2"]
+        with mock.patch("core.games.clock", return_value=1000):
+            # white's first move starts the clocks, it costs no time
+            self.assertEqual(game.move(True, "e4")["white_time"], base + increment)
+        with mock.patch("core.games.clock", return_value=3500):
+            moved = game.move(False, "e5")
+        self.assertEqual(moved["black_time"], base - 2500 + increment)
+        self.assertEqual(moved["white_time"], base + increment)
+
+    def test_draws_by_repetition(self):
+        game = Game("g" * 32, "w" * 32, "b" * 32)
+        self.play(game, ["Nf3", "Nf6", "Ng1", "Ng8"] * 2)
+        self.assertEqual(game.end_if_gameover(), {"type": "inform_draw"})
+
+
+class GameShardTests(SimpleTestCase):
+    async def test_logs_a_failing_event_rather_than_raising(self):
+        game = Game("g" * 32, "w" * 32, "b" * 32)
+        GameRegistry().add(game)
+        self.addCleanup(GameRegistry().remove, game.uuid)
+        event = {
+            "type": "play_move",
+            "game_uuid": game.uuid,
+            "colour": True,
+            "san": 5,
+            "code": None,
+            "channel": None,
+        }
+        # in process and in a shard worker
+        with self.assertLogs("core.shards", "ERROR") as logs:
+            await shards.GameShard().handle(event)
+            await shards.GameShardConsumer().dispatch(event)
+        self.assertEqual(len(logs.records), 2)
+
+
+class ExplorerTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "explorer.idx")
+        self.settings_override = override_settings(GAME_EXPLORER_PATH=path)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def archive(self, moves, status="C", winner_colour=True):
+        models.Game.objects.create(
+            uuid=os.urandom(16).hex(),
+            white_uuid="w",
+            black_uuid="b",
+            status=status,
+            winner_colour=winner_colour,
+            moves=moves,
+            fen="",
+            created=timezone.now(),
+            ended=timezone.now(),
+        )
+
+    def explore(self, fen=chess.STARTING_FEN):
+        response = self.client.get(reverse("core:explorer"), {"fen": fen})
+        return {move["san"]: move for move in response.json()["moves"]}
+
+    def test_counts_the_moves_played_from_a_position(self):
+        self.archive("e2e4 e7e5 d1h5 b8c6 f1c4 g8f6 h5f7")
+        self.archive("e2e4 c7c5", "D", None)
+        self.archive("d2d4 d7d5", "T", False)
+        self.archive("d2d4", "A", False)
+        self.assertEqual(explorer.build(), 3)
+
+        moves = self.explore()
+        self.assertEqual(list(moves), ["e4", "d4"])
+        self.assertEqual(
+            [moves["e4"][result] for result in ("white", "draws", "black")],
+            [1, 1, 0],
+        )
+        after_e4 = self.explore(
+            "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq - 0 1"
+        )
+        self.assertEqual(set(after_e4), {"e5", "c5"})
+
+    def test_adds_new_games_incrementally(self):
+        self.archive("e2e4")
+        explorer.build()
+        self.archive("e2e4", winner_colour=False)
+        self.archive("g1f3")
+        self.assertEqual(explorer.build(), 2)
+
+        moves = self.explore()
+        self.assertEqual((moves["e4"]["white"], moves["e4"]["black"]), (1, 1))
+        self.assertEqual(moves["Nf3"]["games"], 1)
+        self.assertEqual(explorer.build(rebuild=True), 3)
+        self.assertEqual(self.explore()["e4"]["games"], 2)
+
+
+class AssetTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.settings_override = override_settings(GAME_ASSETS_ROOT=self.root)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+        cache.clear()
+
+    def read(self, name):
+        with open(os.path.join(self.root, name), "rb") as f:
+            return f.read()
+
+    def test_pages_load_the_sources_until_built(self):
+        content = self.client.get(reverse("core:home")).content.decode()
+        self.assertIn('src="/static/core/js/game.js"', content)
+        self.assertIn("/static/img/chesspieces/wikipedia/wK.png", content)
+
+    def test_builds_fingerprinted_compressed_bundles(self):
+        manifest = assets.build()
+        built = manifest["bundles"]["base.css"]
+        self.assertRegex(built, r"^build/base\.[0-9a-f]{12}\.css$")
+        css = self.read(built)
+        self.assertEqual(gzip.decompress(self.read(built + ".gz")), css)
+        # fonts are built too and the css points at them from build/
+        font = manifest["files"]["font/roboto/Roboto-Bold.woff2"]
+        self.assertIn(f"url({font[len('build/'):]})".encode(), css)
+        self.assertEqual(assets.build(), manifest)
+
+        content = self.client.get(reverse("core:home")).content.decode()
+        self.assertIn(f'href="/static/{built}"', content)
+        self.assertIn(manifest["bundles"]["home.js"], content)
+        self.assertIn(manifest["files"]["img/chesspieces/wikipedia/wK.png"], content)
+        self.assertNotIn("core/js/game.js", content)
+
+
+class HomeTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    # messages kept in the session leave the cookie header, the cache key, as is
+    @override_settings(
+        MESSAGE_STORAGE="django.contrib.messages.storage.session.SessionStorage"
+    )
+    def test_shows_a_flash_message_once_despite_the_cache(self):
+        self.client.get(reverse("core:home"))
+        session = self.client.session
+        session["_messages"] = MessageEncoder().encode(
+            [Message(message_constants.INFO, "Welcome back")]
+        )
+        session.save()
+
+        for shown in (True, False):
+            response = self.client.get(reverse("core:home"))
+            self.assertEqual("Welcome back" in response.content.decode(), shown)
+
+
+class PgnTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.alice = User.objects.create_user("alice")
+        self.bob = User.objects.create_user("bob")
+
+    def archive(self, moves, status, winner_colour, white=None, black=None):
+        board = chess.Board()
+        for uci in moves.split():
+            board.push_uci(uci)
+        models.Game.objects.create(
+            uuid=os.urandom(16).hex(),
+            white_uuid=os.urandom(16).hex(),
+            black_uuid=os.urandom(16).hex(),
+            white=white,
+            black=black,
+            status=status,
+            winner_colour=winner_colour,
+            moves=moves,
+            fen=board.fen(),
+            time_control="blitz_3_2",
+            created=timezone.now(),
+            ended=timezone.now(),
+        )
+
+    def export(self, **params):
+        response = self.client.get(reverse("core:export_pgn"), params)
+        return b"".join(response.streaming_content).decode()
+
+    def import_games(self, text):
+        with ThreadPoolExecutor(2) as executor:
+            progress = list(
+                pgn.import_games(
+                    io.StringIO(text).readlines(), executor, batch_size=2, window=2
+                )
+            )
+        return progress[-1] if progress else (0, 0)
+
+    def fields(self):
+        return sorted(
+            models.Game.objects.values_list(
+                "uuid",
+                "white__username",
+                "black__username",
+                "status",
+                "winner_colour",
+                "moves",
+                "fen",
+                "time_control",
+            )
+        )
+
+    def test_games_survive_a_round_trip(self):
+        self.archive(
+            "e2e4 e7e5 f1c4 b8c6 d1h5 g8f6 h5f7",
+            "C",
+            True,
+            white=self.alice,
+            black=self.bob,
+        )
+        self.archive("e2e4 e7e5", "D", None, white=self.bob)
+        self.archive("d2d4", "T", False, black=self.alice)
+        self.archive("", "A", True, white=self.alice, black=self.bob)
+        archived = self.fields()
+
+        text = self.export()
+        self.assertEqual(text.count("[Event "), 4)
+        models.Game.objects.all().delete()
+        self.assertEqual(self.import_games(text), (4, 4))
+        self.assertEqual(self.fields(), archived)
+        self.assertEqual(self.import_games(text), (4, 0))
+
+    def test_exports_the_games_of_a_user(self):
+        self.archive("e2e4", "A", True, white=self.alice)
+        self.archive("d2d4", "A", True, white=self.bob)
+        self.assertEqual(self.export(user="alice").count("[Event "), 1)
+
+    async def export_over_asgi(self, query):
+        communicator = ApplicationCommunicator(
+            get_asgi_application(),
+            {
+                "type": "http",
+                "method": "GET",
+                "path": reverse("core:export_pgn"),
+                "query_string": query,
+                "headers": [],
+            },
+        )
+        await communicator.send_input({"type": "http.request"})
+        start = await communicator.receive_output(5)
+        body = b""
+        more = True
+        while more:
+            chunk = await communicator.receive_output(5)
+            body += chunk.get("body", b"")
+            more = chunk.get("more_body", False)
+        return start["status"], body.decode()
+
+    def test_exports_under_asgi(self):
+        self.archive("e2e4", "A", True, white=self.alice)
+        self.archive("d2d4", "A", True, white=self.bob)
+        status, text = async_to_sync(self.export_over_asgi)(b"user=bob")
+        self.assertEqual(status, 200)
+        self.assertEqual(text.count("[Event "), 1)
+        self.assertIn('[White "bob"]', text)
+
+    def test_skips_games_with_illegal_moves(self):
+        text = (
+            '[White "alice"]\n[Black "bob"]\n[Result "1-0"]\n\n'
+            "1. e4 e5 2. Ke3 1-0\n\n"
+            '[White "bob"]\n[Black "alice"]\n[Result "0-1"]\n\n'
+            "1. f3 e5 2. g4 Qh4# 0-1\n"
+        )
+        self.assertEqual(self.import_games(text), (2, 1))
+        game = models.Game.objects.get()
+        self.assertEqual(
+            (game.white, game.status, game.winner_colour), (self.bob, "C", False)
+        )
+
+
+class RatingTests(TestCase):
+    def setUp(self):
+        User = get_user_model()
+        self.alice = User.objects.create_user("alice")
+        self.bob = User.objects.create_user("bob")
+
+    def game(self, white, black, winner_colour=None):
+        game = Game(
+            os.urandom(16).hex(),
+            os.urandom(16).hex(),
+            os.urandom(16).hex(),
+            white_user_id=white and white.pk,
+            black_user_id=black and black.pk,
+        )
+        if winner_colour is None:
+            game.finish()
+        else:
+            game.finish(winner_colour, "checkmate")
+        return game
+
+    def rating(self, user):
+        user.refresh_from_db(fields=["rating"])
+        return user.rating
+
+    def test_rates_the_games_of_a_batch_in_order(self):
+        ratings.rate(
+            [
+                self.game(self.alice, self.bob, True),
+                self.game(self.bob, self.alice),
+                self.game(self.alice, None, False),
+            ]
+        )
+
+        k = settings.GAME_RATING_K
+        alice = DEFAULT_RATING + k / 2
+        bob = DEFAULT_RATING - k / 2
+        change = k * (0.5 - ratings.expected_score(bob, alice))
+        self.assertAlmostEqual(self.rating(self.alice), alice - change)
+        self.assertAlmostEqual(self.rating(self.bob), bob + change)
+        self.assertGreater(change, 0)
+
+    def test_rates_a_finished_game_from_the_event_loop(self):
+        async_to_sync(ratings.rate_game)(self.game(self.alice, self.bob, False))
+        k = settings.GAME_RATING_K
+        self.assertEqual(self.rating(self.alice), DEFAULT_RATING - k / 2)
+        self.assertEqual(self.rating(self.bob), DEFAULT_RATING + k / 2)
+
+
+@override_settings(
+    GAME_ARCHIVE=True, GAME_ARCHIVE_BATCH_SIZE=2, GAME_ARCHIVE_FLUSH_INTERVAL=0.2
+)
+class ArchiveTests(TransactionTestCase):
+    """The writer thread, on a queue of 3 of the tests' own."""
+
+    def setUp(self):
+        for name, value in (
+            ("pending", queue.Queue(3)),
+            ("writer", None),
+            ("stopping", threading.Event()),
+            ("atexit", mock.Mock()),
+        ):
+            patcher = mock.patch.object(archive, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: archive.writer and archive.stop_writer())
+
+    def finished(self, count):
+        games = [Game(os.urandom(16).hex(), "w" * 32, "b" * 32) for _ in range(count)]
+        for game in games:
+            game.finish(True, "checkmate")
+        return games
+
+    def test_writes_full_batches_then_what_arrived_within_the_interval(self):
+        batches = []
+        bulk_create = models.Game.objects.bulk_create
+
+        def counted(games, **kwargs):
+            bulk_create(games, **kwargs)
+            batches.append(len(games))
+
+        with mock.patch.object(models.Game.objects, "bulk_create", counted):
+            for game in self.finished(3):
+                archive.GameArchive().add(game)
+            # the database isn't read meanwhile, sqlite would lock the writer out
+            deadline = time.monotonic() + 5
+            while sum(batches) < 3 and time.monotonic() < deadline:
+                time.sleep(0.05)
+        self.assertEqual(batches, [2, 1])
+        self.assertEqual(models.Game.objects.count(), 3)
+
+    @override_settings(GAME_ARCHIVE_FLUSH_INTERVAL=60)
+    def test_writes_the_queued_games_when_stopped(self):
+        for game in self.finished(3):
+            archive.GameArchive().add(game)
+        archive.stop_writer()
+        self.assertFalse(archive.writer.is_alive())
+        self.assertEqual(models.Game.objects.count(), 3)
+
+    def test_drops_games_while_the_queue_is_full(self):
+        games = self.finished(4)
+        with mock.patch.object(archive, "start_writer"):
+            with self.assertLogs("core.archive", "WARNING") as logs:
+                for game in games:
+                    archive.GameArchive().add(game)
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn(games[-1].uuid, logs.output[0])
+        self.assertEqual(archive.pending.qsize(), 3)
+        self.assertEqual(models.Game.objects.count(), 0)
+
+
+def redis_running():
+    host, port = settings.REDIS_HOSTS[0]
+    try:
+        return redis.Redis(host=host, port=port).ping()
+    except redis.ConnectionError:
+        return False
+
+
+# a redis db of the tests' own, clearing its waiting queues leaves a dev
+# server's players alone
+TEST_REDIS_DB = 15
+
+# the tests playing games archive none of them, the writer would flush them
+# into the dev database once the test one is gone
+isolated = override_settings(REDIS_DB=TEST_REDIS_DB, GAME_ARCHIVE=False)
+
+
+@unittest.skipUnless(redis_running(), "redis is not running")
+@isolated
+class AnalysisTests(SimpleTestCase):
+    def setUp(self):
+        analysis.cache.clear()
+        analysis.buckets.clear()
+
+    async def analyse(self, client, fen, depth=2):
+        await client.send_json_to({"command": "analyse", "fen": fen, "depth": depth})
+        return await client.receive_json_from(10)
+
+    async def connect(self):
+        client = WebsocketCommunicator(
+            consumers.AsyncGameConsumer.as_asgi(), "/ws/game/"
+        )
+        await client.connect()
+        return client
+
+    async def test_analyses_and_caches_positions(self):
+        client = await self.connect()
+        first = await self.analyse(client, SCHOLARS_MATE_IN_ONE)
+        self.assertEqual((first["mate"], first["moves"]), (1, ["Qxf7#"]))
+        self.assertEqual(len(analysis.cache), 1)
+        # the same position reached by other moves is answered from the cache
+        second = await self.analyse(client, SCHOLARS_MATE_IN_ONE.replace("4 4", "8 6"))
+        self.assertEqual(second["moves"], ["Qxf7#"])
+        self.assertEqual(len(analysis.cache), 1)
+        await client.disconnect()
+
+    @override_settings(GAME_ANALYSIS_BURST=1, GAME_ANALYSIS_RATE=0)
+    async def test_rate_limits_users(self):
+        client = await self.connect()
+        allowed = await self.analyse(client, SCHOLARS_MATE_IN_ONE)
+        self.assertEqual(allowed["error"], "")
+        limited = await self.analyse(client, chess.STARTING_FEN)
+        self.assertEqual(limited["error"], "limited")
+        await client.disconnect()
+
+    async def test_rejects_invalid_positions(self):
+        client = await self.connect()
+        self.assertEqual((await self.analyse(client, "8/8/8/8"))["error"], "invalid")
+        await client.disconnect()
+
+
+@unittest.skipUnless(redis_running(), "redis is not running")
+@isolated
+class HybridChannelLayerTests(SimpleTestCase):
+    def setUp(self):
+        async_to_sync(WaitingQueue("bullet").clear)()
+
+    def sent(self):
+        return dict(metrics.CHANNEL_MESSAGES.values)
+
+    async def test_delivers_to_the_channels_of_its_process_in_memory(self):
+        # two processes' layers
+        here = HybridChannelLayer(hosts=settings.REDIS_HOSTS)
+        there = HybridChannelLayer(hosts=settings.REDIS_HOSTS)
+        mine, theirs = await here.new_channel(), await there.new_channel()
+        receiving = asyncio.ensure_future(here.receive(mine))
+        await asyncio.sleep(0.1)
+
+        await there.send(mine, {"type": "remote"})
+        self.assertEqual(await asyncio.wait_for(receiving, 5), {"type": "remote"})
+
+        receiving = asyncio.ensure_future(here.receive(mine))
+        group = f"layer-test-{os.urandom(8).hex()}"
+        for channel in (mine, theirs):
+            await here.group_add(group, channel)
+        before = self.sent()
+        await here.group_send(group, {"type": "moved", "ply": 1})
+        sent = self.sent()
+        self.assertEqual(sent[("memory",)] - before.get(("memory",), 0), 1)
+        self.assertEqual(sent[("redis",)] - before.get(("redis",), 0), 1)
+        self.assertEqual((await asyncio.wait_for(receiving, 5))["ply"], 1)
+        self.assertEqual((await there.receive(theirs))["ply"], 1)
+
+        for channel in (mine, theirs):
+            await here.group_discard(group, channel)
+        popping = here.popping
+        await here.close_pools()
+        await there.close_pools()
+        self.assertTrue(popping.cancelled())
+
+    def test_matches_the_channels_redis_it_was_written_for(self):
+        # the layer reuses private parts of this version, see its docstring
+        self.assertEqual(channels_redis.__version__, "3.3.1")
+
+    async def test_pairs_players_of_the_same_process_first(self):
+        queue = WaitingQueue("bullet")
+        # a bucket below and above, too far apart to pair with each other
+        below = DEFAULT_RATING - settings.GAME_RATING_BUCKET
+        above = DEFAULT_RATING + settings.GAME_RATING_BUCKET
+
+        with mock.patch("core.waiting_queue.PROCESS", "elsewhere"):
+            await queue.match("remote", below)
+        await queue.match("local", above)
+        self.assertEqual((await queue.match("new", DEFAULT_RATING, 1))[0], "local")
+        self.assertEqual((await queue.match("next", DEFAULT_RATING, 1))[0], "remote")
+
+        with override_settings(GAME_MATCH_COLOCATE=False):
+            with mock.patch("core.waiting_queue.PROCESS", "elsewhere"):
+                await queue.match("remote", below)
+            await queue.match("local", above)
+            new = await queue.match("new", DEFAULT_RATING, 1)
+            self.assertEqual(new[0], "remote")
+        await queue.clear()
+
+
+@unittest.skipUnless(redis_running(), "redis is not running")
+@isolated
+class WaitingQueueTests(SimpleTestCase):
+    def setUp(self):
+        async_to_sync(WaitingQueue("bullet").clear)()
+
+    async def test_pairs_clients_joining_at_once_with_each_other(self):
+        queue = WaitingQueue("bullet")
+        clients = [f"client{n}" for n in range(20)]
+        opponents = await asyncio.gather(
+            *(queue.match(client, DEFAULT_RATING) for client in clients)
+        )
+
+        pairs = [
+            (client, opponent[0])
+            for client, opponent in zip(clients, opponents)
+            if opponent
+        ]
+        self.assertEqual(len(pairs), 10)
+        paired = [client for pair in pairs for client in pair]
+        self.assertCountEqual(paired, clients)
+        self.assertEqual(await queue.count(), 0)
+
+    async def test_keeps_a_queue_per_time_control(self):
+        bullet, blitz = WaitingQueue("bullet"), WaitingQueue("blitz")
+        await blitz.clear()
+        self.assertIsNone(await bullet.match("bullet", DEFAULT_RATING))
+        self.assertIsNone(await blitz.match("blitz", DEFAULT_RATING))
+        self.assertEqual((await bullet.count(), await blitz.count()), (1, 1))
+
+        self.assertEqual(await blitz.match("next", DEFAULT_RATING), ("blitz", None))
+        self.assertEqual(await bullet.count(), 1)
+        await bullet.clear()
+
+    async def test_widens_the_search_with_the_wait(self):
+        queue = WaitingQueue("bullet")
+        await queue.match("far", DEFAULT_RATING + 3 * settings.GAME_RATING_BUCKET)
+        self.assertIsNone(await queue.match("near", DEFAULT_RATING))
+        self.assertIsNone(
+            await queue.match("near", DEFAULT_RATING, radius=2, waiting=True)
+        )
+        self.assertEqual(
+            await queue.match("near", DEFAULT_RATING, radius=3, waiting=True),
+            ("far", None),
+        )
+        self.assertEqual(await queue.count(), 0)
+
+    async def test_never_pairs_a_client_rejoining_elsewhere_with_itself(self):
+        queue = WaitingQueue("bullet")
+        await queue.match("A", DEFAULT_RATING)
+        self.assertEqual(await queue.match("B", DEFAULT_RATING), ("A", None))
+        # A's entry in the common list of its old bucket is left behind
+        rating = DEFAULT_RATING - settings.GAME_RATING_BUCKET / 2
+        self.assertIsNone(await queue.match("A", rating))
+        self.assertIsNone(await queue.match("A", rating, radius=1, waiting=True))
+        self.assertTrue(await queue.search("A"))
+
+        self.assertEqual(
+            await queue.match("C", DEFAULT_RATING, radius=1), ("A", None)
+        )
+
+    def test_widens_the_radius_every_few_seconds_up_to_a_limit(self):
+        consumer = consumers.AsyncGameConsumer()
+        every = settings.GAME_MATCH_WIDEN_EVERY
+        for waited, radius in (
+            (0, 0),
+            (every - 0.1, 0),
+            (2.5 * every, 2),
+            (1000 * every, settings.GAME_MATCH_MAX_RADIUS),
+        ):
+            consumer.queued_at = time.monotonic() - waited
+            self.assertEqual(consumer.search_radius(), radius)
+
+
+@unittest.skipUnless(redis_running(), "redis is not running")
+@isolated
+class LoadTestTests(SimpleTestCase):
+    def test_stores_the_results_of_every_run(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        results = os.path.join(directory.name, "loadtest.jsonl")
+        for _ in range(2):
+            out = io.StringIO()
+            call_command(
+                "loadtest",
+                players=4,
+                plies=6,
+                ramp=0,
+                poll=0.05,
+                results=results,
+                stdout=out,
+            )
+
+        with open(results) as f:
+            runs = [json.loads(line) for line in f]
+        self.assertEqual(len(runs), 2)
+        self.assertGreater(runs[1]["moves_per_sec"], 0)
+        self.assertIn("compared with", out.getvalue())
+
+    def test_refuses_an_odd_number_of_players(self):
+        with self.assertRaisesMessage(CommandError, "--players"):
+            call_command("loadtest", players=3)
+
+
+async def start_game(control="blitz_3_2"):
+    """Return the communicators of two players matched with each other.
+
+    Each is given the start frame it received as its start attribute.
+    """
+    await WaitingQueue(control).clear()
+    app = consumers.AsyncGameConsumer.as_asgi()
+    players = []
+    for _ in range(2):
+        client = WebsocketCommunicator(app, "/ws/game/")
+        await client.connect()
+        await client.send_json_to({"command": "find_opponent", "control": control})
+        players.append(client)
+        # the first player waits in the queue before the second looks
+        await asyncio.sleep(0.1)
+    for client in players:
+        client.start = await client.receive_json_from(5)
+    white, black = sorted(players, key=lambda c: c.start["colour"] != "white")
+    return white, black
+
+
+@unittest.skipUnless(redis_running(), "redis is not running")
+@isolated
+class WireTests(SimpleTestCase):
+    """A player on the msgpack protocol against one on JSON."""
+
+    async def connect(self, app, *subprotocols):
+        client = WebsocketCommunicator(app, "/ws/game/", subprotocols=subprotocols)
+        connected, subprotocol = await client.connect()
+        self.assertTrue(connected)
+        return client, subprotocol
+
+    async def receive_packed(self, client):
+        return msgpack.unpackb(await client.receive_from(5))
+
+    def test_unpacks_commands_as_their_json_counterparts(self):
+        code = wire.encode_move(chess.Move.from_uci("e7e8q"))
+        self.assertEqual(wire.decode_move(code), chess.Move.from_uci("e7e8q"))
+        self.assertEqual(
+            wire.unpack_command(wire.pack(wire.MOVE, code)),
+            {"command": "move", "move": code},
+        )
+        self.assertEqual(
+            wire.unpack_command(wire.pack(wire.FIND_OPPONENT)),
+            {"command": "find_opponent"},
+        )
+
+    async def test_packs_the_frames_the_json_protocol_sends(self):
+        # binary find_opponent frames play the default control
+        await WaitingQueue().clear()
+        app = consumers.AsyncGameConsumer.as_asgi()
+        packed, subprotocol = await self.connect(app, wire.MSGPACK_SUBPROTOCOL)
+        self.assertEqual(subprotocol, wire.MSGPACK_SUBPROTOCOL)
+        await packed.send_to(bytes_data=wire.pack(wire.FIND_OPPONENT))
+        await asyncio.sleep(0.1)
+        plain, subprotocol = await self.connect(app, wire.JSON_SUBPROTOCOL)
+        self.assertEqual(subprotocol, wire.JSON_SUBPROTOCOL)
+        await plain.send_json_to({"command": "find_opponent"})
+
+        start = await self.receive_packed(packed)
+        plain_start = await plain.receive_json_from(5)
+        opcode, client, colour, opponent, game, token, base, increment = start
+        self.assertEqual(opcode, wire.START)
+        self.assertEqual(
+            (opponent, game, base, increment),
+            (
+                plain_start["client"],
+                plain_start["game"],
+                plain_start["time"],
+                plain_start["increment"],
+            ),
+        )
+        self.assertEqual(client, plain_start["opponent"])
+        self.assertEqual(colour, plain_start["colour"] == "black")
+
+        # whoever is white opens with e4
+        board = chess.Board()
+        code = wire.encode_move(board.parse_san("e4"))
+        if colour:
+            await packed.send_to(bytes_data=wire.pack(wire.MOVE, code))
+        else:
+            await plain.send_json_to({"command": "move", "san": "e4"})
+        moved = await self.receive_packed(packed)
+        plain_moved = await plain.receive_json_from(5)
+        self.assertEqual(moved[:3], [wire.MOVED, code, True])
+        self.assertEqual(board.san(wire.decode_move(moved[1])), plain_moved["san"])
+        self.assertEqual(
+            moved[3:], [plain_moved["white_time"], plain_moved["black_time"]]
+        )
+
+        # the msgpack player comes back on a new socket
+        await packed.disconnect()
+        packed, _ = await self.connect(app, wire.MSGPACK_SUBPROTOCOL)
+        await packed.send_json_to({"command": "resume", "game": game, "token": token})
+        resumed = await self.receive_packed(packed)
+        self.assertEqual(resumed[:5], [wire.RESUME, game, client, token, colour])
+        board.push_san("e4")
+        self.assertEqual(resumed[5:8], [opponent, board.fen(), [code]])
+        for client in (packed, plain):
+            await client.disconnect()
+
+    async def test_closes_a_socket_sending_a_malformed_binary_frame(self):
+        app = consumers.AsyncGameConsumer.as_asgi()
+        for frame in (b"\xc1", wire.pack(wire.MOVE, "e4"), wire.pack(99)):
+            client, _ = await self.connect(app, wire.MSGPACK_SUBPROTOCOL)
+            await client.send_to(bytes_data=frame)
+            closed = await client.receive_output(5)
+            self.assertEqual(closed, {"type": "websocket.close", "code": 1003})
+            await client.disconnect()
+
+
+@unittest.skipUnless(redis_running(), "redis is not running")
+@isolated
+class ClockTests(SimpleTestCase):
+    @override_settings(
+        GAME_TIME_CONTROLS={**settings.GAME_TIME_CONTROLS, "tiny": (300, 0)}
+    )
+    async def test_ends_the_game_on_time_without_the_clients_asking(self):
+        white, black = await start_game("tiny")
+        await white.send_json_to({"command": "move", "san": "e4"})
+        for client in (white, black):
+            self.assertEqual((await client.receive_json_from(5))["san"], "e4")
+        # black never moves and nobody sends end_if_timeout
+        for client in (white, black):
+            self.assertEqual(
+                await client.receive_json_from(5),
+                {"command": "win", "winner_colour": "white", "by": "timeout"},
+            )
+            await client.disconnect()
+
+
+@unittest.skipUnless(redis_running(), "redis is not running")
+@isolated
+class SpectatorTests(SimpleTestCase):
+    async def test_sends_a_snapshot_then_only_the_moves(self):
+        white, black = await start_game()
+        for mover, san in ((white, "e4"), (black, "e5")):
+            await mover.send_json_to({"command": "move", "san": san})
+            for client in (white, black):
+                await client.receive_json_from(5)
+
+        game_uuid = white.start["game"]
+        spectator = WebsocketCommunicator(
+            consumers.SpectatorConsumer.as_asgi(), f"/ws/watch/{game_uuid}/"
+        )
+        spectator.scope["url_route"] = {"kwargs": {"game_uuid": game_uuid}}
+        await spectator.connect()
+        snapshot = await spectator.receive_json_from(5)
+        self.assertEqual(
+            (snapshot["command"], snapshot["moves"], snapshot["ply"]),
+            ("watch", ["e4", "e5"], 2),
+        )
+
+        await white.send_json_to({"command": "move", "san": "Nf3"})
+        moved = await spectator.receive_json_from(5)
+        self.assertEqual(
+            (moved["command"], moved["san"], moved["ply"]), ("moved", "Nf3", 3)
+        )
+        self.assertNotIn("moves", moved)
+        self.assertTrue(await spectator.receive_nothing(0.2))
+        for client in (white, black, spectator):
+            await client.disconnect()
+
+    @override_settings(GAME_WATCH_TIMEOUT=0.2)
+    async def test_closes_a_spectator_of_a_game_that_is_gone(self):
+        white, black = await start_game()
+        await white.disconnect()
+        await black.disconnect()
+        for game_uuid in ("f" * 32, white.start["game"]):
+            spectator = WebsocketCommunicator(
+                consumers.SpectatorConsumer.as_asgi(), f"/ws/watch/{game_uuid}/"
+            )
+            spectator.scope["url_route"] = {"kwargs": {"game_uuid": game_uuid}}
+            await spectator.connect()
+            self.assertEqual(await spectator.receive_json_from(5), {"command": "gone"})
+            closed = await spectator.receive_output(5)
+            self.assertEqual(closed["type"], "websocket.close")
+            await spectator.disconnect()
+
+
+@unittest.skipUnless(redis_running(), "redis is not running")
+@isolated
+class MetricsTests(SimpleTestCase):
+    async def play_scholars_mate(self):
+        white, black = await start_game()
+        for white_san, black_san in zip(SCRIPT["white"], SCRIPT["black"] + [None]):
+            for mover, san in ((white, white_san), (black, black_san)):
+                if san:
+                    await mover.send_json_to({"command": "move", "san": san})
+                    for client in (white, black):
+                        await client.receive_json_from(5)
+        for client in (white, black):
+            self.assertEqual((await client.receive_json_from(5))["by"], "checkmate")
+            await client.disconnect()
+
+    def test_counts_the_finished_games(self):
+        before = metrics.FINISHED_GAMES.values.get(("checkmate",), 0)
+        async_to_sync(self.play_scholars_mate)()
+
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        text = response.content.decode()
+        self.assertIn("# TYPE chess_finished_games_total counter\n", text)
+        self.assertIn(
+            f'chess_finished_games_total{{result="checkmate"}} {before + 1}\n', text
+        )
+        self.assertIn("# TYPE chess_waiting_players gauge\n", text)
+
+    @override_settings(GAME_METRICS=False)
+    def test_hides_the_metrics_when_off(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 404)
+
+
+@unittest.skipUnless(redis_running(), "redis is not running")
+@isolated
+class PremoveTests(SimpleTestCase):
+    async def premove(self, client, uci):
+        code = wire.encode_move(chess.Move.from_uci(uci))
+        await client.send_json_to({"command": "move", "move": code})
+
+    async def test_plays_a_premove_when_the_opponent_moves(self):
+        white, black = await start_game()
+        await self.premove(black, "e7e5")
+        await asyncio.sleep(0.1)
+        await white.send_json_to({"command": "move", "san": "e4"})
+
+        base, increment = settings.GAME_TIME_CONTROLS["blitz_3_2"]
+        for client in (white, black):
+            self.assertEqual((await client.receive_json_from(5))["san"], "e4")
+            premoved = await client.receive_json_from(5)
+            self.assertEqual((premoved["san"], premoved["colour"]), ("e5", "black"))
+            # black's clock wasn't charged for it
+            self.assertEqual(premoved["black_time"], base + increment)
+        await white.disconnect()
+        await black.disconnect()
+
+    async def test_drops_a_premove_illegal_when_its_turn_comes(self):
+        white, black = await start_game()
+        await white.send_json_to({"command": "move", "san": "e4"})
+        await black.receive_json_from(5)
+        await black.send_json_to({"command": "move", "san": "e5"})
+        await black.receive_json_from(5)
+        # the second premove replaces the first, the e4 pawn is in its way
+        await self.premove(black, "b8c6")
+        await self.premove(black, "e5e4")
+        await asyncio.sleep(0.1)
+        await white.send_json_to({"command": "move", "san": "Nf3"})
+
+        self.assertEqual((await black.receive_json_from(5))["san"], "Nf3")
+        self.assertEqual(
+            await black.receive_json_from(5), {"command": "premove_dropped"}
+        )
+        await white.disconnect()
+        await black.disconnect()
+
+
+@unittest.skipUnless(redis_running(), "redis is not running")
+@isolated
+class ResumeTests(SimpleTestCase):
+    async def resume(self, game_uuid, token):
+        client = WebsocketCommunicator(
+            consumers.AsyncGameConsumer.as_asgi(), "/ws/game/"
+        )
+        await client.connect()
+        await client.send_json_to(
+            {"command": "resume", "game": game_uuid, "token": token}
+        )
+        return client, await client.receive_json_from(5)
+
+    @override_settings(GAME_RECONNECT_GRACE=0.2)
+    async def test_resumes_before_the_old_socket_drops(self):
+        white, black = await start_game()
+        await white.send_json_to({"command": "move", "san": "e4"})
+        for client in (white, black):
+            await client.receive_json_from(5)
+
+        resumed, snapshot = await self.resume(white.start["game"], white.start["token"])
+        self.assertEqual(
+            (snapshot["command"], snapshot["colour"], snapshot["moves"]),
+            ("resume", "white", ["e4"]),
+        )
+        # the server only now sees the old socket drop, the seat isn't held
+        await white.disconnect()
+        await asyncio.sleep(0.4)
+        await black.send_json_to({"command": "move", "san": "e5"})
+        self.assertEqual((await resumed.receive_json_from(5))["san"], "e5")
+        await resumed.send_json_to({"command": "move", "san": "Nf3"})
+        self.assertEqual((await resumed.receive_json_from(5))["san"], "Nf3")
+        await resumed.disconnect()
+        await black.disconnect()
+
+    async def test_refuses_a_token_of_neither_seat(self):
+        white, black = await start_game()
+        client, refused = await self.resume(white.start["game"], "0" * 32)
+        self.assertEqual(refused, {"command": "resume_refused"})
+        for client in (client, white, black):
+            await client.disconnect()
+
+    @override_settings(GAME_RECONNECT_GRACE=0.2)
+    async def test_abandons_the_game_once_the_grace_is_over(self):
+        white, black = await start_game()
+        await white.disconnect()
+        self.assertEqual(
+            await black.receive_json_from(5),
+            {"command": "win", "winner_colour": "black", "by": "abandonment"},
+        )
+        await black.disconnect()
+
+
+@unittest.skipUnless(redis_running(), "redis is not running")
+@isolated
+class FrameLimitTests(SimpleTestCase):
+    async def connect(self):
+        client = WebsocketCommunicator(
+            consumers.AsyncGameConsumer.as_asgi(), "/ws/game/"
+        )
+        await client.connect()
+        return client
+
+    def throttled(self, reason):
+        return metrics.THROTTLED_FRAMES.values.get((reason,), 0)
+
+    async def test_closes_on_oversize_and_malformed_frames(self):
+        for frame, code in (
+            ("x" * (settings.GAME_MAX_FRAME_BYTES + 1), 1009),
+            ("[1, 2]", 1003),
+            ('{"command": {}}', 1003),
+            ('{"command": "move"}', 1003),
+            ('{"command": "move", "san": 5}', 1003),
+            ('{"command": "resume", "game": "x"}', 1003),
+            (
+                json.dumps({"command": "resume", "game": "f" * 32, "token": "é" * 32}),
+                1003,
+            ),
+            ('{"command": "find_opponent", "control": []}', 1003),
+        ):
+            client = await self.connect()
+            await client.send_to(text_data=frame)
+            closed = await client.receive_output(5)
+            self.assertEqual(closed, {"type": "websocket.close", "code": code})
+            await client.disconnect()
+
+    async def test_closes_a_spectator_sending_bad_frames(self):
+        game_uuid = "f" * 32
+        for frame, code in (
+            ("x" * (settings.GAME_MAX_FRAME_BYTES + 1), 1009),
+            ("{", 1003),
+        ):
+            client = WebsocketCommunicator(
+                consumers.SpectatorConsumer.as_asgi(), f"/ws/watch/{game_uuid}/"
+            )
+            client.scope["url_route"] = {"kwargs": {"game_uuid": game_uuid}}
+            await client.connect()
+            await client.send_to(text_data=frame)
+            closed = await client.receive_output(5)
+            self.assertEqual(closed, {"type": "websocket.close", "code": code})
+            await client.disconnect()
+
+    async def test_closes_a_player_sending_a_malformed_move(self):
+        white, black = await start_game()
+        await white.send_json_to({"command": "move", "san": None})
+        closed = await white.receive_output(5)
+        self.assertEqual(closed, {"type": "websocket.close", "code": 1003})
+        await white.disconnect()
+        await black.disconnect()
+
+    @override_settings(GAME_FRAME_STRIKES=3, GAME_FRAME_STRIKE_RATE=0)
+    async def test_drops_frames_over_the_limits_then_closes(self):
+        limited, coalesced = self.throttled("limited"), self.throttled("coalesced")
+        client = await self.connect()
+        # one poll is handled, the next four of the burst coalesced
+        for _ in range(5):
+            await client.send_json_to({"command": "end_if_timeout"})
+        self.assertTrue(await client.receive_nothing())
+        self.assertEqual(self.throttled("coalesced"), coalesced + 4)
+
+        for _ in range(3):
+            await client.send_json_to({"command": "end_if_timeout"})
+        self.assertTrue(await client.receive_nothing())
+        await client.send_json_to({"command": "end_if_timeout"})
+        closed = await client.receive_output(5)
+        self.assertEqual(closed, {"type": "websocket.close", "code": 1008})
+        self.assertEqual(self.throttled("limited"), limited + 4)
+        await client.disconnect()
+
+
+@unittest.skipUnless(redis_running(), "redis is not running")
+@isolated
+class ComputerTests(SimpleTestCase):
+    async def find_opponent(self):
+        await WaitingQueue("blitz_3_2").clear()
+        client = WebsocketCommunicator(
+            consumers.AsyncGameConsumer.as_asgi(), "/ws/game/"
+        )
+        await client.connect()
+        await client.send_json_to({"command": "find_opponent", "control": "blitz_3_2"})
+        return client
+
+    @override_settings(GAME_COMPUTER_OFFER_AFTER=0)
+    async def test_plays_the_computer_once_offered(self):
+        searched = metrics.COMPUTER_MOVES.values.get(("searched",), 0)
+        client = await self.find_opponent()
+        self.assertEqual(
+            await client.receive_json_from(5), {"command": "computer_offered"}
+        )
+        await client.send_json_to({"command": "play_computer", "level": "easy"})
+        start = await client.receive_json_from(5)
+        self.assertEqual((start["colour"], start["opponent"]), ("white", "computer"))
+        self.assertFalse(await WaitingQueue("blitz_3_2").search(start["client"]))
+
+        await client.send_json_to({"command": "move", "san": "e4"})
+        self.assertEqual((await client.receive_json_from(5))["san"], "e4")
+        # the worker process of the searcher may still be starting
+        answer = await client.receive_json_from(30)
+        self.assertEqual(answer["colour"], "black")
+        board = chess.Board()
+        board.push_san("e4")
+        board.push_san(answer["san"])
+        self.assertEqual(
+            metrics.COMPUTER_MOVES.values.get(("searched",), 0), searched + 1
+        )
+        await client.disconnect()
+
+    @override_settings(GAME_COMPUTER_OFFER_AFTER=60)
+    async def test_ignores_play_computer_before_the_offer(self):
+        client = await self.find_opponent()
+        await client.send_json_to({"command": "play_computer"})
+        self.assertTrue(await client.receive_nothing(0.5))
+        await client.disconnect()
+
+
+@unittest.skipUnless(redis_running(), "redis is not running")
+@isolated
+class HandoffTests(SimpleTestCase):
+    def tearDown(self):
+        handoff.state.clear()
+
+    async def test_players_resume_a_drained_game_elsewhere(self):
+        white, black = await start_game()
+        for mover, san in ((white, "e4"), (black, "e5")):
+            await mover.send_json_to({"command": "move", "san": san})
+            for client in (white, black):
+                clocks = await client.receive_json_from(5)
+
+        await handoff.drain()
+        for client in (white, black):
+            closed = await client.receive_output(5)
+            self.assertEqual(closed, {"type": "websocket.close", "code": 1012})
+            await client.disconnect()
+        # a new process takes over
+        await asyncio.sleep(0.5)
+        handoff.state.clear()
+        shards.local.pop("task").cancel()
+        shards.local.clear()
+
+        app = consumers.AsyncGameConsumer.as_asgi()
+        players = []
+        for old in (white, black):
+            client = WebsocketCommunicator(app, "/ws/game/")
+            await client.connect()
+            await client.send_json_to(
+                {
+                    "command": "resume",
+                    "game": old.start["game"],
+                    "token": old.start["token"],
+                }
+            )
+            resumed = await client.receive_json_from(5)
+            self.assertEqual(resumed["moves"], ["e4", "e5"])
+            # the time in between wasn't charged to white
+            self.assertEqual(resumed["black_time"], clocks["black_time"])
+            self.assertGreater(resumed["white_time"], clocks["white_time"] - 400)
+            players.append(client)
+
+        await players[0].send_json_to({"command": "move", "san": "Nf3"})
+        for client in players:
+            self.assertEqual((await client.receive_json_from(5))["san"], "Nf3")
+            await client.disconnect()
+
+
+def play_games(consumer, games):
+    """Play games of scholar's mate as one player, in a fresh process.
+
+    Return how each game ended and whether this process owned any game.
+    """
+
+    app = {"sync": consumers.GameConsumer, "async": consumers.AsyncGameConsumer}[
+        consumer
+    ].as_asgi()
+
+    async def play():
+        results = []
+        for _ in range(games):
+            client = WebsocketCommunicator(app, "/ws/game/")
+            await client.connect()
+            await client.send_json_to(
+                {"command": "find_opponent", "control": "bullet"}
+            )
+            start = await client.receive_json_from(30)
+            moves = list(SCRIPT[start["colour"]])
+            if start["colour"] == "white":
+                await client.send_json_to({"command": "move", "san": moves.pop(0)})
+
+            while True:
+                frame = await client.receive_json_from(30)
+                if frame["command"] != "moved":
+                    break
+                if frame["colour"] != start["colour"] and moves:
+                    await client.send_json_to(
+                        {"command": "move", "san": moves.pop(0)}
+                    )
+
+            results.append(
+                (frame["command"], frame.get("winner_colour"), frame.get("by"))
+            )
+            await client.disconnect()
+        return results, "channel" in shards.local
+
+    return asyncio.run(play())
+
+
+@unittest.skipUnless(redis_running(), "redis is not running")
+@isolated
+class MultiProcessGameTests(SimpleTestCase):
+    """Games between players connected to different processes.
+
+    Needs the redis of REDIS_HOSTS. The shard tests start runworker
+    processes owning the games. The processes archive into a database of
+    their own and share the tests' redis db.
+    """
+
+    GAMES = 4
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.env = {
+            "DATABASE_PATH": os.path.join(cls.directory.name, "db.sqlite3"),
+            "REDIS_DB": str(TEST_REDIS_DB),
+        }
+        subprocess.run(
+            [sys.executable, "manage.py", "migrate"],
+            cwd=settings.BASE_DIR,
+            env={**os.environ, **cls.env},
+            stdout=subprocess.DEVNULL,
+            check=True,
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.workers = []
+        async_to_sync(WaitingQueue("bullet").clear)()
+
+    def tearDown(self):
+        for worker in self.workers:
+            worker.terminate()
+            worker.wait()
+
+    def start_workers(self, shards):
+        env = {**os.environ, **self.env, "GAME_SHARDS": ",".join(shards)}
+        for name in shards:
+            self.workers.append(
+                subprocess.Popen(
+                    [sys.executable, "manage.py", "runworker", f"game-shard.{name}"],
+                    cwd=settings.BASE_DIR,
+                    env=env,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            )
+
+    def play(self, shards, consumer):
+        # the players' processes load their settings from the environment
+        context = multiprocessing.get_context("spawn")
+        env = {**self.env, "GAME_SHARDS": ",".join(shards)}
+        with mock.patch.dict(os.environ, env):
+            with context.Pool(2, initializer=django.setup) as pool:
+                players = pool.starmap(play_games, [(consumer, self.GAMES)] * 2)
+
+        for results, _ in players:
+            self.assertEqual(results, [("win", "white", "checkmate")] * self.GAMES)
+        return [owned for _, owned in players]
+
+    def test_shards_own_the_games(self):
+        shards = ["test-1", "test-2"]
+        self.start_workers(shards)
+        for consumer in ("async", "sync"):
+            with self.subTest(consumer=consumer):
+                self.assertEqual(self.play(shards, consumer), [False, False])
+
+    def test_creating_process_owns_the_game(self):
+        for consumer in ("async", "sync"):
+            with self.subTest(consumer=consumer):
+                self.assertIn(True, self.play([], consumer))
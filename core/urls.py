@@ -3,4 +3,8 @@ from .views import *
 
 app_name = "core"
 
-urlpatterns = [path("", home, name="home")]
+urlpatterns = [
+    path("", home, name="home"),
+    path("explorer", explorer, name="explorer"),
+    path("games.pgn", export_pgn, name="export_pgn"),
+]
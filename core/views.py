@@ -1,5 +1,103 @@
+import functools
+import tempfile
+import chess
+from django.conf import settings
+from django.contrib import messages
+from django.db.models import Q
+from django.http import FileResponse, Http404, HttpResponse, JsonResponse
 from django.shortcuts import render
+from django.views.decorators.cache import cache_page, never_cache
+from django.views.decorators.vary import vary_on_cookie
+from . import assets, metrics, models, pgn
+from .explorer import OpeningExplorer
 
 
+# chessboard.js names its pieces by colour and role, e.g. "wK"
+PIECES = [colour + role for colour in "wb" for role in "KQRBNP"]
+
+
+def cache_page_without_messages(timeout):
+    """Cache a page per cookie header, unless flash messages are pending.
+
+    Messages are shown once, a page rendering them is never cached, or the
+    same cookies would be served them again.
+    """
+
+    def decorator(view):
+        cached = cache_page(timeout)(vary_on_cookie(view))
+        uncached = never_cache(view)
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if messages.get_messages(request):
+                return uncached(request, *args, **kwargs)
+            return cached(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@cache_page_without_messages(settings.GAME_HOME_CACHE_SECONDS)
 def home(request):
-    return render(request, "core/home.html")
+    time_controls = [
+        (name, f"{name.split('_')[0].title()} {base // 60000}+{increment // 1000}")
+        for name, (base, increment) in settings.GAME_TIME_CONTROLS.items()
+    ]
+    return render(
+        request,
+        "core/home.html",
+        {
+            "time_controls": time_controls,
+            "default_time_control": settings.GAME_DEFAULT_TIME_CONTROL,
+            "piece_urls": {
+                piece: assets.url(f"img/chesspieces/wikipedia/{piece}.png")
+                for piece in PIECES
+            },
+        },
+    )
+
+
+def prometheus_metrics(request):
+    if not settings.GAME_METRICS:
+        raise Http404
+    return HttpResponse(
+        metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def explorer(request):
+    """Return the moves played from the position ?fen= and how they scored."""
+    try:
+        board = chess.Board(request.GET.get("fen", chess.STARTING_FEN))
+    except ValueError:
+        return JsonResponse({"error": "invalid fen"}, status=400)
+
+    return JsonResponse({"fen": board.fen(), "moves": OpeningExplorer().moves(board)})
+
+
+def export_pgn(request):
+    """Send the archived games as PGN, those of ?user= if given.
+
+    The games are written to a temporary file before the response starts,
+    under ASGI a streamed body is read on the event loop, where the
+    queries of the chunks can't run nor be waited on without stalling the
+    game sockets.
+    """
+    games = models.Game.objects.all()
+    username = request.GET.get("user")
+    if username:
+        games = games.filter(
+            Q(white__username=username) | Q(black__username=username)
+        )
+
+    export = tempfile.TemporaryFile()
+    for text in pgn.export_games(games):
+        export.write(text.encode())
+    export.seek(0)
+    return FileResponse(
+        export,
+        as_attachment=True,
+        filename="games.pgn",
+        content_type="application/x-chess-pgn",
+    )
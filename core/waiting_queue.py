@@ -1,26 +1,178 @@
-import redis
+import asyncio
+import hashlib
+import uuid
+from aioredis.errors import ReplyError
+from asgiref.sync import async_to_sync
 from django.conf import settings
+from . import metrics, redis_pool
 
-# connect to redis
-r = redis.Redis(
-    host=settings.REDIS_HOST,
-    port=settings.REDIS_PORT,
-    db=settings.REDIS_DB,
-    decode_responses=True,
-)
+# Pair ARGV[1] with the first client still waiting in a rating bucket within
+# ARGV[3] buckets of its own bucket ARGV[2], nearest buckets first, skipping
+# entries that were cancelled. Of the buckets as near, clients queued by the
+# same process ARGV[6] come first: unless ARGV[6] is empty, clients are also
+# queued in a list of their process's for the bucket. A new client is
+# enqueued in its bucket if nobody is found. A client already waiting
+# (ARGV[5] == "1") only searches further buckets, its own never holds
+# anybody else, and gives up if it was paired in the meantime. A client never
+# takes its own entries, those a rejoin in another bucket left behind. Returns
+# the opponent and the user id it joined with. Runs atomically on the server so
+# two clients can't both miss and wait for each other, nor both take the
+# same opponent.
+MATCH = """
+local client, bucket, radius = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+local waiting, process = ARGV[5] == "1", ARGV[6]
+local function lists(buckets)
+    local keys = {}
+    if process ~= "" then
+        for _, b in ipairs(buckets) do
+            table.insert(keys, KEYS[3] .. b .. ":" .. process)
+        end
+    end
+    for _, b in ipairs(buckets) do
+        table.insert(keys, KEYS[3] .. b)
+    end
+    return keys
+end
+if waiting and redis.call("SISMEMBER", KEYS[1], client) == 0 then
+    return false
+end
+
+for distance = waiting and 1 or 0, radius do
+    local buckets = {bucket - distance, bucket + distance}
+    if distance == 0 then
+        buckets = {bucket}
+    end
+    for _, list in ipairs(lists(buckets)) do
+        while true do
+            local val = redis.call("LPOP", list)
+            if not val then
+                break
+            end
+            if val ~= client and redis.call("SREM", KEYS[1], val) == 1 then
+                local user_id = redis.call("HGET", KEYS[2], val)
+                redis.call("HDEL", KEYS[2], val)
+                if waiting then
+                    redis.call("SREM", KEYS[1], client)
+                    redis.call("HDEL", KEYS[2], client)
+                end
+                return {val, user_id}
+            end
+        end
+    end
+end
+
+if not waiting then
+    redis.call("RPUSH", KEYS[3] .. bucket, client)
+    if process ~= "" then
+        local list = KEYS[3] .. bucket .. ":" .. process
+        redis.call("RPUSH", list, client)
+        -- dropped once the process is gone a day
+        redis.call("EXPIRE", list, 86400)
+    end
+    redis.call("SADD", KEYS[1], client)
+    redis.call("HSET", KEYS[2], client, ARGV[4])
+end
+return false
+"""
+MATCH_SHA = hashlib.sha1(MATCH.encode()).hexdigest()
+# this process in the waiting queue, its clients are paired with each other
+# first so the events of their game stay in memory
+PROCESS = uuid.uuid4().hex
 
 
 class WaitingQueue:
-    KEY = "waiting-queue"
+    """Rating bucketed FIFOs of the clients waiting for a time control.
+
+    Clients are queued in the bucket of GAME_RATING_BUCKET rating points
+    their rating falls in and paired with the nearest waiting client within
+    a radius of buckets, so a join touches a handful of keys however many
+    clients wait. The set holds the clients actually waiting and the hash
+    the user each of them joined as. Cancelling only removes from those; the
+    stale list entry is dropped when a search reaches it.
+
+    The operations are coroutines on the pooled clients of redis_pool, each
+    a single round trip.
+    """
+
+    def __init__(self, control=None):
+        self.control = control or settings.GAME_DEFAULT_TIME_CONTROL
+        # every time control has a queue of its own
+        self.key = f"waiting-queue:{self.control}"
+        self.members_key = f"waiting-queue-members:{self.control}"
+        self.users_key = f"waiting-queue-users:{self.control}"
+
+    def bucket(self, rating):
+        return int(rating // settings.GAME_RATING_BUCKET)
+
+    async def redis(self):
+        # every time control's queue lives on one of REDIS_HOSTS
+        return await redis_pool.connection(self.control)
 
-    def push(self, val):
-        r.rpush(self.KEY, val)
+    @metrics.timed(metrics.WAITING_QUEUE_SECONDS, "match")
+    async def match(self, val, rating, radius=0, user_id=None, waiting=False):
+        """Return (opponent, opponent's user id) for val, or None.
 
-    def pop(self):
-        return r.lpop(self.KEY)
+        A new client is enqueued if no opponent is found. A client already
+        waiting passes waiting=True and a radius widened with its wait.
+        """
+        redis = await self.redis()
+        keys = [self.members_key, self.users_key, f"{self.key}:"]
+        args = [
+            val,
+            self.bucket(rating),
+            radius,
+            user_id or "",
+            int(waiting),
+            PROCESS if settings.GAME_MATCH_COLOCATE else "",
+        ]
+        try:
+            opponent = await redis.evalsha(MATCH_SHA, keys, args)
+        except ReplyError as e:
+            if not str(e).startswith("NOSCRIPT"):
+                raise
+            # first run on this server, EVAL caches the script for EVALSHA
+            opponent = await redis.eval(MATCH, keys, args)
+        if not opponent:
+            return None
+        return opponent[0], int(opponent[1]) if opponent[1] else None
 
-    def search(self, val):
-        return str(val) in r.lrange(self.KEY, 0, -1)
+    @metrics.timed(metrics.WAITING_QUEUE_SECONDS, "search")
+    async def search(self, val):
+        redis = await self.redis()
+        return bool(await redis.sismember(self.members_key, str(val)))
 
-    def remove(self, val):
-        r.lrem(self.KEY, 0, val)
+    @metrics.timed(metrics.WAITING_QUEUE_SECONDS, "remove")
+    async def remove(self, val):
+        """Take val out of the queue, return whether it was still waiting."""
+        redis = await self.redis()
+        pipe = redis.pipeline()
+        pipe.srem(self.members_key, val)
+        pipe.hdel(self.users_key, val)
+        removed, _ = await pipe.execute()
+        return bool(removed)
+
+    @metrics.timed(metrics.WAITING_QUEUE_SECONDS, "count")
+    async def count(self):
+        redis = await self.redis()
+        return await redis.scard(self.members_key)
+
+    @metrics.timed(metrics.WAITING_QUEUE_SECONDS, "clear")
+    async def clear(self):
+        redis = await self.redis()
+        buckets = [key async for key in redis.iscan(match=f"{self.key}:*")]
+        await redis.delete(self.members_key, self.users_key, *buckets)
+
+
+async def waiting_players():
+    """Return how many clients wait, over the queues of every time control."""
+    counts = await asyncio.gather(
+        *(WaitingQueue(control).count() for control in settings.GAME_TIME_CONTROLS)
+    )
+    return sum(counts)
+
+
+metrics.Gauge(
+    "chess_waiting_players",
+    "Players waiting in the queue for an opponent.",
+    lambda: async_to_sync(waiting_players)(),
+)
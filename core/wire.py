@@ -0,0 +1,66 @@
+from datetime import datetime, timezone
+import chess
+import msgpack
+
+# Clients offering the chess.msgpack subprotocol at connect exchange msgpack
+# arrays instead of JSON objects. Moves travel as 16 bit codes
+# (from | to << 6 | promotion << 12) and clocks as milliseconds left.
+# Clients offering nothing, or chess.json, keep the JSON protocol.
+MSGPACK_SUBPROTOCOL = "chess.msgpack"
+JSON_SUBPROTOCOL = "chess.json"
+
+# client to server opcodes
+FIND_OPPONENT = 0
+MOVE = 1
+END_IF_TIMEOUT = 2
+CANCEL_PREMOVE = 3
+COMMANDS = {
+    FIND_OPPONENT: "find_opponent",
+    MOVE: "move",
+    END_IF_TIMEOUT: "end_if_timeout",
+    CANCEL_PREMOVE: "cancel_premove",
+}
+
+# server to client opcodes
+START = 0
+MOVED = 1
+WIN = 2
+DRAW = 3
+RESUME = 4
+WATCH = 5
+ANALYSIS = 6
+PREMOVE_DROPPED = 7
+COMPUTER_OFFERED = 8
+RESUME_REFUSED = 9
+GONE = 10
+
+
+def encode_move(move):
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def decode_move(code):
+    if not isinstance(code, int) or not 0 <= code < 6 << 12:
+        raise ValueError(f"invalid move code: {code!r}")
+    return chess.Move(code & 63, code >> 6 & 63, code >> 12 or None)
+
+
+def epoch_ms(dt):
+    return int(dt.timestamp() * 1000)
+
+
+def from_epoch_ms(ms):
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+
+
+def pack(*fields):
+    return msgpack.packb(fields)
+
+
+def unpack_command(bytes_data):
+    """Return a binary frame as the dict its JSON counterpart would load to."""
+    fields = msgpack.unpackb(bytes_data)
+    command = {"command": COMMANDS.get(fields[0])}
+    if fields[0] == MOVE:
+        command["move"] = fields[1]
+    return command
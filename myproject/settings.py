@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -83,7 +84,7 @@ WSGI_APPLICATION = "myproject.wsgi.application"
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+        "NAME": os.environ.get("DATABASE_PATH", BASE_DIR / "db.sqlite3"),
     }
 }
 
@@ -132,16 +133,163 @@ STATICFILES_DIRS = (BASE_DIR / "static",)
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
-REDIS_HOST = "localhost"
-REDIS_PORT = 6379
-REDIS_DB = 1
+# Redis hosts as "host:port,host:port". Channels and groups are spread over
+# them by channels_redis and every time control's waiting queue lives on one
+# of them.
+REDIS_HOSTS = [
+    (host, int(port))
+    for host, port in (
+        address.split(":")
+        for address in os.environ.get("REDIS_HOSTS", "127.0.0.1:6379").split(",")
+    )
+]
+REDIS_DB = int(os.environ.get("REDIS_DB", 1))
+# connections the game server keeps to each redis host per event loop, the
+# most waiting queue commands in flight at once
+REDIS_POOL_SIZE = 10
 
 ASGI_APPLICATION = "myproject.asgi.application"
+# channels_redis, delivering in memory to the channels of the same process
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "core.layers.HybridChannelLayer",
         "CONFIG": {
-            "hosts": [("127.0.0.1", 6379)],
+            "hosts": REDIS_HOSTS,
+            # messages waiting for the consumers of a process, which share
+            # one list in redis, before sends fail with ChannelFull
+            "capacity": 10000,
         },
     },
 }
+
+# Names of the shards owning the games, comma separated. Each game belongs to
+# the shard its uuid hashes to, served by a worker started with
+# `python manage.py runworker game-shard.<name>`. Left empty, a game is owned
+# by the process that created it.
+GAME_SHARDS = [name for name in os.environ.get("GAME_SHARDS", "").split(",") if name]
+
+# "async" serves ws/game/ with AsyncGameConsumer, "sync" with GameConsumer
+GAME_CONSUMER = "async"
+
+# finished games are written by a background thread in batches, not at all
+# when off; ratings are applied either way
+GAME_ARCHIVE = True
+GAME_ARCHIVE_BATCH_SIZE = 100
+GAME_ARCHIVE_FLUSH_INTERVAL = 1  # seconds
+GAME_ARCHIVE_QUEUE_SIZE = 10000
+
+# let clients negotiate the compact msgpack frames of core.wire
+GAME_MSGPACK_FRAMES = True
+
+# seconds a disconnected player's seat is held before the game is abandoned
+GAME_RECONNECT_GRACE = 30
+
+# seconds a spectator waits for the snapshot of its game, one no owner answers
+# for is unknown or over and the socket is told it's gone and closed
+GAME_WATCH_TIMEOUT = 5
+
+# Frames a game socket may send: GAME_FRAME_LIMITS[command] is the (rate a
+# second, burst) of a command, "*" of the others, {} turns the limits off.
+# The commands of GAME_FRAME_INTERVALS are handled at most once every so many
+# seconds. Frames over a limit are dropped, a socket dropping more than
+# GAME_FRAME_STRIKES, regained at GAME_FRAME_STRIKE_RATE a second, is closed
+# like one sending a frame over GAME_MAX_FRAME_BYTES or a malformed one.
+GAME_MAX_FRAME_BYTES = 4096
+GAME_FRAME_LIMITS = {
+    "move": (10, 20),
+    "cancel_premove": (10, 20),
+    "find_opponent": (0.5, 5),
+    "resume": (0.5, 5),
+    "end_if_timeout": (1, 5),
+    "*": (2, 10),
+}
+GAME_FRAME_INTERVALS = {"end_if_timeout": 1}  # seconds
+GAME_FRAME_STRIKES = 50
+GAME_FRAME_STRIKE_RATE = 1
+
+# time controls offered at find_opponent, as (base, increment) in ms, each
+# with a waiting queue of its own
+GAME_TIME_CONTROLS = {
+    "bullet": (60_000, 0),
+    "blitz": (300_000, 0),
+    "blitz_3_2": (180_000, 2_000),
+    "rapid": (600_000, 0),
+    "rapid_15_10": (900_000, 10_000),
+}
+GAME_DEFAULT_TIME_CONTROL = "rapid"
+
+# Elo rating and rating bucketed matchmaking. A waiting player accepts
+# opponents one bucket further away every GAME_MATCH_WIDEN_EVERY seconds,
+# up to GAME_MATCH_MAX_RADIUS buckets away.
+GAME_RATING_K = 32
+GAME_RATING_BUCKET = 50
+GAME_MATCH_WIDEN_EVERY = 5  # seconds
+GAME_MATCH_MAX_RADIUS = 8
+# pair players connected to the same process first, within a bucket, so the
+# moves of their game are delivered in memory by core.layers
+GAME_MATCH_COLOCATE = True
+
+# time the game server's hot paths and serve them at /metrics in the
+# Prometheus text format, off leaves the timed functions undecorated
+GAME_METRICS = True
+
+# Position analysis on GAME_ENGINE_POOL_SIZE engines, UCI binaries at
+# GAME_ENGINE_PATH, e.g. stockfish, or without one the slow pure Python
+# searcher of core.searcher. Depths are in plies, every search is cut after
+# GAME_ANALYSIS_TIME seconds. Each user gets GAME_ANALYSIS_BURST analyses at
+# once and GAME_ANALYSIS_RATE more a second.
+GAME_ENGINE_PATH = os.environ.get("GAME_ENGINE_PATH", "")
+GAME_ENGINE_POOL_SIZE = 2
+GAME_ANALYSIS_QUEUE_SIZE = 32
+GAME_ANALYSIS_CACHE_SIZE = 10000
+GAME_ANALYSIS_DEPTH = 12
+GAME_ANALYSIS_MAX_DEPTH = 20
+GAME_ANALYSIS_TIME = 2  # seconds
+GAME_ANALYSIS_RATE = 0.2
+GAME_ANALYSIS_BURST = 5
+
+# Players waiting GAME_COMPUTER_OFFER_AFTER seconds for an opponent, checked at
+# every widening, are offered a game against the computer, None offers none.
+# GAME_COMPUTER_LEVELS are the (depth, seconds) a computer move is searched
+# with, at most a GAME_COMPUTER_MOVES_LEFT'th of its clock, on engines of their
+# own like those of the analyses: GAME_COMPUTER_POOL_SIZE of them with at most
+# GAME_COMPUTER_QUEUE_SIZE moves queued.
+GAME_COMPUTER_OFFER_AFTER = 15  # seconds
+GAME_COMPUTER_LEVELS = {"easy": (1, 0.5), "medium": (2, 1), "hard": (4, 2)}
+GAME_COMPUTER_DEFAULT_LEVEL = "medium"
+GAME_COMPUTER_MOVES_LEFT = 30
+GAME_COMPUTER_POOL_SIZE = 2
+GAME_COMPUTER_QUEUE_SIZE = 64
+
+# opening explorer index built from the archived games by
+# `python manage.py build_explorer`, counting their first GAME_EXPLORER_PLIES
+GAME_EXPLORER_PATH = BASE_DIR / "explorer.idx"
+GAME_EXPLORER_PLIES = 30
+
+# archived games read per query when streaming them out as PGN
+GAME_PGN_CHUNK_SIZE = 2000
+
+# Static files each page loads, bundled by `python manage.py build_assets`
+# with the fonts and images their css uses and GAME_ASSET_FILES into
+# fingerprinted, precompressed files under GAME_ASSETS_ROOT/build. Until
+# then pages load the sources one by one.
+GAME_ASSETS_ROOT = BASE_DIR / "static"
+GAME_ASSET_BUNDLES = {
+    "base.css": ["css/bootstrap.min.css", "css/mdb.min.css", "css/style.min.css"],
+    "base.js": [
+        "js/jquery-3.4.1.min.js",
+        "js/popper.min.js",
+        "js/bootstrap.min.js",
+        "js/mdb.min.js",
+    ],
+    "home.css": ["css/chessboard-1.0.0.min.css"],
+    "home.js": ["js/chessboard-1.0.0.js", "core/js/game.js"],
+}
+GAME_ASSET_FILES = ["img/chesspieces/wikipedia/*.png"]
+
+# seconds the rendered home page is cached for, per session cookie
+GAME_HOME_CACHE_SECONDS = 60
+
+# seconds a game handed off by a draining process waits in redis for one of
+# its players to resume it on another process
+GAME_HANDOFF_TTL = 300
@@ -15,8 +15,10 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path, include
+from core.views import prometheus_metrics
 
 urlpatterns = [
     path("admin/", admin.site.urls),
+    path("metrics", prometheus_metrics, name="metrics"),
     path("", include("core.urls", namespace="core")),
 ]
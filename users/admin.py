@@ -2,4 +2,10 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from .models import User
 
-admin.site.register(User, UserAdmin)
+
+class RatedUserAdmin(UserAdmin):
+    fieldsets = UserAdmin.fieldsets + (("Rating", {"fields": ("rating",)}),)
+    list_display = UserAdmin.list_display + ("rating",)
+
+
+admin.site.register(User, RatedUserAdmin)
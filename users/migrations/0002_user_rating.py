@@ -0,0 +1,18 @@
+# Generated by Django 3.2.10 on 2026-10-18 19:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='rating',
+            field=models.FloatField(default=1500),
+        ),
+    ]
@@ -1,5 +1,8 @@
 from django.contrib.auth.models import AbstractUser
+from django.db import models
+
+DEFAULT_RATING = 1500
 
 
 class User(AbstractUser):
-    pass
+    rating = models.FloatField(default=DEFAULT_RATING)